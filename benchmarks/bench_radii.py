@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the source radius estimate in ap_photom, comparing the old
+per-source loop with the vectorised profile gather.
+
+    python benchmarks/bench_radii.py [nsources]
+"""
+import os
+import sys
+import time
+import numpy as np
+from copy import deepcopy
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'pouakai'))
+from aperture_photom import ap_photom
+
+
+def make_image(nsources,ny=4096,nx=2048,sigma=2.2,seed=0):
+	rng = np.random.default_rng(seed)
+	image = rng.normal(500,10,(ny,nx)).astype(np.float32)
+	x = rng.uniform(20,nx-20,nsources)
+	y = rng.uniform(20,ny-20,nsources)
+	amp = rng.uniform(200,2e4,nsources)
+	yy, xx = np.mgrid[-12:13,-12:13]
+	for i in range(nsources):
+		x0, y0 = int(x[i]), int(y[i])
+		psf = amp[i] * np.exp(-((xx + x0 - x[i])**2 + (yy + y0 - y[i])**2) / (2 * sigma**2))
+		image[y0-12:y0+13,x0-12:x0+13] += psf.astype(np.float32)
+	return image, x, y
+
+def old_radii(phot):
+	xcoords = phot.source_x.astype(int)
+	ycoords = phot.source_y.astype(int)
+	data = deepcopy(phot.data) - phot.data_median
+	data[data < 0] = 0
+	radii = []
+	for i in range(len(xcoords)):
+		data1 = data[ycoords[i],xcoords[i]:xcoords[i]+30]
+		normal = data1 / data[ycoords[i], xcoords[i]]
+		try:
+			fwhm = np.where(normal < 0.5)[0][0]
+		except:
+			fwhm = np.nan
+		radii += [fwhm]
+	return np.array(radii) * 1.4
+
+def run(nsources=5000,sigma=2.2):
+	image, x, y = make_image(nsources,sigma=sigma)
+	phot = ap_photom(data=image,run=False)
+	phot._image_stats()
+	phot.source_x = x + 0.5
+	phot.source_y = y + 0.5
+
+	t0 = time.perf_counter()
+	radii = old_radii(phot)
+	t_old = time.perf_counter() - t0
+
+	t0 = time.perf_counter()
+	phot._calc_radii()
+	t_new = time.perf_counter() - t0
+
+	t0 = time.perf_counter()
+	phot._calc_fwhm()
+	t_fwhm = time.perf_counter() - t0
+
+	same = np.array_equal(radii,phot.radii,equal_nan=True)
+	print('sources: {}'.format(nsources))
+	print('loop:       {:.3f} s'.format(t_old))
+	print('vectorised: {:.3f} s (x{:.1f}), of which sub-pixel FWHM {:.3f} s'.format(t_new,t_old/t_new,t_fwhm))
+	print('radii identical: {}'.format(same))
+	print('global FWHM: {:.2f} pix (input {:.2f})'.format(phot.fwhm,2.3548*sigma))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		run(int(sys.argv[1]))
+	else:
+		run()
@@ -0,0 +1,79 @@
+"""
+Benchmark of the satellite streak detection at full resolution against the
+binned detection with full resolution refinement, on synthetic frames with
+0-3 trails. Reports the time, number of streaks found and the overlap of the
+masks with the full resolution mask and with the injected trails.
+
+    python benchmarks/bench_sat_streaks.py [nstars]
+"""
+import os
+import sys
+import time
+import warnings
+import numpy as np
+import cv2
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'pouakai'))
+from satellite_detection import sat_streaks
+
+
+def make_image(ntrails,nstars=1000,ny=4096,nx=2048,amp=200,width=3,seed=0):
+	rng = np.random.default_rng(seed)
+	image = rng.normal(500,10,(ny,nx)).astype(np.float32)
+	x = rng.uniform(10,nx-10,nstars)
+	y = rng.uniform(10,ny-10,nstars)
+	flux = rng.uniform(100,3e4,nstars)
+	yy, xx = np.mgrid[-10:11,-10:11]
+	for i in range(nstars):
+		x0, y0 = int(x[i]), int(y[i])
+		psf = flux[i] * np.exp(-((xx + x0 - x[i])**2 + (yy + y0 - y[i])**2) / (2 * 2.2**2))
+		image[y0-10:y0+11,x0-10:x0+11] += psf.astype(np.float32)
+	truth = np.zeros((ny,nx),dtype=np.uint8)
+	for i in range(ntrails):
+		angle = np.radians(rng.uniform(-60,60))
+		length = rng.uniform(800,2500)
+		cx, cy = rng.uniform(300,nx-300), rng.uniform(600,ny-600)
+		dx, dy = np.cos(angle) * length / 2, np.sin(angle) * length / 2
+		p1, p2 = (int(cx - dx),int(cy - dy)), (int(cx + dx),int(cy + dy))
+		trail = np.zeros((ny,nx),dtype=np.float32)
+		cv2.line(trail,p1,p2,1.0,thickness=width)
+		image += cv2.GaussianBlur(trail,(0,0),1.0) * amp
+		cv2.line(truth,p1,p2,1,thickness=17)
+	return image, truth.astype(bool)
+
+def iou(a,b):
+	union = np.sum(a | b)
+	if union == 0:
+		return 1.0
+	return np.sum(a & b) / union
+
+def run(nstars=1000,binnings=[4,8],ntrails=[0,0,1,1,2,3]):
+	warnings.simplefilter('ignore')
+	times = {b:0 for b in [1] + binnings}
+	agree = {b:0 for b in binnings}
+	print('stars: {}'.format(nstars))
+	print('{:>6} {:>7} {:>6} {:>8} {:>8} {:>9}'.format('trails','binning','found','time s','iou full','iou truth'))
+	for i, n in enumerate(ntrails):
+		image, truth = make_image(n,nstars=nstars,seed=i)
+		full = None
+		for b in [1] + binnings:
+			t0 = time.perf_counter()
+			sat = sat_streaks(image,binning=b)
+			dt = time.perf_counter() - t0
+			times[b] += dt
+			mask = sat.total_mask > 0
+			if full is None:
+				full = (sat.sat_num,mask)
+			else:
+				agree[b] += sat.sat_num == full[0]
+			print('{:>6} {:>7} {:>6} {:>8.2f} {:>8.3f} {:>9.3f}'.format(n,b,sat.sat_num,dt,iou(mask,full[1]),iou(mask,truth)))
+	for b in binnings:
+		print('binning {}: x{:.1f} faster, same number of streaks on {}/{} frames'.format(
+			  b,times[1] / times[b],agree[b],len(ntrails)))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		run(int(sys.argv[1]))
+	else:
+		run()
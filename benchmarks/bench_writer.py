@@ -0,0 +1,66 @@
+"""
+Compare the old write-then-gzip path against the streamed writers in fits_writer
+for a MOA sized calibrated image with its mask extension.
+
+    python benchmarks/bench_writer.py [outdir]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'pouakai'))
+from fits_writer import write_fits
+
+
+def make_frame(ny=4096,nx=2048,seed=0):
+	rng = np.random.default_rng(seed)
+	image = rng.normal(500,20,(ny,nx)).astype(np.float32)
+	ys = rng.integers(0,ny,2000)
+	xs = rng.integers(0,nx,2000)
+	image[ys,xs] += rng.uniform(1e3,3e4,2000).astype(np.float32)
+	mask = np.zeros((ny,nx),dtype=int)
+	mask[:,100:103] = 16
+	mask[ys,xs] |= 2
+	header = fits.Header()
+	header['EXPTIME'] = 60
+	return image, mask, header
+
+def hdul_for(image,mask,header):
+	phdu = fits.PrimaryHDU(data = image, header = header)
+	mhdu = fits.ImageHDU(data = mask, header = header)
+	return fits.HDUList([phdu, mhdu])
+
+def old_path(hdul,name):
+	hdul.writeto(name,overwrite=True)
+	os.system('gzip -f ' + name)
+	return name + '.gz'
+
+def run(outdir,repeats=3):
+	image, mask, header = make_frame()
+	cases = [('gzip -f (old)',lambda n: old_path(hdul_for(image,mask,header),n)),
+			 ('gzip stream level 1',lambda n: write_fits(hdul_for(image,mask,header),n,compress='gzip',level=1)),
+			 ('gzip stream level 6',lambda n: write_fits(hdul_for(image,mask,header),n,compress='gzip',level=6)),
+			 ('tile (rice/gzip_2)',lambda n: write_fits(hdul_for(image,mask,header),n,compress='tile')),
+			 ('uncompressed',lambda n: write_fits(hdul_for(image,mask,header),n,compress=False))]
+	print('{:<22}{:>12}{:>14}'.format('writer','time (s)','size (MB)'))
+	for label, func in cases:
+		times = []
+		for i in range(repeats):
+			name = os.path.join(outdir,'bench_{}.fits'.format(i))
+			t0 = time.perf_counter()
+			fname = func(name)
+			times += [time.perf_counter() - t0]
+			size = os.path.getsize(fname)
+			os.remove(fname)
+		print('{:<22}{:>12.2f}{:>14.1f}'.format(label,np.median(times),size/1024**2))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		run(sys.argv[1])
+	else:
+		with tempfile.TemporaryDirectory() as outdir:
+			run(outdir)
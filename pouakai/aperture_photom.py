@@ -11,26 +11,31 @@ from photutils.aperture import SkyCircularAperture, CircularAperture, CircularAn
 
 from scipy.ndimage.filters import convolve
 
-from scipy.ndimage import gaussian_filter
-from scipy.interpolate import griddata
+from zp_surface import fit_surface, zp_correction_surface
 
 from mpl_toolkits.mplot3d import Axes3D
 from gaia_query import get_gaia_region
 
 from scipy.optimize import minimize
 
-from calibrimbore import sauron, get_skymapper_region, get_ps1_region
+from calibrimbore import get_skymapper_region, get_ps1_region
+from sauron_registry import models
+from spatial_index import mask_index, close_neighbours
+from diagnostics import plot_mag_limit
 from astropy.time import Time
 from copy import deepcopy
 
 import os
+import time
+import pandas as pd
 package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
 
 class ap_photom():
 
 	def __init__(self,file=None,data=None,wcs=None,mask=None,header=None,ax=None,
 				 threshold=5.0,run=True,cal_model='ckmodel',brightlim=14,rescale=True,
-				 plot=True,floor=None,radius_override=None,use_catalogue=True):
+				 plot=True,floor=None,radius_override=None,use_catalogue=True,
+				 surface_method='full',surface_bin=16):
 		self.file = file
 		self.data = data
 		self.wcs = wcs
@@ -42,6 +47,8 @@ class ap_photom():
 		self.image_floor = floor
 		self.radius_override = radius_override
 		self.use_catalogue = use_catalogue
+		self.surface_method = surface_method
+		self.surface_bin = surface_bin
 
 
 		
@@ -59,20 +66,27 @@ class ap_photom():
 		self.cal_model = cal_model.lower()
 		self.band = None
 		self.sauron = None
+		self.cat_mags = None
+		self._mask_indexes = {}
 		self.zp = None 
 		self.zp_std = None  
 		self.zps = None
 
+		self._stages = set()
+		self._pass = 0
+		self.timings = []
+
 		if run:
-			self._load_image()
-			self._basic_source_mask()
+			self._run_stage('load_image',self._load_image)
+			self._run_stage('source_mask',self._basic_source_mask)
 			self.calculate_zp(threshold)
 			if rescale:
-				self.ZP_correction()
-				self.Recast_image_scale()
+				self._run_stage('zp_surface',self.ZP_correction)
+				self._run_stage('rescale',self.Recast_image_scale)
 				self.calculate_zp(threshold)
 			else:
 				self.zp_surface = np.ones_like(self.data)
+				self.surface_zps = None
 			self.ap_photom['mag'] = self.ap_photom['sysmag'] + self.zp
 			self.ap_photom['e_mag'] = 2.5/np.log(10)*(self.ap_photom['e_counts']/self.ap_photom['counts'])
 			if plot:
@@ -81,6 +95,30 @@ class ap_photom():
 
 
 
+	def _run_stage(self,name,func,*args,**kwargs):
+		"""
+		Run a pipeline stage unless its output is still valid, and time it.
+		"""
+		if name in self._stages:
+			return
+		t = time.perf_counter()
+		func(*args,**kwargs)
+		self.timings += [{'stage':name,'pass':self._pass,'time':time.perf_counter() - t}]
+		self._stages.add(name)
+
+	def _invalidate(self,*names):
+		"""
+		Mark stages as needing to be rerun.
+		"""
+		for name in names:
+			self._stages.discard(name)
+
+	def timing_report(self):
+		"""
+		Time spent in each stage of the photometry pipeline.
+		"""
+		return pd.DataFrame(self.timings,columns=['stage','pass','time'])
+
 	def _load_image(self):
 		if self.file is not None:
 			self.hdu = fits.open(self.file)[0]
@@ -142,29 +180,71 @@ class ap_photom():
 		#self._mask_killer()
 
 
-	def _calc_radii(self):
-
+	def _calc_radii(self,length=30):
+		"""
+		Estimate the aperture radius from where each source drops to half its peak
+		along +x, as well as a sub-pixel FWHM per source from its profile along both
+		axes. The profiles are gathered straight from the image without copying it.
+		"""
 		xcoords = self.source_x.astype(int)
-		
 		ycoords = self.source_y.astype(int)
-		
-		data = deepcopy(self.data) - self.data_median
-
-		data[data < 0] = 0
-
-		radii = []
-
-		for i in range(len(xcoords)):
-			#print(xcoords[i],ycoords[i])
-			data1 = data[ycoords[i],xcoords[i]:xcoords[i]+30]
-			normal = data1 / data[ycoords[i], xcoords[i]]
-			try:
-				fwhm = np.where(normal < 0.5)[0][0]
-			except:
-				fwhm = np.nan # dummy number 
-			radii += [fwhm]
-		self.radii = np.array(radii) * 1.4
+		nx = self.data.shape[1]
+
+		cols = xcoords[:,np.newaxis] + np.arange(length)[np.newaxis,:]
+		valid = cols < nx
+		profile = self.data[ycoords[:,np.newaxis],np.minimum(cols,nx-1)] - self.data_median
+		profile[profile < 0] = 0
+		with np.errstate(divide='ignore',invalid='ignore'):
+			normal = profile / profile[:,:1]
+		below = (normal < 0.5) & valid
+		fwhm = np.argmax(below,axis=1).astype(float)
+		fwhm[~below.any(axis=1)] = np.nan # dummy number 
+
+		self.radii = fwhm * 1.4
 		self.radius = np.nanmedian(self.radii)
+		self._calc_fwhm()
+
+	def _calc_fwhm(self,length=15,step=1):
+		"""
+		Sub-pixel FWHM of every source from bilinearly sampled profiles along +-x
+		and +-y, with a robust (sigma clipped median) global FWHM.
+		"""
+		ny, nx = self.data.shape
+		xc = self.source_x - 0.5
+		yc = self.source_y - 0.5
+		r = np.arange(0,length,step)
+		directions = np.array([[1,0],[-1,0],[0,1],[0,-1]])
+		# sample positions, shape (source, direction, radius)
+		px = xc[:,np.newaxis,np.newaxis] + directions[np.newaxis,:,0,np.newaxis] * r
+		py = yc[:,np.newaxis,np.newaxis] + directions[np.newaxis,:,1,np.newaxis] * r
+		valid = (px >= 0) & (px <= nx - 1) & (py >= 0) & (py <= ny - 1)
+		px = np.clip(px,0,nx - 1)
+		py = np.clip(py,0,ny - 1)
+		x0 = np.minimum(px.astype(int),nx - 2)
+		y0 = np.minimum(py.astype(int),ny - 2)
+		fx = px - x0
+		fy = py - y0
+		profile = ((1 - fx) * (1 - fy) * self.data[y0,x0] + fx * (1 - fy) * self.data[y0,x0+1] +
+				   (1 - fx) * fy * self.data[y0+1,x0] + fx * fy * self.data[y0+1,x0+1])
+		profile = profile - self.data_median
+
+		with np.errstate(divide='ignore',invalid='ignore'):
+			normal = profile / profile[:,:,:1]
+		below = (normal < 0.5) & valid
+		found = below.any(axis=2) & (profile[:,:,0] > 0)
+		i = np.maximum(np.argmax(below,axis=2),1)
+		hi = np.take_along_axis(normal,(i-1)[...,np.newaxis],axis=2)[...,0]
+		lo = np.take_along_axis(normal,i[...,np.newaxis],axis=2)[...,0]
+		with np.errstate(divide='ignore',invalid='ignore'):
+			half = r[i-1] + step * (hi - 0.5) / (hi - lo)
+		half[~found] = np.nan
+
+		self.fwhms = 2 * np.nanmean(half,axis=1)
+		good = np.isfinite(self.fwhms)
+		if good.any():
+			self.fwhm = float(np.ma.median(sigma_clip(self.fwhms[good])))
+		else:
+			self.fwhm = np.nan
 
 
 	def _get_apertures(self):
@@ -225,15 +305,15 @@ class ap_photom():
 			self.cal_sys = 'skymapper'
 		else:
 			self.cal_sys = 'ps1'
-		fname = 'cal_files/MOA-{filt}_{sys}_{model}.npy'.format(filt=self.band,
-										sys=self.cal_sys,model=self.cal_model)
-		self.sauron = sauron(load_state = package_directory + fname)
+		self.sauron = models.get(self.band,self.cal_sys,self.cal_model)
 
 	def predict_mags(self):
 		ind = self.ap_photom['flag'].values == 0
 		ra, dec = self.wcs.all_pix2world(self.ap_photom['xcenter'].iloc[ind],self.ap_photom['ycenter'].iloc[ind],0)
 		if self.sauron is not None:
 			mags = self.sauron.estimate_mag(ra=ra,dec=dec,close=True)
+			# the model is shared between images, so keep this image's catalogue mags
+			self.cat_mags = getattr(self.sauron,'cat_mags',None)
 			self.pred_mag = np.ones(len(ind)) * np.nan
 			self.pred_mag[ind] = mags
 
@@ -254,26 +334,33 @@ class ap_photom():
 		self.good = ind
 
 	def calculate_zp(self,threshold=10):
-		self._load_image()
-		self._image_stats()
+		"""
+		Run the photometry pipeline. Stages whose outputs do not depend on the pixel
+		values are only run once, so after a rescale only the photometry and
+		zeropoint are redone.
+		"""
+		self._pass += 1
+		self._run_stage('load_image',self._load_image)
+		self._run_stage('image_stats',self._image_stats)
 		
 		if self.use_catalogue:
-			self.catalogue_sources()
-			self._calc_radii()
+			self._run_stage('catalogue_sources',self.catalogue_sources)
+			self._run_stage('calc_radii',self._calc_radii)
 		else:
 			self.radius = 3*1.2
 			for i in range(2):
-				self.find_sources(fwhm=self.radius/1.2,threshold=threshold)
-				self._calc_radii()
+				self._invalidate('find_sources','calc_radii')
+				self._run_stage('find_sources',self.find_sources,fwhm=self.radius/1.2,threshold=threshold)
+				self._run_stage('calc_radii',self._calc_radii)
 		#print(len(self.cat))
 		#print(len(self.sou))
-		self._get_apertures()
-		self.ap_photometry()
-		self._load_sauron()
-		self.predict_mags()
-		self.calc_zp(snr_lim=threshold)
+		self._run_stage('apertures',self._get_apertures)
+		self._run_stage('photometry',self.ap_photometry)
+		self._run_stage('load_sauron',self._load_sauron)
+		self._run_stage('predict_mags',self.predict_mags)
+		self._run_stage('calc_zp',self.calc_zp,snr_lim=threshold)
 
-		self.magnitude_limit(snr_lim=threshold)
+		self._run_stage('magnitude_limit',self.magnitude_limit,snr_lim=threshold)
 
 
 	def magnitude_limit(self,snr_lim=10):
@@ -295,27 +382,21 @@ class ap_photom():
 		#chi_squared = np.sum((np.polyval(pfit, mag[ind][sigclip]) - np.log10(sig_noise[ind][sigclip])) ** 2)
 
 		
-	def mag_limit_fig(self,ax):
+	def mag_limit_data(self):
+		"""
+		Magnitudes and signal to noise of the sources kept in the magnitude limit
+		fit, with the fitted model.
+		"""
 		sig_noise = self.ap_photom['snr'].values
 		mag = (self.ap_photom['sysmag'] + self.zps).values
 		ind = np.isfinite(mag) & np.isfinite(np.log10(sig_noise))
 		sigclip = ~sigma_clip(mag[ind] - self.fitted_line(sig_noise[ind])).mask
-		yz = np.linspace(1,10**5,295)
-
-		#ax.plot(mag[ind],np.log10(sig_noise[ind]),'.',alpha=0.5)
-		ax.plot(mag[ind][sigclip],np.log10(sig_noise[ind][sigclip]),'.',alpha=0.5)
-		ax.plot(self.fitted_line(yz),np.log10(yz),'-')
-
-		ax.axhline(np.log10(3),ls='-.',color='k')
-		ax.axhline(np.log10(5),ls='--',color='k')
-		ax.set_ylabel(r'log$_{10}$(SNR)')
-		ax.set_xlabel('Magnitude Limit')
+		return {'maglim_mag':mag[ind][sigclip],'maglim_snr':sig_noise[ind][sigclip],
+				'snr_model':np.array(self.snr_model)}
 
-		ax.text(19,2,r'$3\sigma=$ {:.2f}'.format(self.fitted_line(3)))
-		ax.text(19,2.5,r'$5\sigma=$ {:.2f}'.format(self.fitted_line(5)))
-	 	
-		ax.set_ylim(0,3)
-		ax.set_xlim(13,21)
+	def mag_limit_fig(self,ax):
+		data = self.mag_limit_data()
+		plot_mag_limit(ax,data['maglim_mag'],data['maglim_snr'],data['snr_model'])
 
 
 	def _maglim_minimizer(self,var,snr,mag):
@@ -327,14 +408,19 @@ class ap_photom():
 	def fitted_line(self, sn):
 		return self.snr_model[1] + self.snr_model[0] * np.log10(sn)
 
+	def _get_mask_index(self,buffer=0):
+		"""
+		Spatial index of the masked pixels, built once per image and buffer size.
+		"""
+		if buffer not in self._mask_indexes:
+			self._mask_indexes[buffer] = mask_index(self.mask,buffer=buffer)
+		return self._mask_indexes[buffer]
+
 	def _mask_killer(self,buffer=5):
 		if self.mask is not None:
-			mask = convolve(self.mask,np.ones((buffer,buffer)))
-			x,y = np.where(mask > 0)
 			sx = self.sources['xcentroid'].values
 			sy = self.sources['ycentroid'].values
-			d = np.sqrt((sx[:,np.newaxis] - x[np.newaxis,])**2 + (sy[:,np.newaxis] - y[np.newaxis,])**2)
-			mind = np.nanmin(d,axis=1)
+			mind = self._get_mask_index(buffer).nearest(sx,sy)
 			ind = mind > 1
 			#print(f'Killed {len(sx) - np.sum(ind*1)} sources')
 			self.sources = self.sources.iloc[ind]
@@ -344,21 +430,11 @@ class ap_photom():
 
 	def _check_mask(self):
 		if self.mask is not None:
-			flags = np.where(self.mask > 0)
-			bx = flags[1]
-			by = flags[0]
-
 			sx = self.ap_photom['xcenter'].values
 			sy = self.ap_photom['ycenter'].values
 			r = self.radii 
-
-			x = (sx[:,np.newaxis] - bx[np.newaxis,:])
-			y = (sy[:,np.newaxis] - by[np.newaxis,:])
-
-			d2 = x**2 + y**2
-
-			near = d2 < r[:,np.newaxis]
-			near = np.nansum(near,axis=1)
+			# matches the old d**2 < r selection
+			near = self._get_mask_index().count_within(sx,sy,np.sqrt(r))
 		else:
 			near = self.radii * 0
 		return near.astype(int)
@@ -368,16 +444,7 @@ class ap_photom():
 		sx = self.ap_photom['xcenter'].values
 		sy = self.ap_photom['ycenter'].values
 
-		x = sx[:,np.newaxis] - sx[np.newaxis,:]
-		y = sy[:,np.newaxis] - sy[np.newaxis,:]
-
-		d2 = x**2 + y**2
-		d2[d2==0] = np.nan
-
-		mins = np.nanmin(d2,axis=1)
-		mins = mins < limit**2
-
-		return mins
+		return close_neighbours(sx,sy,limit)
 
 	def _basic_source_mask(self,buffer=0.04):
 		"""
@@ -398,32 +465,9 @@ class ap_photom():
 		x_data = (self.ap_photom['xcenter'].values[ind] + 0.5).astype(int)
 		y_data = (self.ap_photom['ycenter'].values[ind] + 0.5).astype(int)
 		z_data = self.zps[ind]
-		
-		zpimage = np.zeros_like(self.data)
-		zpimage[y_data,x_data] = z_data
-		zpimage[zpimage==0] = np.nan
-		#zpimage[cut.mask] = np.nan
-
-		x = np.arange(0, zpimage.shape[1])
-		y = np.arange(0, zpimage.shape[0])
-		arr = np.ma.masked_invalid(zpimage)
-		xx, yy = np.meshgrid(x, y)
-		#get only the valid values
-		x1 = xx[~arr.mask]
-		y1 = yy[~arr.mask]
-		newarr = arr[~arr.mask]
-
-		estimate = griddata((x1, y1), newarr.ravel(),
-									(xx, yy),method='linear')
-		bitmask = np.zeros_like(zpimage,dtype=int)
-		bitmask[np.isnan(estimate)] = 128 | 4
-		nearest = griddata((x1, y1), newarr.ravel(),
-									(xx, yy),method='nearest')
-
-		estimate[np.isnan(estimate)] = nearest[np.isnan(estimate)]
-
-		estimate = gaussian_filter(estimate,smoother)
 
+		estimate, bitmask = fit_surface(x_data,y_data,z_data,self.data.shape,smoother=smoother,
+										method=self.surface_method,bin_size=self.surface_bin)
 		return estimate, bitmask
 
 	def Recast_image_scale(self,newzp=25):
@@ -435,19 +479,26 @@ class ap_photom():
 		else:
 			new_image = ((self.data - np.nanmedian(self.data)) * 10**((self.zp_surface - newzp) / -2.5)) + np.nanmedian(self.data)
 		self.data = new_image
+		# the catalogue positions, radii and predicted mags are unchanged by the rescale
+		self._invalidate('photometry','calc_zp','magnitude_limit')
+		if not self.use_catalogue:
+			self._invalidate('image_stats','find_sources','calc_radii','apertures',
+							 'predict_mags')
 
 
 	def ZP_correction(self,sigma=2):
 		"""
 		Correct the zeropoint for the residual background varibility.
 		"""
-		tmp,_ = self.Fit_surface(mask=None,smoother=200)
 		x_data = (self.ap_photom['xcenter'].values + 0.5).astype(int)
 		y_data = (self.ap_photom['ycenter'].values + 0.5).astype(int)
-		diff = (self.zps - tmp[y_data.astype(int),x_data.astype(int)])
-		cut = ~sigma_clip(diff,sigma=sigma).mask
-		estimate,bitmask = self.Fit_surface(mask=cut,smoother=30)
+		estimate,bitmask,cut = zp_correction_surface(x_data,y_data,self.zps,self.data.shape,sigma=sigma,
+													 method=self.surface_method,bin_size=self.surface_bin)
 		self.zp_surface = estimate
+		# the points the surface was fit to, self.zps is replaced by the rescaled pass
+		self.surface_x = x_data
+		self.surface_y = y_data
+		self.surface_zps = self.zps.copy()
 
 		
 
@@ -0,0 +1,170 @@
+import os
+import gzip
+import json
+import time
+import numpy as np
+from astropy.io import fits
+
+package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+
+def _open(file):
+	"""
+	Open a (possibly gzipped) fits file as a plain byte stream.
+	"""
+	f = open(file,'rb')
+	magic = f.read(2)
+	f.seek(0)
+	if magic == b'\x1f\x8b':
+		return gzip.GzipFile(fileobj=f,mode='rb')
+	return f
+
+def read_header(file):
+	"""
+	Read only the primary header. For gzipped files this stops decompressing at
+	the end of the header instead of inflating the whole file.
+	"""
+	with _open(file) as f:
+		return fits.Header.fromfile(f)
+
+def read_header_sample(file,step=8,block=256):
+	"""
+	Read the primary header and a subsampled (every step-th row and column) copy
+	of the primary image in a single sequential pass over the file.
+
+	--------
+	Outputs-
+	--------
+		header 	Header 	primary header
+		sample 	array 	image[::step,::step] with BSCALE/BZERO applied
+	"""
+	with _open(file) as f:
+		header = fits.Header.fromfile(f)
+		ny, nx = header['NAXIS2'], header['NAXIS1']
+		bitpix = header['BITPIX']
+		kind = 'i' if bitpix > 0 else 'f'
+		dtype = np.dtype('>{}{}'.format(kind,abs(bitpix) // 8))
+		row_bytes = nx * dtype.itemsize
+		parts = []
+		for start in range(0,ny,block):
+			n = min(block,ny - start)
+			buf = f.read(n * row_bytes)
+			rows = np.frombuffer(buf,dtype).reshape(n,nx)
+			# keep the global row phase when the block is not a multiple of step
+			parts += [rows[(-start) % step::step,::step]]
+	raw = np.concatenate(parts)
+	sample = raw.astype(float) * header.get('BSCALE',1) + header.get('BZERO',0)
+	if ('BLANK' in header) & (bitpix > 0):
+		sample[raw == header['BLANK']] = np.nan
+	return header, sample
+
+
+class archive_index():
+	"""
+	Persistent record of the files found in an archive directory (and its year sub
+	directories), with the (size, mtime) of every file. Directories whose mtime
+	has not changed since the last scan are not listed again, as files are only
+	ever added to or removed from the archive, never rewritten in place.
+
+	-------
+	Inputs-
+	-------
+		root 		str 	archive directory
+		name 		str 	name of the index file in cal_lists/
+		suffix 		str 	only files ending with this are indexed
+	"""
+	def __init__(self,root,name,suffix='.gz',index_dir=package_directory + 'cal_lists/'):
+		self.root = root
+		self.suffix = suffix
+		self.file = os.path.join(index_dir,'{}_index.json'.format(name))
+		# directory -> {'mtime':mtime, 'files':{name:(size, mtime)}}
+		self.dirs = {}
+		self._load()
+
+	def _load(self):
+		if os.path.isfile(self.file):
+			with open(self.file) as f:
+				index = json.load(f)
+			if index.get('root') == self.root:
+				self.dirs = index['dirs']
+
+	def save(self):
+		tmp = self.file + '.{}.tmp'.format(os.getpid())
+		with open(tmp,'w') as f:
+			json.dump({'root':self.root,'dirs':self.dirs},f)
+		os.replace(tmp,self.file)
+
+	def _directories(self):
+		dirs = [self.root]
+		with os.scandir(self.root) as it:
+			for entry in it:
+				if entry.is_dir():
+					dirs += [entry.path]
+		return dirs
+
+	def _list(self,d):
+		files = {}
+		with os.scandir(d) as it:
+			for entry in it:
+				if entry.is_file() and entry.name.endswith(self.suffix):
+					stat = entry.stat()
+					files[entry.name] = [stat.st_size,stat.st_mtime]
+		return files
+
+	def scan(self,verbose=False):
+		"""
+		Find the files that are new or changed since the last scan. The index is
+		updated in memory, call save once the files have been processed.
+
+		--------
+		Outputs-
+		--------
+			changed 	list 	new or modified files
+			removed 	list 	files no longer in the archive
+		"""
+		t = time.time()
+		changed = []
+		removed = []
+		skipped = 0
+		dirs = self._directories()
+		for d in dirs:
+			mtime = os.stat(d).st_mtime
+			old = self.dirs.get(d,{'mtime':None,'files':{}})
+			if old['mtime'] == mtime:
+				skipped += 1
+				continue
+			files = self._list(d)
+			changed += [os.path.join(d,f) for f in files if old['files'].get(f) != files[f]]
+			removed += [os.path.join(d,f) for f in old['files'] if f not in files]
+			self.dirs[d] = {'mtime':mtime,'files':files}
+		for d in [d for d in self.dirs if d not in dirs]:
+			removed += [os.path.join(d,f) for f in self.dirs.pop(d)['files']]
+		if verbose:
+			print('Scanned {}: {} changed, {} removed, {} unchanged directories skipped ({:.1f} s)'.format(
+				  self.root,len(changed),len(removed),skipped,time.time() - t))
+		return changed, removed
+
+	def files(self):
+		"""
+		All files currently in the index.
+		"""
+		return [os.path.join(d,f) for d in self.dirs for f in self.dirs[d]['files']]
+
+	def forget(self,files):
+		"""
+		Drop files from the index so the next scan picks them up again (e.g. after
+		they failed to process).
+		"""
+		for file in files:
+			d, name = os.path.split(file)
+			if d in self.dirs:
+				self.dirs[d]['files'].pop(name,None)
+				self.dirs[d]['mtime'] = None
+
+
+def report_rate(label,n,start):
+	"""
+	Print the number of files processed per second since start.
+	"""
+	dt = max(time.time() - start,1e-9)
+	print('{}: {} files in {:.1f} s ({:.1f} files/s)'.format(label,n,dt,n / dt))
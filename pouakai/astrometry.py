@@ -0,0 +1,59 @@
+import os
+import subprocess
+import numpy as np
+from astropy.io import fits
+from aperture_photom import ap_photom
+
+
+def image_sources(image,header=None,fwhm=5,threshold=10,nstars=300):
+	"""
+	Find the brightest point sources in an image with the ap_photom star finder.
+	Positions are 0-indexed pixel coordinates, sorted from brightest to faintest.
+	"""
+	phot = ap_photom(data=image,header=header,run=False)
+	phot._image_stats()
+	phot.find_sources(fwhm=fwhm,threshold=threshold)
+	sources = phot.sources.sort_values('flux',ascending=False).iloc[:nstars]
+	return sources['xcentroid'].values, sources['ycentroid'].values, sources['flux'].values
+
+def write_xylist(name,x,y,flux):
+	"""
+	Save a source list in the astrometry.net xylist format (1-indexed pixels).
+	"""
+	cols = [fits.Column(name='X',format='E',array=np.asarray(x) + 1),
+			fits.Column(name='Y',format='E',array=np.asarray(y) + 1),
+			fits.Column(name='FLUX',format='E',array=np.asarray(flux))]
+	hdu = fits.BinTableHDU.from_columns(cols)
+	hdu.writeto(name,overwrite=True)
+
+def solve_xylist(xylist,width,height,ra,dec,radius=2,timeout=None):
+	"""
+	Solve a source list with the local astrometry.net solve-field. Only the .wcs
+	header is written and read back, no image is copied.
+	"""
+	base = xylist.split('.fits')[0]
+	astrom_call = ('solve-field --no-plots -O -p --width {width} --height {height} '
+				   '--x-column X --y-column Y --sort-column FLUX '
+				   '--ra {ra} --dec {dec} --radius {radius} '
+				   '--new-fits none --corr none --rdls none --match none --solved none '
+				   '--index-xyls none --wcs {base}.wcs {file}')
+	solver = astrom_call.format(width=width,height=height,ra=ra,dec=dec,radius=radius,
+								base=base,file=xylist)
+	subprocess.run(solver,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True,timeout=timeout)
+	wcs_name = base + '.wcs'
+	if not os.path.isfile(wcs_name):
+		raise ValueError('solve-field could not solve {}'.format(xylist))
+	return fits.getheader(wcs_name)
+
+def update_header(header,wcs_header):
+	"""
+	Copy the solution cards from a solve-field header into the image header,
+	leaving out all the astrometry.net junk.
+	"""
+	skip = ['SIMPLE','BITPIX','NAXIS','EXTEND','COMMENT','HISTORY','']
+	new_head = header.copy()
+	for card in wcs_header.cards:
+		if card.keyword in skip:
+			continue
+		new_head[card.keyword] = (card.value,card.comment)
+	return new_head
@@ -0,0 +1,151 @@
+import gc
+import numpy as np
+from scipy.ndimage import binary_dilation
+
+from core import pouakai
+
+
+def stack_frames(raw):
+	"""
+	Copy raw frames into one (N, ny, nx) array of their common dtype.
+	"""
+	dtype = np.result_type(*[frame.dtype for frame in raw])
+	raw_stack = np.empty((len(raw),) + raw[0].shape,dtype=dtype)
+	for i in range(len(raw)):
+		raw_stack[i] = raw[i]
+	return raw_stack
+
+def flatten_stack(raw_stack,dark,norm_flat):
+	"""
+	Dark subtract and flat field the whole stack in one float32 buffer. The ufuncs
+	broadcast the masters over the stack with the same loop and cast as
+	pouakai.reduce_image, so each frame matches the single frame reduction.
+	"""
+	stack = np.empty(raw_stack.shape,dtype=np.float32)
+	np.subtract(raw_stack,dark,out=stack,casting='unsafe')
+	np.divide(stack,norm_flat,out=stack)
+	return stack
+
+def saturation_stack(raw_stack,satlimit=3.5e4,buffer=3):
+	"""
+	Dilated saturation mask of every frame, the dilation doesn't cross frames.
+	"""
+	return binary_dilation(raw_stack > satlimit,structure=np.ones((1,buffer,buffer),dtype=bool))
+
+def subtract_background(stack,offset=500):
+	"""
+	Set the median of each frame to offset, in place.
+	"""
+	# median frame by frame, a median over the reshaped stack would copy all of it
+	bkg = np.array([np.nanmedian(frame) for frame in stack])
+	stack -= (bkg - offset)[:,np.newaxis,np.newaxis]
+	return bkg
+
+def calibrate_stack(raw,dark,norm_flat,offset=500,satlimit=3.5e4,buffer=3):
+	"""
+	Dark subtract, flat field and background subtract a stack of frames that share
+	the same masters, as array operations over the (N, ny, nx) stack.
+
+	-------
+	Inputs-
+	-------
+		raw 		array 	raw frames (N, ny, nx), or a list of (ny, nx) frames
+		dark 		array 	master dark
+		norm_flat 	array 	median normalised master flat
+		offset 		float 	level the background is set to
+		satlimit 	float 	raw counts above which pixels are flagged as saturated
+		buffer 		int 	size of the saturation mask dilation
+
+	--------
+	Outputs-
+	--------
+		stack 		array 	calibrated float32 frames
+		saturation 	array 	saturation mask of each frame
+		bkg 		array 	background subtracted from each frame
+	"""
+	if not isinstance(raw,np.ndarray):
+		raw = stack_frames(raw)
+	saturation = saturation_stack(raw,satlimit,buffer)
+	stack = flatten_stack(raw,dark,norm_flat)
+	bkg = subtract_background(stack,offset)
+	return stack, saturation, bkg
+
+
+def reduce_batch(files,batch_size=16,verbose=True,**options):
+	"""
+	Reduce frames that share calibrations as a batch. The frames are grouped by
+	their master dark and flat, the raw frames of each group are copied into one
+	stack and the dark subtraction, flat fielding and saturation masks are done
+	over the whole stack. Only the background median, astrometry, satellite
+	search and photometry are run frame by frame.
+
+	-------
+	Inputs-
+	-------
+		files 		list 	raw frames to reduce
+		batch_size 	int 	most frames held in memory at once
+		options 	kwargs 	passed to pouakai for every frame
+
+	--------
+	Outputs-
+	--------
+		results 	list 	(file, error) with error None on success
+	"""
+	results = []
+	for start in range(0,len(files),batch_size):
+		frames = []
+		for file in files[start:start + batch_size]:
+			try:
+				frames += [pouakai(file,verbose=verbose,run=False,**options)]
+			except Exception as e:
+				results += [(file,str(e))]
+
+		groups = {}
+		for p in frames:
+			groups.setdefault((p.dark_file,p.flat_file),[]).append(p)
+		del frames
+
+		for group in groups.values():
+			if verbose:
+				print('Calibrating {} frames with {} and {}'.format(len(group),group[0].dark_file,group[0].flat_file))
+			results += _reduce_group(group)
+		del groups
+		gc.collect()
+	return results
+
+def _reduce_group(group):
+	results = []
+	p = group[0]
+	dtype = np.result_type(*[g.raw_image.dtype for g in group])
+	raw = np.empty((len(group),) + p.raw_image.shape,dtype=dtype)
+	for i, g in enumerate(group):
+		g._add_image(g.raw_image,'raw')
+		raw[i] = g.raw_image
+		# the stack holds the only copy of each raw frame from here
+		g.raw_image = None
+	saturation = saturation_stack(raw)
+	stack = flatten_stack(raw,p.dark,p.norm_flat)
+	del raw
+	# thumbnails of the flattened frames before the background step, as reduce_image
+	for g, frame in zip(group,stack):
+		g._add_image(g.flat,'flat')
+		g._add_image(frame,'reduced')
+	subtract_background(stack,p.offset)
+
+	for i in range(len(group)):
+		p = group[i]
+		try:
+			if np.nansum(stack[i]) == 0:
+				raise ValueError('Image is all NaNs')
+			p.image = stack[i]
+			p.premasks = {'saturation':saturation[i]}
+			p.finish_reduction()
+			results += [(p.file,None)]
+		except Exception as e:
+			if p.verbose:
+				print('Failed: ' + p.file)
+				print(e)
+			results += [(p.file,str(e))]
+		# release the frame before moving on to the next
+		group[i] = None
+	return results
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+from cal_store import read_list, list_stamp
+
+
+class calibration_index():
+	"""
+	Index of a master calibration list, partitioned on the given columns with
+	each partition sorted by JD so the nearest master is a binary search.
+	"""
+	def __init__(self,name,partition,cal_dir='cal_lists/'):
+		self.name = name
+		self.cal_dir = cal_dir
+		self.partition = list(partition)
+		self.stamp = list_stamp(name,cal_dir)
+		self._build()
+
+	def _build(self):
+		masters = read_list(self.name,columns=self.partition + ['jd','filename'],cal_dir=self.cal_dir)
+		masters = masters.iloc[np.isfinite(masters['jd'].values)]
+		self.partitions = {}
+		for key, group in masters.groupby(self.partition,sort=False):
+			if not isinstance(key,tuple):
+				key = (key,)
+			jd = group['jd'].values.astype(float)
+			order = np.argsort(jd,kind='stable')
+			self.partitions[key] = (jd[order], group['filename'].values[order])
+
+	def keys(self):
+		return list(self.partitions.keys())
+
+	def nearest(self,key,jd):
+		"""
+		Return the filename and absolute time difference of the master in the
+		partition closest in time to jd, or (None, inf) for an empty partition.
+		"""
+		if key not in self.partitions:
+			return None, np.inf
+		jds, files = self.partitions[key]
+		i = np.searchsorted(jds,jd)
+		candidates = [c for c in (i - 1, i) if 0 <= c < len(jds)]
+		best = min(candidates, key=lambda c: abs(jds[c] - jd))
+		return files[best], abs(jds[best] - jd)
+
+	def is_stale(self):
+		return list_stamp(self.name,self.cal_dir) != self.stamp
+
+
+partitions = {'flat':['chip','band','flat_type','note'],
+			  'dark':['chip','exptime']}
+
+_indexes = {}
+
+def get_index(cal_type,cal_dir='cal_lists/'):
+	"""
+	Load the index for the master list of cal_type once per process, rebuilding it
+	when the list changes on disk.
+	"""
+	cal_type = cal_type.lower()
+	if cal_type not in partitions:
+		raise ValueError('Only flat and dark are valid options!!')
+	name = 'master_{}_list'.format(cal_type)
+	key = (os.path.abspath(cal_dir),name)
+	index = _indexes.get(key)
+	if (index is None) or index.is_stale():
+		index = calibration_index(name,partitions[cal_type],cal_dir)
+		_indexes[key] = index
+	return index
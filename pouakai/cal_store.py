@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pandas as pd
+
+try:
+	import pyarrow.parquet as pq
+	has_parquet = True
+except ImportError:
+	has_parquet = False
+
+
+# flag bits
+FLAG_OK = 0
+FLAG_BAD_HEADER = 1
+
+# sentinel for missing integer values, floats use NaN and strings ''
+INT_SENTINEL = -1
+
+_raw = {'name':'str','chip':'int','exptime':'float','jd':'float','date':'str'}
+
+schemas = {'dark_list':dict(_raw,filename='str',note='str',flag='int'),
+		   'flat_list':dict(_raw,band='str',field='str',filename='str',note='str',flag='int'),
+		   'obs_list':dict(_raw,field='str',band='str',ra='str',dec='str',moon_sep='float',
+						   sky='float',filename='str',flag='int'),
+		   'master_dark_list':dict(_raw,filename='str',note='str',nimages='int',flag='int'),
+		   'master_flat_list':dict(_raw,band='str',field='str',filename='str',dark_file='str',
+								   time_diff='float',nimages='int',flat_type='str',note='str',
+								   flag='int')}
+
+
+def _path(name,cal_dir,fmt):
+	return os.path.join(cal_dir,'{}.{}'.format(name,fmt))
+
+def _format(name,cal_dir):
+	"""
+	Backend a list is read from: parquet if it has been written, otherwise csv.
+	"""
+	if os.path.isfile(_path(name,cal_dir,'parquet')):
+		if not has_parquet:
+			raise ValueError('{} is stored as parquet, pyarrow is needed to read it'.format(name))
+		return 'parquet'
+	return 'csv'
+
+def coerce(df,name):
+	"""
+	Cast the columns of a list to its schema. Values that can't be parsed (e.g. the
+	'bad' entries of unreadable headers) become the sentinel and set FLAG_BAD_HEADER.
+	"""
+	schema = schemas[name]
+	df = df.copy()
+	if 'flag' in df.columns:
+		flag = pd.to_numeric(df['flag'],errors='coerce').fillna(FLAG_OK).values.astype(np.int16)
+	else:
+		flag = np.zeros(len(df),dtype=np.int16)
+	for col in df.columns:
+		if (col not in schema) | (col == 'flag'):
+			continue
+		kind = schema[col]
+		if kind == 'str':
+			df[col] = df[col].fillna('').astype(str).str.strip()
+			continue
+		values = pd.to_numeric(df[col],errors='coerce')
+		given = df[col].notna().values & (df[col].astype(str).str.strip().values != '')
+		flag[values.isna().values & given] |= FLAG_BAD_HEADER
+		if kind == 'int':
+			df[col] = values.fillna(INT_SENTINEL).astype(np.int64)
+		else:
+			df[col] = values.astype(float)
+	if 'flag' in schema:
+		df['flag'] = flag
+	return df
+
+def _empty(name,columns=None):
+	schema = schemas[name]
+	dtypes = {'str':object,'int':np.int64,'float':float}
+	cols = [c for c in schema if (columns is None) or (c in columns)]
+	return pd.DataFrame({c:pd.Series(dtype=dtypes[schema[c]]) for c in cols})
+
+def read_list(name,columns=None,cal_dir='cal_lists/'):
+	"""
+	Read a calibration or observation list with typed columns.
+
+	-------
+	Inputs-
+	-------
+		name 		str 	list name, e.g. 'master_dark_list'
+		columns 	list 	only read these columns
+		cal_dir 	str 	directory holding the lists
+	"""
+	fmt = _format(name,cal_dir)
+	path = _path(name,cal_dir,fmt)
+	if not os.path.isfile(path):
+		return _empty(name,columns)
+	if fmt == 'parquet':
+		if columns is not None:
+			available = set(pq.read_schema(path).names)
+			df = pd.read_parquet(path,columns=[c for c in columns if c in available])
+		else:
+			df = pd.read_parquet(path)
+	else:
+		usecols = None if columns is None else (lambda c: c in columns)
+		df = pd.read_csv(path,usecols=usecols)
+	df = coerce(df,name)
+	if columns is not None:
+		for col in columns:
+			if col not in df.columns:
+				df[col] = _empty(name,[col])[col].reindex(df.index)
+		df = df[list(columns)]
+	return df
+
+def write_list(df,name,cal_dir='cal_lists/'):
+	"""
+	Write a list atomically, as parquet when pyarrow is available.
+	"""
+	df = coerce(df,name)
+	fmt = 'parquet' if has_parquet else 'csv'
+	path = _path(name,cal_dir,fmt)
+	tmp = path + '.{}.tmp'.format(os.getpid())
+	if fmt == 'parquet':
+		df.to_parquet(tmp,index=False)
+	else:
+		df.to_csv(tmp,index=False)
+	os.replace(tmp,path)
+	return path
+
+def list_stamp(name,cal_dir='cal_lists/'):
+	"""
+	(mtime, size) of the stored list, used to notice it changing on disk.
+	"""
+	path = _path(name,cal_dir,_format(name,cal_dir))
+	if not os.path.isfile(path):
+		return None
+	stat = os.stat(path)
+	return (stat.st_mtime,stat.st_size)
+
+def migrate(cal_dir='cal_lists/'):
+	"""
+	One off conversion of the csv lists to the typed store ('bad' strings become
+	sentinels with FLAG_BAD_HEADER set). The csv files are left in place.
+	"""
+	done = []
+	for name in schemas:
+		csv = _path(name,cal_dir,'csv')
+		if os.path.isfile(csv):
+			write_list(pd.read_csv(csv),name,cal_dir)
+			done += [name]
+	return done
+
+
+if __name__ == '__main__':
+	print('Migrated', migrate())
@@ -0,0 +1,115 @@
+import os
+import json
+import pandas as pd
+from cal_store import read_list, write_list
+
+def _json_value(value):
+	if hasattr(value,'item'):
+		return value.item()
+	return str(value)
+
+
+class cal_list_writer():
+	"""
+	Collect new rows for one of the calibration lists and write them in a single
+	batch. Rows are kept in per column buffers and each row is also appended to a
+	journal next to the list as it is added, so rows from a run that dies before
+	commit are merged into the list when the next writer for it is created.
+
+	-------
+	Inputs-
+	-------
+		name 	str 	list name in cal_store, e.g. 'master_dark_list'
+		key 	str 	column identifying a row, new rows replace existing rows
+						with the same key
+		cal_dir str 	directory holding the lists
+	"""
+	def __init__(self,name,key='name',cal_dir='cal_lists/'):
+		self.name = name
+		self.key = key
+		self.cal_dir = cal_dir
+		self.journal = os.path.join(cal_dir,name + '.journal')
+		self._reset()
+		self.recovered = self._recover()
+
+	def _reset(self):
+		self.columns = {}
+		self.nrows = 0
+
+	def _recover(self):
+		"""
+		Merge rows left in the journal by an interrupted run into the list.
+		"""
+		if not os.path.isfile(self.journal):
+			return 0
+		with open(self.journal) as f:
+			rows = [json.loads(line) for line in f if line.strip() != '']
+		for row in rows:
+			self._buffer(row)
+		n = self.nrows
+		self.commit()
+		return n
+
+	def _buffer(self,entry):
+		for col in entry:
+			if col not in self.columns:
+				self.columns[col] = [None] * self.nrows
+			self.columns[col].append(entry[col])
+		self.nrows += 1
+		for col in self.columns:
+			if len(self.columns[col]) < self.nrows:
+				self.columns[col].append(None)
+
+	def add(self,entry):
+		"""
+		Add a row (dict) or the rows of a DataFrame.
+		"""
+		if isinstance(entry,pd.DataFrame):
+			rows = entry.to_dict('records')
+		elif entry is None or len(entry) == 0:
+			rows = []
+		else:
+			rows = [entry]
+		with open(self.journal,'a') as f:
+			for row in rows:
+				f.write(json.dumps(row,default=_json_value) + '\n')
+			f.flush()
+		for row in rows:
+			self._buffer(row)
+
+	def extend(self,entries):
+		for entry in entries:
+			self.add(entry)
+
+	def frame(self):
+		"""
+		The buffered rows as a DataFrame.
+		"""
+		return pd.DataFrame(self.columns)
+
+	def commit(self,base=None):
+		"""
+		Write the existing list (or base, if given) plus the buffered rows in one
+		go and clear the journal.
+
+		--------
+		Outputs-
+		--------
+			df 	DataFrame 	the list as written
+		"""
+		if base is None:
+			base = read_list(self.name,cal_dir=self.cal_dir)
+		new = self.frame()
+		if self.nrows > 0:
+			if (self.key is not None) & (self.key in new.columns):
+				new = new.drop_duplicates(subset=[self.key],keep='last')
+				if self.key in base.columns:
+					base = base.iloc[~base[self.key].isin(new[self.key]).values]
+			df = pd.concat([base,new],ignore_index=True)
+		else:
+			df = base
+		write_list(df,self.name,self.cal_dir)
+		if os.path.isfile(self.journal):
+			os.remove(self.journal)
+		self._reset()
+		return df
@@ -5,135 +5,213 @@ from glob import glob
 import os
 from copy import deepcopy
 from joblib import Parallel, delayed
+from stacking import stack_frames
+from fits_writer import write_fits
+from cal_writer import cal_list_writer
+from cal_store import read_list, list_stamp, FLAG_OK
+from master_cache import get_master_frames
+from manifest import work_manifest, run_unit
 
 def split_names(files):
 	names = [x.split('-')[0] for x in files]
 	return names
 
 
-def make_master_darks(save_location = '/home/phys/astronomy/rri38/moa/data/master/dark/',num_cores=25,verbose=False):
+def build_units(manifest,units,func,writer,num_cores=25,retry_failed=False,verbose=False):
+	"""
+	Build the units of work that are not yet done, recording each unit's state in
+	the manifest and journaling each new master list entry as soon as it is made.
+
+	-------
+	Inputs-
+	-------
+		manifest 		work_manifest 	state of every unit
+		units 			dict 	key -> arguments of func for that unit
+		func 			func 	builds one master and returns its list entry
+		writer 			cal_list_writer 	list the entries go to
+		retry_failed 	bool 	also re-run units that failed before
+	"""
+	manifest.add(units.keys())
+	for key in units:
+		# done but not in the list, e.g. removed to be rebuilt
+		if manifest.state(key) == 'done':
+			manifest.set(key,'pending')
+	todo = [k for k in manifest.todo(retry_failed) if k in units]
+	if verbose:
+		print('Building {} of {} units'.format(len(todo),len(units)))
+
+	def tasks():
+		for key in todo:
+			manifest.set(key,'running')
+			yield delayed(run_unit)(func,key,*units[key])
+
+	if (num_cores > 1) & (len(todo) > 1):
+		results = Parallel(n_jobs=num_cores,return_as='generator_unordered')(tasks())
+	else:
+		results = (task[0](*task[1],**task[2]) for task in tasks())
+	for key, entry, error in results:
+		if error is None:
+			writer.add(entry)
+			manifest.set(key,'done')
+		else:
+			manifest.set(key,'failed',error)
+			print('Failed ',key,': ',error)
+	writer.commit()
+	manifest.compact()
+	if verbose:
+		print(manifest.summary())
+	return manifest
+
+def make_master_darks(save_location = '/home/phys/astronomy/rri38/moa/data/master/dark/',num_cores=25,verbose=False,memory_budget=1024**3,
+					  retry_failed=False):
 	# make save_location an environment variable
-	dark_list = pd.read_csv('cal_lists/dark_list.csv')
-	ind = dark_list['chip'].values != 'bad'
+	dark_list = read_list('dark_list',columns=['name','chip','jd','filename','flag'])
+	ind = dark_list['flag'].values == FLAG_OK
 	dark_list = dark_list[ind]
-	masters = pd.read_csv('cal_lists/master_dark_list.csv')
-	names = split_names(dark_list['name'].values)
-	all_names = set(names)
-	master_names = set(split_names(masters['name'].values))
+	writer = cal_list_writer('master_dark_list')
+	masters = read_list('master_dark_list',columns=['name','chip'])
+	# a unit is the master of one chip for a set of darks
+	dark_list['set'] = split_names(dark_list['name'].values)
+	done = set(zip(split_names(masters['name'].values),masters['chip'].values))
+	units = {}
+	for (n, j), chip in dark_list.groupby(['set','chip'],sort=False):
+		if (1 <= j <= 10) & ((n,j) not in done):
+			units[(n,int(j))] = (chip['filename'].values,chip['jd'].values,save_location,verbose,memory_budget)
+	units = dict(sorted(units.items(),reverse=True))
+	manifest = work_manifest('master_dark')
+	build_units(manifest,units,dark_processing,writer,num_cores,retry_failed,verbose)
+
+def dark_processing(chip_files,jds,save_location,verbose,memory_budget=1024**3):
+	"""
+	Median combine the darks of one chip into a master and return its list entry.
+	"""
+	entry = {}
+	m, std = stack_frames(chip_files,_read_frame,combine=('median','std'),
+						  memory_budget=memory_budget)
+	file = chip_files[-1]
+	header = fits.getheader(file)
+	nimages = len(chip_files)
+	#print('made array')
+	if verbose:
+		print('Used ',nimages,' images in median')
+	time = np.nanmean(jds.astype(float))
+	#print('calc mean')
+	header['JDSTART'] = time 
+	header['MASTER'] = True
+	phdu = fits.PrimaryHDU(data = m, header = header)
+	ehdu = fits.ImageHDU(data = std, header = header)
+	hdul = fits.HDUList([phdu, ehdu])
 
-	new = all_names - master_names
-	new = list(new)
-	new.sort(reverse=True)
-	print('sorted')
-	indexer = np.arange(len(new),dtype=int)
-	if num_cores > 1:
-		entries = Parallel(n_jobs=num_cores)(delayed(dark_processing)(index,new,names,dark_list,save_location,verbose) for index in indexer)
+
+	letter = file.split('-')[2]
+	base_name = file.split('/')[-1].split('.')[0].replace(letter,'m')
+	save_name = save_location + base_name + '.fits'
+	print('saving')
+	write_fits(hdul,save_name)
+	print('saved')
+	entry['name'] = base_name
+
+	entry['chip'] = header['CHIP']
+	entry['exptime'] = header['EXPTIME']
+	entry['jd'] = time
+	entry['date'] = header['DATE-OBS']
+	entry['nimages'] = nimages
+	entry['filename'] = save_name + '.gz'
+	if nimages < 3:
+		note = 'bad'
 	else:
-		entries = []
-		for index in indexer:
-			entries += [dark_processing(index,new,names,dark_list,save_location,verbose)]
-			print('!!! ', entries)
-	for entry in entries:
-		masters = masters.append(entry,ignore_index=True)
-	masters.to_csv('cal_lists/master_dark_list.csv',index=False)
-
-def dark_processing(index,new,names,dark_list,save_location,verbose):
-	entries = {}
-	n = new[index]
-	ind = np.array(names) == n
-	all_chips = dark_list.iloc[ind]
-	#print(all_chips)
-	for j in range(10):
-		try:
-			j += 1
-			entry = {}
-			chip_ind = all_chips['chip'].values.astype(int) == j
-			chip = all_chips.iloc[chip_ind]
-			chip_files = chip['filename'].values
-			master = []
-			for file in chip_files:
-				hdu = fits.open(file)[0]
-				header = hdu.header
-				data = hdu.data
-				master += [data]
-			master = np.array(master)
-			#print('made array')
-			if verbose:
-				print('Used ',len(master),' images in median')
-			m = np.nanmedian(master,axis=0)
-			std = np.nanstd(master,axis=0)
-			time = np.nanmean(chip['jd'].astype(float))
-			#print('calc mean')
-			header['JDSTART'] = time 
-			header['MASTER'] = True
-			phdu = fits.PrimaryHDU(data = m, header = header)
-			ehdu = fits.ImageHDU(data = std, header = header)
-			hdul = fits.HDUList([phdu, ehdu])
+		note = 'good'
+	entry['note'] = note
+	if verbose:
+		print('Done ', base_name)
+	return entry
 
+def _read_frame(file):
+	return fits.open(file)[0].data
 
-			letter = file.split('-')[2]
-			base_name = file.split('/')[-1].split('.')[0].replace(letter,'m')
-			save_name = save_location + base_name + '.fits'
-			print('saving')
-			hdul.writeto(save_name,overwrite=True)
-			compress = 'gzip -f ' + save_name
-			os.system(compress)
-			print('saved')
-			entry['name'] = base_name
+def _read_flat(file):
+	data = fits.open(file)[0].data.astype(float)
 
-			entry['chip'] = header['CHIP']
-			entry['exptime'] = header['EXPTIME']
-			entry['jd'] = time
-			entry['date'] = header['DATE-OBS']
-			entry['nimages'] = len(master)
-			entry['filename'] = save_name + '.gz'
-			if len(master) < 3:
-				note = 'bad'
-			else:
-				note = 'good'
-			entry['note'] = note
-			if verbose:
-				print('Done ', base_name)
-			if len(entries) == 0:
-				entries = pd.DataFrame([entry])
-			else:
-				entries = entries.append(entry,ignore_index=True)
-		except:
-			print('bad')
-		
-	return entries 
+	saturations = (data > 50000).flatten()
+	# if more than 10% of pixels are saturated, set array to nan
+	if sum(saturations) > len(saturations) * 0.1:
+		print('image ', file, ' is saturated')
+		data = data * np.nan
+	return data
 
-def get_master_dark(jd,exptime,chip,strict=True,tol=1):
+class dark_resolver():
 	"""
-	ytdhgvj
+	Nearest master dark lookups for the flat processing. The master dark list is
+	read once (and again only if it changes on disk), lookups are memoised on
+	(jd, exptime, chip) and the dark frames are served from the process master
+	cache, so the flats stacked in a worker share the decoded darks.
 	"""
-	darks = pd.read_csv('cal_lists/master_dark_list.csv')
-	if strict:
-		ind = darks['note'].values == 'good'
-		darks = darks.iloc[ind]
-	dchips = darks['chip'].values
-	chip_ind = dchips == chip
-	darks = darks.iloc[chip_ind]
-	
-	dexptime = darks['exptime'].values
-	exp_ind = dexptime.astype(int) == int(exptime)
-	good = darks.iloc[exp_ind]
-
-	if len(good) > 0:
-		djd = good['jd'].values
-		diff = jd - djd
-		min_ind = np.argmin(abs(diff))
-		t_diff = diff[min_ind]
-		dark = good.iloc[min_ind]
-		fname = dark['filename']
-		#print('flat exp:{}, chip:{}'.format(exptime,chip))
-		if abs(t_diff) < tol:
-			return fname, t_diff
-		else:
-			return 'none', -999	
-	else:
+	def __init__(self,strict=True,tol=1,cal_dir='cal_lists/'):
+		self.strict = strict
+		self.tol = tol
+		self.cal_dir = cal_dir
+		self._load()
+
+	def _load(self):
+		self.stamp = list_stamp('master_dark_list',self.cal_dir)
+		darks = read_list('master_dark_list',columns=['chip','exptime','jd','filename','note'],
+						  cal_dir=self.cal_dir)
+		if self.strict:
+			darks = darks.iloc[darks['note'].values == 'good']
+		darks = darks.iloc[np.isfinite(darks['jd'].values)]
+		self.partitions = {}
+		for key, group in darks.groupby([darks['chip'].values,darks['exptime'].values.astype(int)]):
+			jd = group['jd'].values
+			order = np.argsort(jd,kind='stable')
+			self.partitions[key] = (jd[order],group['filename'].values[order])
+		self._lookups = {}
+
+	def lookup(self,jd,exptime,chip):
+		"""
+		Return the filename and time difference (jd - dark jd) of the nearest good
+		master dark with the same chip and exposure time, or ('none', -999) if there
+		is none within tol days.
+		"""
+		if list_stamp('master_dark_list',self.cal_dir) != self.stamp:
+			self._load()
+		key = (jd,int(exptime),chip)
+		if key not in self._lookups:
+			self._lookups[key] = self._nearest(*key)
+		return self._lookups[key]
+
+	def _nearest(self,jd,exptime,chip):
+		if (chip,exptime) not in self.partitions:
+			return 'none', -999
+		jds, files = self.partitions[(chip,exptime)]
+		i = np.searchsorted(jds,jd)
+		candidates = [c for c in (i - 1, i) if 0 <= c < len(jds)]
+		best = min(candidates, key=lambda c: abs(jd - jds[c]))
+		t_diff = jd - jds[best]
+		if abs(t_diff) < self.tol:
+			return files[best], t_diff
 		return 'none', -999
 
+	def load(self,fname):
+		"""
+		The data of a master dark, decoded once per process.
+		"""
+		return get_master_frames(fname)[0]
+
+
+_resolvers = {}
+
+def get_dark_resolver(strict=True,tol=1,cal_dir='cal_lists/'):
+	key = (strict,tol,os.path.abspath(cal_dir))
+	if key not in _resolvers:
+		_resolvers[key] = dark_resolver(strict,tol,cal_dir)
+	return _resolvers[key]
+
+def get_master_dark(jd,exptime,chip,strict=True,tol=1):
+	"""
+	Find the nearest good master dark for a frame, see dark_resolver.lookup.
+	"""
+	return get_dark_resolver(strict,tol).lookup(jd,exptime,chip)
+
 
 def cut_bad_reductions(table):
 	"""
@@ -152,10 +230,11 @@ def cut_bad_reductions(table):
 	return tab
 
 
-def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/master/flat/',redo_bad=False, verbose=False):
+def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/master/flat/',redo_bad=False, verbose=False,memory_budget=1024**3):
 	# make save_location an environment variable
-	flat_list = pd.read_csv('cal_lists/flat_list.csv')
-	masters = pd.read_csv('cal_lists/master_flat_list.csv')
+	flat_list = read_list('flat_list')
+	writer = cal_list_writer('master_flat_list')
+	masters = read_list('master_flat_list')
 	if redo_bad:
 		masters = cut_bad_reductions(masters)
 	names = split_names(flat_list['name'].values)
@@ -180,22 +259,11 @@ def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/maste
 			chip_ind = all_chips['chip'].values.astype(int) == j
 			chip = all_chips.iloc[chip_ind]
 			chip_files = chip['filename'].values
-			master = []
-			for file in chip_files:
-				hdu = fits.open(file)[0]
-				header = hdu.header
-				data = hdu.data.astype(float)
-
-				saturations = (data > 50000).flatten()
-				# if more than 10% of pixels are saturated, set array to nan
-				if sum(saturations) > len(saturations) * 0.1:
-					print('image ', file, ' is saturated')
-					data = data * np.nan
-
-				master += [data]
-			master = np.array(master)
+			file = chip_files[-1]
+			header = fits.getheader(file)
+			nimages = len(chip_files)
 			if verbose:
-				print('Used ',len(master),' images in median')
+				print('Used ',nimages,' images in median')
 			# get dark frame
 			if dark_get:
 				fname, tdiff = get_master_dark(chip['jd'].values[0], chip['exptime'].values[0], j)
@@ -210,16 +278,17 @@ def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/maste
 				print('using dark frame ',fname)
 				print('time difference ',tdiff)
 			try:
-				dark = fits.open(fname)[0].data
-				master = master - dark
+				dark = get_dark_resolver().load(fname)
+				loader = lambda f: _read_flat(f) - dark
 
 			except:
 				m = '!!! Warning: No dark found !!!'
 				print(m)
 				tdiff = -999
+				loader = _read_flat
 			
-			mas = np.nanmedian(master,axis=0)
-			std = np.nanstd(master,axis=0)
+			mas, std = stack_frames(chip_files,loader,combine=('median','std'),
+									memory_budget=memory_budget)
 			time = np.nanmean(chip['jd'])
 			header['JDSTART'] = time 
 			header['MASTER'] = True
@@ -232,9 +301,7 @@ def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/maste
 			base_name = file.split('/')[-1].split('.')[0].replace(letter,'m')
 			save_name = save_location + base_name + '.fits'
 			print('saving')
-			hdul.writeto(save_name,overwrite=True)
-			compress = 'gzip -f ' + save_name
-			os.system(compress)
+			write_fits(hdul,save_name)
 			print('saved')
 			entry['name'] = base_name
 
@@ -246,7 +313,7 @@ def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/maste
 			entry['filename'] = save_name + '.gz'
 			entry['dark_file'] = fname 
 			entry['time_diff'] = tdiff
-			entry['nimages'] = len(master)
+			entry['nimages'] = nimages
 
 			field = header['FIELD']
 			if 'flat_round' in field:
@@ -259,7 +326,7 @@ def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/maste
 			if (np.nanmedian(mas) < 15000) | (np.nansum(mas) <= 0):
 				note = 'bad'
 			else:
-				if (len(master) < 2) & (flat_type == 'dome'):
+				if (nimages < 2) & (flat_type == 'dome'):
 					note = 'bad'
 				else:
 					note = 'good'
@@ -276,17 +343,18 @@ def make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/maste
 			if verbose:
 				print('Done ', base_name)
 		
-			masters = masters.append(entry, ignore_index=True)
-			masters.to_csv('cal_lists/master_flat_list.csv',index=False)
+			# journaled as it is made, written to the list once at the end
+			writer.add(entry)
+	writer.commit(masters)
 
-def new_make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/master/flat/',time_frame=60,num_cores=25, verbose=False):
+def new_make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/master/flat/',time_frame=60,num_cores=25, verbose=False,memory_budget=1024**3,
+						  retry_failed=False):
 	# make save_location an environment variable
-	flat_list = pd.read_csv('cal_lists/flat_list.csv')
-	masters = pd.read_csv('cal_lists/master_flat_list.csv')
-	flat_list['field'] = flat_list['field'].str.strip()
+	flat_list = read_list('flat_list',columns=['field','note','chip','band','jd','exptime','filename'])
+	writer = cal_list_writer('master_flat_list')
+	masters = read_list('master_flat_list',columns=['name'])
 	ind = (flat_list['field'].values == 'flat_round') & (flat_list['note'].values == 'good') & (flat_list['chip'].values != 99) & (flat_list['chip'].values != 0)
 	flat_list = flat_list.iloc[ind]
-	flat_list['band'] = flat_list['band'].str.strip()
 	times = flat_list['jd'].values.astype(int)
 	names = []
 	for i in range(len(times)):
@@ -298,19 +366,17 @@ def new_make_master_flats(save_location = '/home/phys/astronomy/rri38/moa/data/m
 	new = all_names - master_names
 	new = list(new)
 	print('Number of new flat entries: ',len(new))
-	if len(new) > 0:
-		new.sort(reverse=True)
-		indexer = np.arange(len(new))
-		entries = Parallel(n_jobs=num_cores)(delayed(flat_processing)(index,new,flat_list,times,time_frame,save_location,verbose) for index in indexer)
-		entries = pd.concat(entries,ignore_index=True)	
-		
-		masters = masters.append(entries, ignore_index=True)
-		masters.to_csv('cal_lists/master_flat_list.csv',index=False)
+	new.sort(reverse=True)
+	units = {(n,int(n.split('_')[-1])):(n,flat_list,times,time_frame,save_location,verbose,memory_budget) for n in new}
+	manifest = work_manifest('master_flat')
+	build_units(manifest,units,flat_processing,writer,num_cores,retry_failed,verbose)
 
-def flat_processing(index,new,flat_list,times,time_frame,save_location,verbose):
-	i = index
+def flat_processing(n,flat_list,times,time_frame,save_location,verbose,memory_budget=1024**3):
+	"""
+	Combine the dome flats of one band and chip from the time_frame days up to the
+	night in the name n into a master and return its list entry.
+	"""
 	entry = {}
-	n = new[i]
 	t = int(n[1:].split('_')[0])
 	c = int(n.split('_')[-1])
 	b = n.split('_')[2]
@@ -325,36 +391,23 @@ def flat_processing(index,new,flat_list,times,time_frame,save_location,verbose):
 	if verbose:
 		print('Num flats: ', len(files))
 
-	master_arr = []
-	darks = []
 	if len(files) > 10:
 		files = files[:10]
-	for j in range(len(files)):
-		
-		hdu = fits.open(files[j])[0]
-		header = hdu.header
-		#print(header)
-		data = hdu.data.astype(float)
-
-		saturations = (data > 50000).flatten()
-		# if more than 10% of pixels are saturated, set array to nan
-		if sum(saturations) > len(saturations) * 0.1:
-			print('image ', files[j], ' is saturated')
-			data = data * np.nan
-		master_arr += [data]
-
-		fname, tdiff = get_master_dark(t, exptimes[j], c)
+
+	darks = get_dark_resolver()
+	def loader(j):
+		data = _read_flat(files[j])
+		fname, tdiff = darks.lookup(t, exptimes[j], c)
 		try:
-			darks += [fits.open(fname)[0].data]
+			dark = darks.load(fname)
 		except:
-			darks += [data * np.nan]
-
-	master_arr = np.array(master_arr)
-	darks = np.array(darks)
-	master_arr = master_arr - darks
+			dark = data * np.nan
+		return data - dark
 
-	mas = np.nanmean(master_arr,axis=0)
-	std = np.nanstd(master_arr,axis=0)
+	mas, std = stack_frames(range(len(files)),loader,combine=('mean','std'),
+							memory_budget=memory_budget)
+	header = fits.getheader(files[-1])
+	nimages = len(files)
 	header['JDSTART'] = t 
 	header['MASTER'] = True
 	phdu = fits.PrimaryHDU(data = mas, header = header)
@@ -363,9 +416,7 @@ def flat_processing(index,new,flat_list,times,time_frame,save_location,verbose):
 
 	save_name = save_location + n + '.fits'
 	print('saving')
-	hdul.writeto(save_name,overwrite=True)
-	compress = 'gzip -f ' + save_name
-	os.system(compress)
+	write_fits(hdul,save_name)
 	print('saved')
 	entry['name'] = n
 
@@ -375,7 +426,7 @@ def flat_processing(index,new,flat_list,times,time_frame,save_location,verbose):
 	entry['jd'] = t
 	entry['date'] = header['DATE-OBS']
 	entry['filename'] = save_name + '.gz'
-	entry['nimages'] = len(master_arr)
+	entry['nimages'] = nimages
 
 	field = header['FIELD']
 	if 'flat_round' in field:
@@ -388,7 +439,7 @@ def flat_processing(index,new,flat_list,times,time_frame,save_location,verbose):
 	if (np.nanmedian(mas) < 15000) | (np.nansum(mas) <= 0):
 		note = 'bad'
 	else:
-		if (len(master_arr) < 2) & (flat_type == 'dome'):
+		if (nimages < 2) & (flat_type == 'dome'):
 			note = 'bad'
 		else:
 			note = 'good'
@@ -404,14 +455,14 @@ def flat_processing(index,new,flat_list,times,time_frame,save_location,verbose):
 
 	if verbose:
 		print('Done ', n)
-	return pd.DataFrame([entry])
+	return entry
 	
 
-def make_masters(verbose=True):
-	make_master_darks(verbose=True)
+def make_masters(verbose=True,retry_failed=False):
+	make_master_darks(verbose=True,retry_failed=retry_failed)
 	if verbose:
 		print('!!! Finished darks !!!')
-	new_make_master_flats(verbose=True)
+	new_make_master_flats(verbose=True,retry_failed=retry_failed)
 	if verbose:
 		print('!!! Finished flats !!!')
 
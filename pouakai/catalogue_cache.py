@@ -0,0 +1,211 @@
+import os
+import numpy as np
+import pandas as pd
+from cal_store import has_parquet
+
+package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+
+class catalogue_cache():
+	"""
+	On disk cache of a reference catalogue split into sky tiles.
+
+	The sky is cut into declination bands of tile_size degrees, with each band cut
+	into roughly square RA cells, so tiles have close to equal area. Every tile is
+	stored as Parquet when pyarrow is available (a numpy record array otherwise, as
+	for the calibration lists in cal_store) and cone searches are served from the
+	tiles that overlap the cone. The fetcher (e.g. a Vizier query) is only called
+	when a tile is not yet on disk.
+
+	-------
+	Inputs-
+	-------
+		name 		str 	catalogue name, used for the cache sub directory
+		fetcher 	func 	fetcher(ra, dec, radius, magnitude_limit) -> DataFrame
+		ra_col 		str 	RA column of the catalogue (deg)
+		dec_col 	str 	Dec column of the catalogue (deg)
+		mag_col 	str 	magnitude column the magnitude limit applies to
+		cache_dir 	str 	root of the cache, defaults to $POUAKAI_CAT_CACHE
+		tile_size 	float 	tile height in degrees, must divide 180
+		magnitude_limit float 	faintest magnitude stored in the tiles
+		offline 	bool 	raise on a missing tile instead of fetching it
+	"""
+	def __init__(self,name,fetcher,ra_col,dec_col,mag_col,cache_dir=None,tile_size=1,
+				 magnitude_limit=21,offline=False):
+		if cache_dir is None:
+			cache_dir = os.environ.get('POUAKAI_CAT_CACHE',package_directory + 'cat_cache/')
+		self.name = name
+		self.fetcher = fetcher
+		self.ra_col = ra_col
+		self.dec_col = dec_col
+		self.mag_col = mag_col
+		self.tile_size = tile_size
+		self.magnitude_limit = magnitude_limit
+		self.offline = offline
+		self.path = os.path.join(cache_dir,'{}_{}deg_{}mag'.format(name,tile_size,magnitude_limit))
+		self.nbands = int(round(180 / tile_size))
+		self.hits = 0
+		self.misses = 0
+
+	def _n_ra(self,band):
+		lo = -90 + band * self.tile_size
+		hi = lo + self.tile_size
+		if (lo < 0) & (hi > 0):
+			cos = 1
+		else:
+			cos = np.cos(np.radians(min(abs(lo),abs(hi))))
+		return max(1,int(np.ceil(360 * cos / self.tile_size)))
+
+	def tile_of(self,ra,dec):
+		"""
+		Tile (band, ra cell) of each position.
+		"""
+		ra = np.asarray(ra) % 360
+		band = np.clip(((np.asarray(dec) + 90) // self.tile_size).astype(int),0,self.nbands - 1)
+		n_ra = np.array([self._n_ra(b) for b in range(self.nbands)])[band]
+		cell = np.minimum((ra / 360 * n_ra).astype(int),n_ra - 1)
+		return band, cell
+
+	def _tile_cone(self,band,cell):
+		"""
+		Cone (ra, dec, radius) that covers a tile.
+		"""
+		lo = -90 + band * self.tile_size
+		hi = lo + self.tile_size
+		n_ra = self._n_ra(band)
+		if n_ra == 1:
+			pole = 90 if hi >= 90 else -90
+			return 0, pole, self.tile_size * 1.01
+		width = 360 / n_ra
+		ra_c = (cell + 0.5) * width
+		dec_c = (lo + hi) / 2
+		ras = np.array([cell * width,ra_c,(cell + 1) * width] * 3)
+		decs = np.repeat([lo,dec_c,hi],3)
+		radius = np.max(_separation(ra_c,dec_c,ras,decs))
+		return ra_c, dec_c, radius * 1.01
+
+	def tiles_for_cone(self,ra,dec,radius):
+		"""
+		All tiles that overlap a cone.
+		"""
+		tiles = []
+		dec_lo = max(dec - radius,-90)
+		dec_hi = min(dec + radius,90)
+		b0 = int((dec_lo + 90) // self.tile_size)
+		b1 = min(int((dec_hi + 90) // self.tile_size),self.nbands - 1)
+		for band in range(b0,b1 + 1):
+			n_ra = self._n_ra(band)
+			lo = max(-90 + band * self.tile_size,dec_lo)
+			hi = min(-90 + (band + 1) * self.tile_size,dec_hi)
+			edge = max(abs(lo),abs(hi))
+			if (edge >= 89.999) | (dec_hi >= 90) | (dec_lo <= -90):
+				cells = range(n_ra)
+			else:
+				x = np.sin(np.radians(radius)) / np.cos(np.radians(edge))
+				if x >= 1:
+					cells = range(n_ra)
+				else:
+					dra = np.degrees(np.arcsin(x)) * 1.01
+					width = 360 / n_ra
+					c0 = int(np.floor((ra - dra) / width))
+					c1 = int(np.floor((ra + dra) / width))
+					cells = sorted(set(c % n_ra for c in range(c0,c1 + 1)))
+			tiles += [(band,c) for c in cells]
+		return tiles
+
+	def _tile_file(self,band,cell,fmt=None):
+		if fmt is None:
+			fmt = 'parquet' if has_parquet else 'npy'
+		return os.path.join(self.path,'{}_{}.{}'.format(band,cell,fmt))
+
+	def _cached_file(self,band,cell):
+		"""
+		The stored file of a tile, in either format, or None.
+		"""
+		for fmt in ['parquet','npy']:
+			fname = self._tile_file(band,cell,fmt)
+			if os.path.isfile(fname) & ((fmt != 'parquet') | has_parquet):
+				return fname
+		return None
+
+	def load_tile(self,band,cell):
+		"""
+		Read a tile from disk, fetching and storing it on a miss.
+		"""
+		fname = self._cached_file(band,cell)
+		if fname is not None:
+			self.hits += 1
+			if fname.endswith('.parquet'):
+				return pd.read_parquet(fname)
+			return pd.DataFrame(np.load(fname,allow_pickle=False))
+		self.misses += 1
+		if self.offline:
+			raise ValueError('Tile {} of {} is not cached and offline is set'.format((band,cell),self.name))
+		ra, dec, radius = self._tile_cone(band,cell)
+		cat = self.fetcher(ra,dec,radius,self.magnitude_limit)
+		if (cat is None) or (len(cat) == 0):
+			cat = pd.DataFrame()
+		else:
+			b, c = self.tile_of(cat[self.ra_col].values,cat[self.dec_col].values)
+			cat = cat.iloc[(b == band) & (c == cell)]
+		cat = cat.reset_index(drop=True)
+		self._save_tile(self._tile_file(band,cell),cat)
+		return cat
+
+	def _save_tile(self,fname,cat):
+		os.makedirs(self.path,exist_ok=True)
+		# write then move so parallel workers never read a partial tile
+		tmp = fname + '.{}.tmp'.format(os.getpid())
+		if fname.endswith('.parquet'):
+			cat.to_parquet(tmp,index=False)
+		else:
+			# string columns as fixed width unicode, object arrays need pickle
+			columns = [cat[col].values if cat[col].dtype.kind in 'biuf' else np.asarray(cat[col],dtype=str)
+					   for col in cat.columns]
+			rec = np.rec.fromarrays(columns,names=list(cat.columns)) if len(columns) > 0 else np.array([])
+			with open(tmp,'wb') as f:
+				np.save(f,rec,allow_pickle=False)
+		os.replace(tmp,fname)
+
+	def cone(self,ra,dec,radius,magnitude_limit=None):
+		"""
+		All catalogue sources within radius (deg) of (ra, dec).
+		"""
+		if magnitude_limit is None:
+			magnitude_limit = self.magnitude_limit
+		if magnitude_limit > self.magnitude_limit:
+			raise ValueError('The {} cache only holds sources brighter than {}'.format(self.name,self.magnitude_limit))
+		tiles = [self.load_tile(b,c) for b, c in self.tiles_for_cone(ra,dec,radius)]
+		tiles = [t for t in tiles if len(t) > 0]
+		if len(tiles) == 0:
+			return pd.DataFrame()
+		cat = pd.concat(tiles,ignore_index=True)
+		sep = _separation(ra,dec,cat[self.ra_col].values,cat[self.dec_col].values)
+		ind = (sep <= radius) & (cat[self.mag_col].values < magnitude_limit)
+		return cat.iloc[ind].reset_index(drop=True)
+
+	def populate(self,ra,dec,radius):
+		"""
+		Make sure every tile needed for the given cones is on disk.
+		"""
+		ra = np.atleast_1d(ra)
+		dec = np.atleast_1d(dec)
+		tiles = set()
+		for i in range(len(ra)):
+			tiles.update(self.tiles_for_cone(ra[i],dec[i],radius))
+		for b, c in sorted(tiles):
+			if self._cached_file(b,c) is None:
+				self.load_tile(b,c)
+		return len(tiles)
+
+	def stats(self):
+		return {'hits':self.hits,'misses':self.misses}
+
+
+def _separation(ra1,dec1,ra2,dec2):
+	"""
+	Angular separation in degrees (haversine).
+	"""
+	ra1, dec1, ra2, dec2 = [np.radians(v) for v in (ra1,dec1,ra2,dec2)]
+	a = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1)/2)**2
+	return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a,0,1))))
@@ -1,14 +1,14 @@
 import matplotlib 
 #%matplotlib inline
 matplotlib.use('Agg')
-import os, psutil
+import os, psutil, resource
 from os import path
 import subprocess
+import shutil
 from astropy.io import fits
 from glob import glob
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 #from astroquery.astrometry_net import AstrometryNet
 from astropy.coordinates import SkyCoord
@@ -19,15 +19,63 @@ from copy import deepcopy
 
 from scipy.stats import iqr
 from aperture_photom import ap_photom
+from zp_surface import save_surface
 
-from scipy.ndimage.filters import convolve
 from satellite_detection import sat_streaks
+import diagnostics
+import masks
+from master_cache import get_master_frames, get_normalised_flat
+from cal_index import get_index
+from fits_writer import write_fits
+from astrometry import image_sources, write_xylist, solve_xylist, update_header
+from wcs_cache import wcs_solutions
 import gc
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
+def find_master(cal_type,chip,band,exp_time,jd,time_tolerence=100,dark_tolerence=10):
+	"""
+	Find the best master calibration file (flat or dark) for a frame, the one
+	closest in time out of those matching its chip and band (flats) or exposure
+	time (darks).
+
+	--------
+	Outputs-
+	--------
+		file 	str 	master filename
+		tdiff 	float 	time difference to the frame in days
+	"""
+	index = get_index(cal_type)
+	if cal_type.lower() == 'flat':
+		keys = [(chip,band.strip(),'dome','good')]
+
+	elif cal_type.lower() == 'dark':
+		keys = [k for k in index.keys() if (k[0] == chip) and
+				(abs(exp_time - k[1]) < dark_tolerence)]
+		if len(keys) == 0:
+			m = 'No master darks with exptime {}'.format(exp_time)
+			raise ValueError(m)
+
+	file = None
+	t_min = np.inf
+	for key in keys:
+		f, t_diff = index.nearest(key,jd)
+		if t_diff < t_min:
+			file = f
+			t_min = t_diff
+	if file is None:
+		m = 'No master files for chip {} listed in {}'.format(chip,index.name)
+		raise ValueError(m)
+	if t_min > time_tolerence:
+		m = 'No master file in {} that meets the time tolerence of {}'.format(index.name, time_tolerence)
+		raise ValueError(m)
+	if file.split('.')[-1] != 'gz':
+		file += '.gz'
+	return file, t_min
+
+
 #class Consume_moa():
 	
 #	def __init__(self,images,):
@@ -35,7 +83,9 @@ warnings.filterwarnings("ignore")
 class pouakai():
 
 	def __init__(self,file,time_tolerence=100,dark_tolerence=10,savepath='',
-				 local_astrom=True,verbose=True,rescale=True,plot=True,calibrate=True):
+				 local_astrom=True,verbose=True,rescale=True,plot=True,calibrate=True,
+				 compress=True,reuse_wcs=True,surface_method='full',sat_binning=1,fig_format='pdf',fig_mode='sync',
+				 run=True):
 
 		self.verbose = verbose
 		self.file = file 
@@ -47,6 +97,16 @@ class pouakai():
 		self.fail_flag = ''
 		self.rescale = rescale
 		self.plotting = plot
+		if fig_mode not in diagnostics.modes:
+			raise ValueError('fig_mode must be one of {}'.format(diagnostics.modes))
+		self.fig_format = fig_format
+		self.fig_mode = fig_mode
+		self.compress = compress
+		self._reuse_wcs = reuse_wcs
+		self.surface_method = surface_method
+		self.sat_binning = sat_binning
+		# mask components computed elsewhere (e.g. for a whole batch)
+		self.premasks = {}
 		self._start_record()
 		self._check_dirs()
 		self._set_base_name() 
@@ -60,13 +120,14 @@ class pouakai():
 
 		self._setup_fig()
 		
-		#try:
-		self.reduce()
-		#except Exception as e:
-		#	self.fail_flag = e
-
-		if self.fail_flag != '':
-			self._fail_log()
+		if run:
+			#try:
+			self.reduce()
+			#except Exception as e:
+			#	self.fail_flag = e
+
+			if self.fail_flag != '':
+				self._fail_log()
 		
 		#del self
 		#gc.collect()
@@ -77,38 +138,51 @@ class pouakai():
 
 	def reduce(self):
 		#self._check_reduction(reduction)
-		process = psutil.Process()
-        
 		self.reduce_image()
-		print('Reduce image ',process.memory_info().rss/1024**2)  # in bytes 
+		self._report_memory('reduce image')
+		self.finish_reduction()
+
+	def finish_reduction(self):
+		"""
+		Everything after the flat fielding: astrometry, masks, photometry and saving.
+		"""
 		self.save_intermediate()
-		print('save image ',process.memory_info().rss/1024**2)  # in bytes 
+		self._report_memory('save image')
 		
 		if self._local_astrom:
 			self.wcs_astrometrynet_local()
 		else:
 			self.wcs_astrometrynet()
-		print('wcs',process.memory_info().rss/1024**2)  # in bytes 
+		self._report_memory('wcs')
 		self.satellite_search()
-		print('satellite ',process.memory_info().rss/1024**2)  # in bytes 
+		self._report_memory('satellite')
 		self.Make_mask()
-		print('Mask ',process.memory_info().rss/1024**2)  # in bytes 
+		self._report_memory('mask')
 		if self._calibrate:
 			self.calculate_zp()
-		print('zp ',process.memory_info().rss/1024**2)  # in bytes 
+			self._report_memory('zp')
 		self.save_fig()
 		self.save_image()
-		print('save full image',process.memory_info().rss/1024**2)  # in bytes 
-		self._record_reduction()
-		print('record red',process.memory_info().rss/1024**2)  # in bytes 
+		self._report_memory('save full image')
 		if self._calibrate:
 			self._save_phot_table()
 			del self.cal
-		print('record phot',process.memory_info().rss/1024**2)  # in bytes 
 		
 		gc.collect()
-		print('del cal: ',process.memory_info().rss/1024**2)  # in bytes 
-		#self._record_reduction()
+		self._report_memory('done')
+		self._record_reduction()
+
+	def _report_memory(self,step):
+		"""
+		Track the resident and peak memory of the process through the reduction.
+		"""
+		rss = psutil.Process().memory_info().rss / 1024**2
+		# ru_maxrss is in kB on linux
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+		self.log['peak_mem'] = peak
+		if self.verbose:
+			print('{}: rss {:.0f} MB, peak {:.0f} MB'.format(step,rss,peak))
+
 	#def _check_reduction(self,reduction):
 
 	def _fail_log(self):
@@ -127,7 +201,8 @@ class pouakai():
 					'field':None,'filename':None,'flat':None,
 					'dark':None,'tdiff_flat':None,
 					'tdiff_dark':None,'zp':None,'zperr':None,
-					'maglim5':None,'maglim3':None,'savename':None}
+					'maglim5':None,'maglim3':None,'savename':None,
+					'peak_mem':None}
 		self.log = document 
 
 
@@ -182,76 +257,24 @@ class pouakai():
 		Retrieve the best master calibration image for the science image.
 		This cane be used to retrieve flats or darks.
 		"""
-		if cal_type.lower() == 'flat':
-			masters = pd.read_csv('cal_lists/master_flat_list.csv')
-			ind = (masters['band'].values == self.filter) & (masters['chip'].values == self.chip)
-			masters = masters.iloc[ind]
-
-			ind = (masters['note'].values == 'good') & (masters['flat_type'].values == 'dome')
-			masters = masters.iloc[ind]
-
-		elif cal_type.lower() == 'dark':
-			masters = pd.read_csv('cal_lists/master_dark_list.csv')
-			ind = masters['chip'].values == self.chip
-			masters = masters.iloc[ind]
-			exptimes = masters['exptime'].values
-			ind = np.where(abs(self.exp_time - exptimes)<self.dark_tolerence)[0]
-			if len(ind) == 0:
-				m = 'No master darks with exptime {}'.format(self.exp_time)
-				raise ValueError(m)
-			masters = masters.iloc[ind]
-
-		else:
-			raise ValueError('Only flat and dark are valid options!!')
-		file, tdiff = self._find_master(masters)
-		if file.split('.')[-1] != 'gz':
-			file += '.gz'
+		file, tdiff = find_master(cal_type,self.chip,self.filter,self.exp_time,self.jd,
+								  self.time_tolerence,self.dark_tolerence)
 		self.log[cal_type] = file
 		self.log['tdiff_' + cal_type] = tdiff
 		if self.verbose:
 			print('tdiff for ' + cal_type + '=' + str(tdiff))
-		hdu = fits.open(file)
-		data = hdu[0].data
-		err =  hdu[1].data
-		hdu.close()
-
+		data, err = get_master_frames(file)
 
 		if cal_type.lower() == 'flat':
 			self.flat_file = file 
 			self.flat = data
 			self.flat_err = err
+			self.norm_flat = get_normalised_flat(file)
 		elif cal_type.lower() == 'dark':
 			self.dark_file = file 
 			self.dark = data
 			self.dark_err = err
 
-
-	def _find_master(self,masters):
-		"""
-		Find the best master image for the science image.
-		"""
-		chip = self.chip
-		date = self.jd
-		tolerence = self.time_tolerence
-
-		chip_ind = masters['chip'].values == chip
-		if len(chip_ind) == 0:
-			m = 'No master files for chip {} listed in {}'.format(chip,masters)
-			raise ValueError(m)
-		m = masters.iloc[chip_ind]
-		m_date = m.jd.values
-
-		t_diff = abs(m_date - date)
-		t_min = np.nanmin(t_diff)
-		if t_min > tolerence:
-			m = 'No master file in {} that meets the time tolerence of {}'.format(masters, tolerence)
-			raise ValueError(m)
-		t_ind = np.argmin(t_diff)
-
-		file = masters['filename'].iloc[t_ind]
-
-		return file, t_diff[t_ind]
-
 	#def _update_header_obj()
 
 
@@ -279,6 +302,9 @@ class pouakai():
 	def _update_header_satellites(self):
 		self.header['SAT'] = (self.sat.satellite,'Satellite in image')
 		self.header['SATNUM'] = (self.sat.sat_num,'Number of satellites in image')
+		for i, streak in enumerate(self.sat.streaks):
+			self.header[f'SATL{i+1}'] = ('{} {} {} {} {}'.format(streak['x1'],streak['y1'],streak['x2'],
+											streak['y2'],streak['width']),'Satellite x1 y1 x2 y2 width')
 
 	def _check_vars(self):
 		"""
@@ -310,19 +336,21 @@ class pouakai():
 		"""
 		self._check_vars()
 		
-		image = (self.raw_image - self.dark) / (self.flat/np.nanmedian(self.flat))
+		# work in place in a single float32 buffer
+		image = np.empty(self.raw_image.shape,dtype=np.float32)
+		np.subtract(self.raw_image,self.dark,out=image,casting='unsafe')
+		np.divide(image,self.norm_flat,out=image)
 		if np.nansum(image) == 0:
 			raise ValueError('Image is all NaNs')
 
-		bkg = np.nanmedian(image)
-		sub = image - bkg + self.offset
+		self._add_image(self.raw_image,'raw')
+		self._add_image(self.flat,'flat')
+		self._add_image(image,'reduced')
 
-		self.image = sub
+		bkg = np.nanmedian(image)
+		image -= bkg - self.offset
 
-		self._add_image(self.raw_image,'A')
-		self._add_image(self.flat,'B')
-		self._add_image(image,'C')
-		self._add_image(image,'D')
+		self.image = image
 
 
 	def save_intermediate(self):
@@ -335,15 +363,10 @@ class pouakai():
 		self._update_header_flat()
 		name = self.savepath + 'red/' + self.base_name + '_red.fits'
 
-		self.red_name = name + '.gz'
-
-
 		if self.verbose:
 			print('Saving intermediated calibrated file')
-		fits.writeto(name,self.image,header=self.header,overwrite=True)
-		
-		compress = 'gzip -f ' + name
-		os.system(compress)
+		hdu = fits.PrimaryHDU(data = self.image, header = self.header)
+		self.red_name = write_fits(hdu,name,compress=self.compress)
 
 
 	def save_image(self):
@@ -354,16 +377,13 @@ class pouakai():
 		self._update_header_dark()
 		self._update_header_flat()
 		name = self.savepath + 'cal/' + self.base_name + '_cal.fits'
-		self.cal_name = name + '.gz'
 
 		phdu = fits.PrimaryHDU(data = self.image, header = self.header)
 		mhdu = fits.ImageHDU(data = self.mask, header = self.header)
 		hdul = fits.HDUList([phdu, mhdu])
 		if self.verbose:
 			print('Saving final calibrated image')
-		hdul.writeto(name,overwrite=True)
-		compress = 'gzip -f ' + name
-		os.system(compress)
+		self.cal_name = write_fits(hdul,name,compress=self.compress)
 		self.log['savename'] = self.cal_name
 
 	def wcs_astrometrynet(self,timeout=120):
@@ -396,40 +416,39 @@ class pouakai():
 
 	def wcs_astrometrynet_local(self):
 		"""
-		Calculate the image wcs using the local libraries for astrometry.net
-		"""
-		# a reasonable search radius is already selected (2deg)
-		astrom_call = "solve-field --no-plots -O -o {savename} -p --ra {ra} --dec {dec} --radius 2 {file}"
-
-		save_path = 'wcs_tmp/' + self.base_name + '/'
-		real_save_path = self.savepath + 'red/' + save_path
-		#if not path.exits(real_save_path):
-		os.mkdir(real_save_path)
-	
-		name = save_path + self.base_name + '_wcs'
-		real_name = real_save_path + self.base_name + '_wcs'
-		solver = astrom_call.format(savename = name, ra = self.field_coord.ra.deg,
-									dec = self.field_coord.dec.deg, file = self.red_name)
-		solve = subprocess.run(solver,stdout=subprocess.PIPE,shell=True)
-
-		f = fits.open(real_name + '.new')
-		wcs_header = f[0].header
-		f.close()
-		# get rid of all the astrometry.net junk in the header 
-		del wcs_header['COMMENT']
-		del wcs_header['HISTORY']
-		self.header = wcs_header
+		Calculate the image wcs using the local libraries for astrometry.net.
+		Sources are found in memory and only the xylist is passed to solve-field.
+		If a blind solution for the same field and chip is cached it is refined
+		against the Gaia stars in it first, with solve-field only run when that fails.
+		"""
+		x, y, flux = image_sources(self.image,header=self.header)
+		key = (self.log['field'],self.chip)
+
+		wcs_header = None
+		if self._reuse_wcs:
+			wcs_header = wcs_solutions.refine(key,x,y)
+			if (wcs_header is not None) & self.verbose:
+				print('Refined cached WCS for ',key)
+
+		if wcs_header is None:
+			save_path = self.savepath + 'red/wcs_tmp/' + self.base_name + '/'
+			os.makedirs(save_path,exist_ok=True)
+			xylist = save_path + self.base_name + '_xy.fits'
+			write_xylist(xylist,x,y,flux)
+			try:
+				# a reasonable search radius is already selected (2deg)
+				wcs_header = solve_xylist(xylist,self.image.shape[1],self.image.shape[0],
+										  self.field_coord.ra.deg,self.field_coord.dec.deg,radius=2)
+			finally:
+				shutil.rmtree(save_path,ignore_errors=True)
+			if self.verbose:
+				print('Solved WCS')
+				print('WCS tmp files cleared')
+			# only blind solutions become the reference for later frames
+			wcs_solutions.store(key,wcs_header,self.image.shape,x,y,jd=self.jd)
+
+		self.header = update_header(self.header,wcs_header)
 		self.wcs = WCS(self.header)
-		
-		if self.verbose:
-			print('Solved WCS')
-		
-		clear = 'rm -rf ' + real_save_path
-		subprocess.run(clear,stdout=subprocess.PIPE,shell=True)
-		#os.system(clear)
-
-		if self.verbose:
-			print('WCS tmp files cleared')
 
 
 	def save_intermediate_wcs(self):
@@ -454,18 +473,16 @@ class pouakai():
 			brightlim = 13
 		else:
 			brightlim = 15
-		mask = ((self.mask & 2) + (self.mask & 4) + (self.mask & 8) + (self.mask & 16))
-		mask[mask > 0] = 1
-		ax = None
-		if self.plotting:
-			ax = self.fig_axis['I']
+		mask = (self.mask & (masks.SATURATION | masks.FLAT | masks.SATELLITE | masks.BADPIX)) > 0
 		self.cal = ap_photom(data=self.image,wcs=self.wcs,mask=mask, header=self.header,
-							threshold=threshold,cal_model=model,ax=ax,
-							brightlim=brightlim,rescale=self.rescale,plot=self.plotting)
+							threshold=threshold,cal_model=model,
+							brightlim=brightlim,rescale=self.rescale,plot=False,
+							surface_method=self.surface_method)
 
-		self._add_image(self.cal.zp_surface,'E',colorbar=True)
-		self._add_image(self.cal.data,'F')
-		self._add_satellite_trail('F')
+		if self.verbose:
+			print(self.cal.timing_report())
+		self._add_image(self.cal.zp_surface,'zp_surface')
+		self._add_image(self.cal.data,'rescaled')
 		self.image = self.cal.data
 
 		self.header['ZP'] = (str(np.round(self.cal.zp,2)), 'Calibrimbore zeropoint')
@@ -478,141 +495,65 @@ class pouakai():
 		self.log['maglim3'] = self.cal.maglim3
 		
 		if self.plotting:
-			self.fig_axis['D'].plot(self.cal.source_x[self.cal.good],self.cal.source_y[self.cal.good],'r.')
-			self._zp_hist()
-			self._zp_color()
-			self.cal.mag_limit_fig(self.fig_axis['I'])
+			self._add_zp_products()
 		self._save_zp_surface()
-		self._save_zp_surface_sources()
 		if self.verbose:
 			print('Zeropoint found to be ' + str(np.round(self.cal.zp,2)))
 
 	def _save_zp_surface(self):
-		path = f'{self.savepath}/zp_surface/{self.base_name}_zp_surface'
-		np.save(path,self.cal.zp_surface)
-	
-	def _save_zp_surface_sources(self):
-		path = f'{self.savepath}/zp_surface/{self.base_name}_zp_points.txt'
-		x_data = (self.cal.ap_photom['xcenter'].values + 0.5).astype(int)
-		y_data = (self.cal.ap_photom['ycenter'].values + 0.5).astype(int)
-		z_data = self.cal.zps
-		arr = np.array([x_data,y_data,z_data])
-		np.savetxt(path,arr)
+		"""
+		Save the zeropoint surface with the zeropoints it was fit to, these are
+		from the first photometry pass, not the rescaled self.cal.zps.
+		"""
+		if self.cal.surface_zps is None:
+			save_surface(self.savepath,self.base_name,self.cal.zp_surface)
+		else:
+			save_surface(self.savepath,self.base_name,self.cal.zp_surface,
+						 self.cal.surface_x,self.cal.surface_y,self.cal.surface_zps)
 
 
-	def _zp_hist(self):
-		"""
-		Create a histogram of the zeropoint distribution
+	def _add_zp_products(self):
 		"""
-		zps = self.cal.zps
-		zps = zps[np.isfinite(zps)]
-		#b = int(abs(np.nanmax(zps) - np.nanmin(zps) /(2*iqr(zps)*len(zps)**(-1/3))))
-		self.fig_axis['G'].hist(zps,alpha=0.5)		
-		med = self.cal.zp
-		high = self.cal.zp+self.cal.zp_std
-		low = self.cal.zp-self.cal.zp_std
-		self.fig_axis['G'].axvline(med,color='k',ls='--')
-		self.fig_axis['G'].axvline(low,color='k',ls=':')
-		self.fig_axis['G'].axvline(high,color='k',ls=':')
-		s = ('$zp='+str((np.round(med,2)))+'^{+' + 
-			str(np.round(high-med,2))+'}_{'+
-			str(np.round(low-med,2))+'}$')
-		self.fig_axis['G'].annotate(s,(.7,.8),fontsize=10,xycoords='axes fraction')
-		self.fig_axis['G'].set_xlabel('zeropoint',fontsize=15)
-		self.fig_axis['G'].set_ylabel('Occurrence',fontsize=15)
-
-	def _zp_color(self):
-		"""
-		Create a figure showing the zeropoint evolving with color.
+		Keep the calibration sources, zeropoints and magnitude limit fit for the
+		diagnostic figure.
 		"""
 		zps = self.cal.zps
-		ind = np.isfinite(zps)
-		gr = (self.cal.sauron.cat_mags['g'] - self.cal.sauron.cat_mags['r']).values[ind]
-
-		self.fig_axis['H'].plot(gr,zps[ind],'.')
-		self.fig_axis['H'].set_ylabel('zeropoint',fontsize=15)
-		self.fig_axis['H'].set_xlabel('$g-r$',fontsize=15)	
-		med = self.cal.zp
-		high = self.cal.zp+self.cal.zp_std
-		low = self.cal.zp-self.cal.zp_std
-		self.fig_axis['H'].axhline(med,color='k',ls='--')
-		self.fig_axis['H'].axhline(low,color='k',ls=':')
-		self.fig_axis['H'].axhline(high,color='k',ls=':')
-
+		gr = (self.cal.cat_mags['g'] - self.cal.cat_mags['r']).values
+		self.diag.add(source_x=self.cal.source_x[self.cal.good],source_y=self.cal.source_y[self.cal.good],
+					  zps=zps,gr=gr,zp=self.cal.zp,zp_std=self.cal.zp_std)
+		self.diag.add(**self.cal.mag_limit_data())
 
 	def save_fig(self):
 		"""
-		Save a diagnostic figure
+		Save the products for the diagnostic figure and draw it now (sync), in a
+		background process (async) or leave it to be drawn later (defer) with
+		diagnostics.render_saved. With async the caller owns the renderer and has
+		to call diagnostics.wait() to collect the figures and their errors.
 		"""
 		if self.plotting:
-			name = self.savepath + 'fig/' + self.base_name + '_diag.pdf'
-			#self.fig.set_tight_layout(True)
-			self.fig.savefig(name)
-			plt.close(self.fig)
-			self.fig.clear()
-			plt.close('all')
-			plt.cla()
-			plt.clf()
+			self.diag.add(streaks=self.sat.streaks)
+			name = self.savepath + 'fig/' + self.base_name + '_diag.npz'
+			self.diag.save(name)
+			if self.fig_mode == 'sync':
+				diagnostics.render_file(name,self.fig_format)
+			elif self.fig_mode == 'async':
+				diagnostics.submit(name,self.fig_format)
+			self.diag = None
 
 
 	def _setup_fig(self):
 		"""
-		Set up the large diagnostic plot figure
+		Set up the collection of diagnostic figure products
 		"""
 		if self.plotting:
-			self.fig = plt.figure(figsize=(8.27,11.69),constrained_layout=True)
-			self.fig_axis = self.fig.subplot_mosaic(
-												"""
-												ABC
-												ABC
-												DEF
-												DEF
-												GHI
-												"""
-											)
-			self.fig_axis['A'].set_title('Raw image',fontsize=15)
-			self.fig_axis['B'].set_title('Flat image',fontsize=15)
-			self.fig_axis['C'].set_title('Reduced image',fontsize=15)
-			self.fig_axis['D'].set_title('Calibration sources',fontsize=15)
-			self.fig_axis['E'].set_title('Zeropoint correction',fontsize=15)
-			self.fig_axis['F'].set_title('Rescaled image',fontsize=15)
-			self.fig_axis['G'].set_title('Zeropoint distribution',fontsize=15)
-			self.fig_axis['H'].set_title('Zeropoint colour',fontsize=15)
-			self.fig_axis['I'].set_title('Signal-Noise Limit',fontsize=15)
-
-	def _add_image(self,image,ax_ind,colorbar=False):
-		"""
-		Add the provided image to the provided axis.
+			self.diag = diagnostics.diagnostic_products()
+
+	def _add_image(self,image,name):
+		"""
+		Add a thumbnail of the image to the diagnostic products.
 		"""
 		if self.plotting:
-			vmin = np.percentile(image,16)
-			vmax = np.percentile(image,84)
-			im = self.fig_axis[ax_ind].imshow(image,origin='lower',
-										vmin=vmin,vmax=vmax)
-			if colorbar:
-				self.fig.colorbar(im,ax=self.fig_axis[ax_ind],fraction=0.046, pad=0.04)
-	
-	def _add_satellite_trail(self,ax_ind):
-		if self.plotting:
-			for consolidated_line in self.sat.consolidated_lines:
-				angle = consolidated_line[0]
-				points = np.array(consolidated_line[1])
-				x = points[:,0]
-				y = points[:,1]
-				coefs = np.polyfit(x, y, 1)
-				slope = coefs[0]
-				intercept = coefs[1]
-				x1 = np.min(x)
-				y1 = int(slope * x1 + intercept)
-				x2 = np.max(x)
-				y2 = int(slope * x2 + intercept)
-				# create the x and y points for the consolidated line
-				x_points = [x1, x2]
-				y_points = [y1, y2]
-
-				# plot the consolidated line
-				self.fig_axis[ax_ind].plot(x_points, y_points, '--r', label='Satellite',alpha = .5)
-				self.fig_axis[ax_ind].legend(loc='upper left')
+			self.diag.add_image(name,image)
 
 
 	def _record_reduction(self):
@@ -628,35 +569,30 @@ class pouakai():
 
 
 	def _flat_mask(self,lowlim=0.8,highlim=1.2,buffer=3):
-		mask = deepcopy(self.flat) / np.nanmedian(deepcopy(self.flat))
-		mask = (mask < lowlim) | (mask > highlim)
-		kernel = np.ones((buffer,buffer))
-		mask = convolve(mask,kernel)
-		mask = mask.astype(int)
-		return mask
+		return masks.flat_mask(self.norm_flat,lowlim,highlim,buffer)
 
 	def _saturaton_mask(self,satlimit=3.5e4,buffer=3):
 		"""
 		An agressive limit is set here to catch overflow pixels.
 		"""
-		mask = deepcopy(self.raw_image)
-		mask = mask > satlimit
-		mask = convolve(mask,np.ones((buffer,buffer)))
-		mask = mask.astype(int)
-		return mask
+		return masks.saturation_mask(self.raw_image,satlimit,buffer)
 
 	def _load_bad_pix_mask(self):
-		bpix = np.load(f'badpix/chip{self.chip}_bpix.npy')
-		return bpix.astype(int)
+		static = masks.get_static_mask(self.flat_file,self.chip)
+		return (static & masks.BADPIX) > 0
 
 	def Make_mask(self):
-		
-		saturation_mask = self._saturaton_mask() * 2
-		flat_mask = self._flat_mask() * 4
-		satellite_mask = self.sat.total_mask * 8
-		bpix = self._load_bad_pix_mask() * 16
-
-		self.mask = flat_mask | saturation_mask | bpix | satellite_mask
+		"""
+		Build the uint8 bit mask. The bad flat and bad pixel bits come from the
+		stored static mask of the master flat and chip, only the saturation and
+		satellite bits are made for each frame.
+		"""
+		if 'saturation' in self.premasks:
+			saturation = self.premasks['saturation']
+		else:
+			saturation = self._saturaton_mask()
+		static = masks.get_static_mask(self.flat_file,self.chip)
+		self.mask = masks.combine(static,saturation,self.sat.total_mask)
 
 		self._update_header_mask_bits()
 
@@ -674,7 +610,7 @@ class pouakai():
 
 
 	def satellite_search(self):
-		self.sat = sat_streaks(self.image,run=True)
+		self.sat = sat_streaks(self.image,binning=self.sat_binning,run=True)
 		self._update_header_satellites()
 		
 	def _save_phot_table(self):
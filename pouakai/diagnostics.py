@@ -0,0 +1,268 @@
+"""
+Diagnostic figures for the reduction. The reduction only collects small
+products (block averaged thumbnails of the images and the zeropoint and
+magnitude limit data) and saves them as <base_name>_diag.npz; the figure is
+drawn from those, either straight away, in a background process, or later:
+
+    python diagnostics.py <savepath>/fig/ [png|pdf]
+"""
+import os
+import sys
+import multiprocessing
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+
+import warnings
+warnings.filterwarnings("ignore")
+
+modes = ['sync','async','defer']
+
+panels = {'A':'Raw image','B':'Flat image','C':'Reduced image','D':'Calibration sources',
+		  'E':'Zeropoint correction','F':'Rescaled image','G':'Zeropoint distribution',
+		  'H':'Zeropoint colour','I':'Signal-Noise Limit'}
+
+
+def thumbnail(image,size=512):
+	"""
+	Block average an image so its longest side is at most about size pixels.
+
+	--------
+	Outputs-
+	--------
+		thumb 	array 	float32 thumbnail
+		factor 	int 	block size, thumbnail pixel i covers pixels i*factor to (i+1)*factor
+	"""
+	factor = max(1,int(np.ceil(max(image.shape) / size)))
+	ny = (image.shape[0] // factor) * factor
+	nx = (image.shape[1] // factor) * factor
+	image = image[:ny,:nx]
+	# rows then columns, much faster than a single mean over a 4d view
+	thumb = image.reshape(ny // factor,factor,nx).mean(axis=1,dtype=np.float32)
+	thumb = thumb.reshape(ny // factor,nx // factor,factor).mean(axis=2)
+	if not np.isfinite(thumb).all():
+		blocks = image.reshape(ny // factor,factor,nx // factor,factor)
+		thumb = np.nanmean(blocks,axis=(1,3),dtype=np.float32)
+	return thumb, factor
+
+def display_limits(image,lower=16,upper=84,sample=100000):
+	"""
+	Display range from the percentiles of an evenly strided subsample of pixels.
+	"""
+	flat = np.asarray(image).ravel()
+	step = max(1,flat.size // sample)
+	return np.nanpercentile(flat[::step],[lower,upper]).astype(np.float32)
+
+def plot_mag_limit(ax,mag,snr,snr_model):
+	"""
+	Signal to noise of the calibration sources against magnitude, with the fitted
+	magnitude limit model mag = snr_model[1] + snr_model[0] * log10(snr).
+	"""
+	def fitted_line(sn):
+		return snr_model[1] + snr_model[0] * np.log10(sn)
+	yz = np.linspace(1,10**5,295)
+	ax.plot(mag,np.log10(snr),'.',alpha=0.5)
+	ax.plot(fitted_line(yz),np.log10(yz),'-')
+
+	ax.axhline(np.log10(3),ls='-.',color='k')
+	ax.axhline(np.log10(5),ls='--',color='k')
+	ax.set_ylabel(r'log$_{10}$(SNR)')
+	ax.set_xlabel('Magnitude Limit')
+
+	ax.text(19,2,r'$3\sigma=$ {:.2f}'.format(fitted_line(3)))
+	ax.text(19,2.5,r'$5\sigma=$ {:.2f}'.format(fitted_line(5)))
+
+	ax.set_ylim(0,3)
+	ax.set_xlim(13,21)
+
+
+class diagnostic_products():
+	"""
+	The products the diagnostic figure is drawn from. Images are kept as
+	thumbnails with display limits from the full image, everything else as small
+	arrays, so the products can be saved and the figure drawn elsewhere.
+
+	-------
+	Inputs-
+	-------
+		size 	int 	longest side of the image thumbnails
+	"""
+	def __init__(self,size=512):
+		self.size = size
+		self.products = {}
+
+	def add_image(self,name,image):
+		thumb, factor = thumbnail(image,self.size)
+		self.products[name] = thumb
+		self.products[name + '_factor'] = np.array(factor)
+		self.products[name + '_limits'] = display_limits(image)
+
+	def add(self,**products):
+		for name in products:
+			self.products[name] = np.asarray(products[name])
+
+	def save(self,file):
+		# uncompressed, compressing the noisy thumbnails costs more than it saves
+		with open(file,'wb') as f:
+			np.savez(f,**self.products)
+		return file
+
+	@classmethod
+	def load(cls,file):
+		products = cls()
+		with np.load(file) as saved:
+			products.products = {k:saved[k] for k in saved.files}
+		return products
+
+	def _image(self,fig,ax,name,colorbar=False):
+		if name not in self.products:
+			return
+		image = self.products[name]
+		factor = int(self.products[name + '_factor'])
+		vmin, vmax = self.products[name + '_limits']
+		# keep the axes in full resolution pixels so overlays line up
+		extent = (-0.5,image.shape[1] * factor - 0.5,-0.5,image.shape[0] * factor - 0.5)
+		im = ax.imshow(image,origin='lower',vmin=vmin,vmax=vmax,extent=extent)
+		if colorbar:
+			fig.colorbar(im,ax=ax,fraction=0.046, pad=0.04)
+
+	def _zp_hist(self,ax):
+		zps = self.products['zps']
+		zps = zps[np.isfinite(zps)]
+		ax.hist(zps,alpha=0.5)
+		med = float(self.products['zp'])
+		high = med + float(self.products['zp_std'])
+		low = med - float(self.products['zp_std'])
+		ax.axvline(med,color='k',ls='--')
+		ax.axvline(low,color='k',ls=':')
+		ax.axvline(high,color='k',ls=':')
+		s = ('$zp='+str((np.round(med,2)))+'^{+' +
+			str(np.round(high-med,2))+'}_{'+
+			str(np.round(low-med,2))+'}$')
+		ax.annotate(s,(.7,.8),fontsize=10,xycoords='axes fraction')
+		ax.set_xlabel('zeropoint',fontsize=15)
+		ax.set_ylabel('Occurrence',fontsize=15)
+
+	def _zp_color(self,ax):
+		zps = self.products['zps']
+		ind = np.isfinite(zps)
+		ax.plot(self.products['gr'][ind],zps[ind],'.')
+		ax.set_ylabel('zeropoint',fontsize=15)
+		ax.set_xlabel('$g-r$',fontsize=15)
+		med = float(self.products['zp'])
+		std = float(self.products['zp_std'])
+		ax.axhline(med,color='k',ls='--')
+		ax.axhline(med - std,color='k',ls=':')
+		ax.axhline(med + std,color='k',ls=':')
+
+	def render(self,name):
+		"""
+		Draw the 9 panel diagnostic figure and save it, the format follows the
+		extension of name (png or pdf).
+		"""
+		p = self.products
+		fig = Figure(figsize=(8.27,11.69),constrained_layout=True)
+		axs = fig.subplot_mosaic(
+								"""
+								ABC
+								ABC
+								DEF
+								DEF
+								GHI
+								"""
+								)
+		for key in panels:
+			axs[key].set_title(panels[key],fontsize=15)
+
+		self._image(fig,axs['A'],'raw')
+		self._image(fig,axs['B'],'flat')
+		self._image(fig,axs['C'],'reduced')
+		self._image(fig,axs['D'],'reduced')
+		self._image(fig,axs['E'],'zp_surface',colorbar=True)
+		self._image(fig,axs['F'],'rescaled')
+		if 'streaks' in p:
+			for streak in p['streaks']:
+				axs['F'].plot([streak['x1'],streak['x2']],[streak['y1'],streak['y2']],
+							  '--r', label='Satellite',alpha = .5)
+				axs['F'].legend(loc='upper left')
+		if 'source_x' in p:
+			axs['D'].plot(p['source_x'],p['source_y'],'r.')
+		if 'zps' in p:
+			self._zp_hist(axs['G'])
+			self._zp_color(axs['H'])
+		if 'snr_model' in p:
+			plot_mag_limit(axs['I'],p['maglim_mag'],p['maglim_snr'],p['snr_model'])
+		fig.savefig(name)
+		return name
+
+
+def figure_name(products_file,fmt='pdf'):
+	return products_file[:-len('.npz')] + '.' + fmt
+
+def render_file(products_file,fmt='pdf'):
+	"""
+	Draw the figure for saved products, next to them.
+	"""
+	return diagnostic_products.load(products_file).render(figure_name(products_file,fmt))
+
+def render_saved(directory,fmt='pdf',overwrite=False,cores=1):
+	"""
+	Draw the figures for all saved products in a directory that don't have an
+	up to date figure yet.
+	"""
+	files = sorted(glob(os.path.join(directory,'*_diag.npz')))
+	todo = []
+	for file in files:
+		name = figure_name(file,fmt)
+		if overwrite or (not os.path.isfile(name)) or (os.path.getmtime(name) < os.path.getmtime(file)):
+			todo += [file]
+	if (cores > 1) & (len(todo) > 1):
+		with ProcessPoolExecutor(cores) as executor:
+			return list(executor.map(render_file,todo,[fmt] * len(todo)))
+	return [render_file(file,fmt) for file in todo]
+
+
+# background renderer, one per process
+_renderer = {'executor':None,'pending':[]}
+
+def _executor():
+	if _renderer['executor'] is None:
+		if multiprocessing.current_process().daemon:
+			# pool workers can't start processes of their own
+			_renderer['executor'] = ThreadPoolExecutor(max_workers=1)
+		else:
+			_renderer['executor'] = ProcessPoolExecutor(max_workers=1)
+	return _renderer['executor']
+
+def submit(products_file,fmt='pdf'):
+	"""
+	Draw the figure for saved products in the background. Call wait to make sure
+	the figures have been written.
+	"""
+	future = _executor().submit(render_file,products_file,fmt)
+	_renderer['pending'] += [(products_file,future)]
+	return future
+
+def wait():
+	"""
+	Wait for the figures submitted by this process, returning the errors of any
+	that failed as {products file: error}.
+	"""
+	errors = {}
+	pending = _renderer['pending']
+	_renderer['pending'] = []
+	for file, future in pending:
+		try:
+			future.result()
+		except Exception as e:
+			errors[file] = '{}: {}'.format(type(e).__name__,e)
+	return errors
+
+
+if __name__ == '__main__':
+	fmt = sys.argv[2] if len(sys.argv) > 2 else 'pdf'
+	done = render_saved(sys.argv[1],fmt=fmt,cores=os.cpu_count())
+	print('Rendered {} figures'.format(len(done)))
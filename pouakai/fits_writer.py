@@ -0,0 +1,89 @@
+import os
+import gzip
+import numpy as np
+from astropy.io import fits
+
+
+suffix = {'none':'','gzip':'.gz','tile':'.fz'}
+
+def _compress_mode(compress):
+	"""
+	Map the compress option onto a write mode. True keeps the old gzip behaviour.
+	"""
+	if (compress is None) or (compress is False):
+		return 'none'
+	if compress is True:
+		return 'gzip'
+	compress = str(compress).lower()
+	if compress not in suffix:
+		raise ValueError('compress must be one of True, False, {}'.format(list(suffix)))
+	return compress
+
+def output_name(name,compress=True):
+	"""
+	Name of the file that write_fits will produce for an uncompressed fits name.
+	"""
+	return name + suffix[_compress_mode(compress)]
+
+def _tile_compress(hdul):
+	"""
+	Convert image extensions to tile compressed HDUs. Integer data is Rice
+	compressed, floating point data uses lossless GZIP_2 (no quantisation).
+	"""
+	comp = [fits.PrimaryHDU(header=fits.Header())]
+	for i, hdu in enumerate(hdul):
+		if hdu.data is None:
+			if i == 0:
+				comp[0] = hdu
+			continue
+		header = hdu.header.copy()
+		for key in ['SIMPLE','EXTEND','XTENSION','PCOUNT','GCOUNT','BZERO','BSCALE']:
+			header.remove(key,ignore_missing=True)
+		if np.issubdtype(hdu.data.dtype,np.integer):
+			data = hdu.data
+			if data.dtype.itemsize > 4:
+				data = data.astype(np.int32)
+			chdu = fits.CompImageHDU(data=data,header=header,compression_type='RICE_1')
+		else:
+			chdu = fits.CompImageHDU(data=hdu.data,header=header,compression_type='GZIP_2',
+									 quantize_level=0.0)
+		comp += [chdu]
+	return fits.HDUList(comp)
+
+def write_fits(hdul,name,compress=True,level=6):
+	"""
+	Write a fits file, compressing it on the way out rather than via a separate
+	gzip call on an uncompressed copy.
+
+	-------
+	Inputs-
+	-------
+		hdul 		HDUList 	data to save, an ndarray is wrapped in a PrimaryHDU
+		name 		str 		uncompressed file name, e.g. red/x_red.fits
+		compress 	bool/str 	True or 'gzip' for a .gz stream, 'tile' for fits
+								tile compression (.fz), False or 'none' for plain fits
+		level 		int 		gzip compression level, 6 matches the gzip default
+
+	--------
+	Outputs-
+	--------
+		fname 	str 	name of the file that was written
+	"""
+	if not isinstance(hdul,fits.HDUList):
+		if isinstance(hdul,(fits.PrimaryHDU,fits.ImageHDU)):
+			hdul = fits.HDUList([hdul])
+		else:
+			hdul = fits.HDUList([fits.PrimaryHDU(data=hdul)])
+	mode = _compress_mode(compress)
+	fname = output_name(name,mode)
+
+	if mode == 'gzip':
+		with open(fname,'wb') as raw:
+			with gzip.GzipFile(filename=os.path.basename(name),fileobj=raw,mode='wb',
+							   compresslevel=level) as f:
+				hdul.writeto(f)
+	elif mode == 'tile':
+		_tile_compress(hdul).writeto(fname,overwrite=True)
+	else:
+		hdul.writeto(fname,overwrite=True)
+	return fname
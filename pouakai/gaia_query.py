@@ -1,36 +1,66 @@
+"""
+Gaia queries for the photometry and astrometry, served from an on-disk tile
+cache (catalogue_cache) so repeat fields don't go back to Vizier. Running
+
+    python gaia_query.py
+
+fills the cache for every field in the observation list. Only Gaia is cached:
+the PS1/SkyMapper queries calibrimbore's sauron makes inside estimate_mag are
+still live network calls, so the zeropoint calibration needs network access.
+"""
 from astropy.coordinates import SkyCoord, Angle
 from astropy import units as u
+import numpy as np
 import pandas as pd
 from astroquery.vizier import Vizier
+from catalogue_cache import catalogue_cache
+from cal_store import read_list
 
-def get_gaia_region(ra,dec,size=0.4, magnitude_limit = 21):
+def _query_gaia_vizier(ra,dec,radius,magnitude_limit):
+	"""
+	Query Vizier for the gaia sources in a cone, radius is in degrees.
 	"""
-	Get the coordinates and mag of all gaia sources in the field of view.
+	c1 = SkyCoord(ra, dec, unit='deg')
+	Vizier.ROW_LIMIT = -1
+
+	result = Vizier.query_region(c1, catalog=["I/345/gaia2"],
+                             		 radius=Angle(radius, "deg"),column_filters={'Gmag':f'<{magnitude_limit}'})
+	if (result is None) or (len(result) == 0):
+		return None
+	return result['I/345/gaia2'].to_pandas()
+
+gaia_cache = catalogue_cache('gaia2',_query_gaia_vizier,ra_col='RA_ICRS',dec_col='DE_ICRS',mag_col='Gmag')
+
+def get_gaia_region(ra,dec,size=0.4, magnitude_limit = 21, use_cache=True):
+	"""
+	Get the coordinates and mag of all gaia sources around the given positions.
+	Sources are served from the local tile cache, Vizier is only queried for
+	tiles that are not yet on disk.
 
 	-------
 	Inputs-
 	-------
-		tpf 				class 	target pixel file lightkurve class
+		ra 					list 	ra of the search centres (deg)
+		dec 				list 	dec of the search centres (deg)
+		size 				float 	search radius in arcsec
 		magnitude_limit 	float 	cutoff for Gaia sources
-		Offset 				int 	offset for the boundary 
+		use_cache 			bool 	query Vizier directly if False
 	
 	--------
 	Outputs-
 	--------
-		coords 	array	coordinates of sources
-		Gmag 	array 	Gmags of sources
+		result 	DataFrame 	gaia sources within size of any of the centres
 	"""
-	c1 = SkyCoord(ra, dec, unit='deg')
-	Vizier.ROW_LIMIT = -1
-
-	result = Vizier.query_region(c1, catalog=["I/345/gaia2"],
-                             		 radius=Angle(size, "arcsec"),column_filters={'Gmag':f'<{magnitude_limit}'})
-
-	keys = ['objID','RAJ2000','DEJ2000','e_RAJ2000','e_DEJ2000','gmag','e_gmag','gKmag','e_gKmag','rmag',
-			'e_rmag','rKmag','e_rKmag','imag','e_imag','iKmag','e_iKmag','zmag','e_zmag','zKmag','e_zKmag',
-			'ymag','e_ymag','yKmag','e_yKmag','tmag','gaiaid','gaiamag','gaiadist','gaiadist_u','gaiadist_l',
-			'row','col']
-
+	radius = size / 60**2
+	if use_cache & (magnitude_limit <= gaia_cache.magnitude_limit):
+		ras = np.atleast_1d(ra)
+		decs = np.atleast_1d(dec)
+		result = [gaia_cache.cone(ras[i],decs[i],radius,magnitude_limit=magnitude_limit) for i in range(len(ras))]
+		result = pd.concat(result,ignore_index=True)
+		if (len(ras) > 1) & ('Source' in result.columns):
+			result = result.drop_duplicates(subset=['Source'],ignore_index=True)
+	else:
+		result = _query_gaia_vizier(ra,dec,radius,magnitude_limit)
 
 	no_targets_found_message = ValueError('Either no sources were found in the query region '
                                           'or Vizier is unavailable')
@@ -39,9 +69,22 @@ def get_gaia_region(ra,dec,size=0.4, magnitude_limit = 21):
 	elif len(result) == 0:
 		raise no_targets_found_message
 	
-
-	result = result['I/345/gaia2'].to_pandas()
 	#result = result.rename(columns={'RA_ICRS':'ra','DE_ICRS':'dec'})
 	#account for proper motion
 	return result
 
+def populate_gaia_cache(cal_dir='cal_lists/',size=0.4*60**2):
+	"""
+	Fill the gaia tile cache for every field in the observation list, so that
+	nodes without outbound network can get the Gaia sources. The sauron PS1 and
+	SkyMapper queries are not cached.
+	"""
+	obs = read_list('obs_list',columns=['field','ra','dec'],cal_dir=cal_dir)
+	fields = obs.drop_duplicates(subset=['field'])
+	c = SkyCoord(fields['ra'].values,fields['dec'].values,unit=(u.hourangle,u.deg))
+	return gaia_cache.populate(c.ra.deg,c.dec.deg,size / 60**2)
+
+
+if __name__ == '__main__':
+	n = populate_gaia_cache()
+	print('Gaia cache holds the {} tiles covering the observed fields'.format(n))
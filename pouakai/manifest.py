@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import traceback
+
+states = ['pending','running','done','failed']
+
+
+class work_manifest():
+	"""
+	Persistent record of the units of work (e.g. one master for a (name, chip))
+	of a long running build and the state each is in: pending, running, done or
+	failed (with the error). Every state change is appended to a json lines file
+	as it happens, so after a crash the build resumes with the units that are not
+	done, and failed units can be re-run on their own.
+
+	-------
+	Inputs-
+	-------
+		name 		str 	manifest name, the file is <cal_dir>/<name>_manifest.jsonl
+		cal_dir 	str 	directory holding the manifest
+	"""
+	def __init__(self,name,cal_dir='cal_lists/'):
+		self.file = os.path.join(cal_dir,'{}_manifest.jsonl'.format(name))
+		self.units = {}
+		self._load()
+
+	def _load(self):
+		if not os.path.isfile(self.file):
+			return
+		with open(self.file) as f:
+			for line in f:
+				if line.strip() == '':
+					continue
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# a line cut short by a crash
+					continue
+				self.units[tuple(record['key'])] = record
+
+	def _write(self,records):
+		with open(self.file,'a') as f:
+			for record in records:
+				f.write(json.dumps(record) + '\n')
+			f.flush()
+
+	def _record(self,key,state,error=None):
+		if state not in states:
+			raise ValueError('state must be one of {}'.format(states))
+		record = {'key':list(key),'state':state,'error':error,'time':time.time()}
+		self.units[tuple(key)] = record
+		return record
+
+	def add(self,keys):
+		"""
+		Register units as pending, units already in the manifest are left as they are.
+		"""
+		records = [self._record(k,'pending') for k in keys if tuple(k) not in self.units]
+		self._write(records)
+		return len(records)
+
+	def set(self,key,state,error=None):
+		self._write([self._record(key,state,error)])
+
+	def state(self,key):
+		if tuple(key) not in self.units:
+			return None
+		return self.units[tuple(key)]['state']
+
+	def todo(self,retry_failed=False):
+		"""
+		Units still to be built. Units left running by an interrupted build are
+		included, failed units only if retry_failed is set.
+		"""
+		todo = ['pending','running']
+		if retry_failed:
+			todo += ['failed']
+		return [k for k, r in self.units.items() if r['state'] in todo]
+
+	def failed(self):
+		return {k:r['error'] for k, r in self.units.items() if r['state'] == 'failed'}
+
+	def summary(self):
+		counts = {s:0 for s in states}
+		for r in self.units.values():
+			counts[r['state']] += 1
+		return counts
+
+	def compact(self):
+		"""
+		Rewrite the file with only the latest state of each unit.
+		"""
+		tmp = self.file + '.{}.tmp'.format(os.getpid())
+		with open(tmp,'w') as f:
+			for record in self.units.values():
+				f.write(json.dumps(record) + '\n')
+		os.replace(tmp,self.file)
+
+
+def run_unit(func,key,*args,**kwargs):
+	"""
+	Run one unit of work, returning (key, result, error) rather than raising so a
+	single bad unit does not stop the build.
+	"""
+	try:
+		return key, func(*args,**kwargs), None
+	except Exception as e:
+		error = '{}: {}'.format(type(e).__name__,e)
+		tb = traceback.extract_tb(e.__traceback__)
+		if len(tb) > 0:
+			error += ' ({}:{})'.format(os.path.basename(tb[-1].filename),tb[-1].lineno)
+		return key, None, error
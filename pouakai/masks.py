@@ -0,0 +1,124 @@
+import os
+import numpy as np
+from scipy.ndimage import binary_dilation
+
+from master_cache import get_normalised_flat
+
+# mask bit values, the mask is stored as uint8
+SATURATION = 2
+FLAT = 4
+SATELLITE = 8
+BADPIX = 16
+
+mask_dtype = np.uint8
+
+
+def dilate(mask,buffer=3):
+	"""
+	Grow a boolean mask by a buffer x buffer box, the same pixels as convolving
+	with np.ones((buffer,buffer)) and taking the non-zero values.
+	"""
+	return binary_dilation(mask,structure=np.ones((buffer,buffer),dtype=bool))
+
+def flat_mask(norm_flat,lowlim=0.8,highlim=1.2,buffer=3):
+	"""
+	Pixels where the normalised flat is outside the limits.
+	"""
+	return dilate((norm_flat < lowlim) | (norm_flat > highlim),buffer)
+
+def saturation_mask(raw,satlimit=3.5e4,buffer=3):
+	"""
+	An agressive limit is set here to catch overflow pixels.
+	"""
+	return dilate(raw > satlimit,buffer)
+
+def bad_pixel_file(chip):
+	return f'badpix/chip{chip}_bpix.npy'
+
+def bad_pixel_mask(chip):
+	return np.load(bad_pixel_file(chip)) > 0
+
+def _static_mask(flat_file,chip):
+	mask = flat_mask(get_normalised_flat(flat_file)).view(mask_dtype) * np.uint8(FLAT)
+	mask |= bad_pixel_mask(chip).view(mask_dtype) * np.uint8(BADPIX)
+	return mask
+
+def static_mask_file(flat_file,chip):
+	"""
+	The static mask of a master flat is kept next to it as
+	<master name>_chip<chip>_mask.npy.
+	"""
+	base = flat_file
+	for ext in ['.gz','.fits']:
+		if base.endswith(ext):
+			base = base[:-len(ext)]
+	return '{}_chip{}_mask.npy'.format(base,chip)
+
+def _is_current(file,sources):
+	if not os.path.isfile(file):
+		return False
+	mtime = os.path.getmtime(file)
+	return all(os.path.getmtime(s) <= mtime for s in sources)
+
+def _save(mask,file):
+	tmp = file + '.{}.tmp'.format(os.getpid())
+	with open(tmp,'wb') as f:
+		np.save(f,mask)
+	os.replace(tmp,file)
+
+# static mask file -> (mtime, read-only memory map), or (source mtimes, array)
+# when the file could not be written, one per process
+_static = {}
+
+def get_static_mask(flat_file,chip):
+	"""
+	Mask bits that only depend on the master flat and the chip (bad flat and bad
+	pixels). They are combined once per (master flat, chip), saved next to the
+	master and served as a read-only memory map, so every worker shares the same
+	pages. The file is rebuilt when the master flat or the bad pixel map is newer.
+	"""
+	file = static_mask_file(flat_file,chip)
+	sources = [flat_file,bad_pixel_file(chip)]
+	if not _is_current(file,sources):
+		# a mask that couldn't be saved is cached against the source mtimes
+		stamp = tuple(os.path.getmtime(s) for s in sources)
+		cached = _static.get(file)
+		if (cached is not None) and (cached[0] == stamp):
+			return cached[1]
+		mask = _static_mask(flat_file,chip)
+		try:
+			_save(mask,file)
+		except OSError:
+			# can't write next to the master, keep it in memory only
+			mask.setflags(write=False)
+			_static[file] = (stamp,mask)
+			return mask
+	mtime = os.path.getmtime(file)
+	cached = _static.get(file)
+	if (cached is None) or (cached[0] != mtime):
+		cached = (mtime,np.load(file,mmap_mode='r'))
+		_static[file] = cached
+	return cached[1]
+
+def combine(static,saturation=None,satellite=None):
+	"""
+	Add the per frame saturation and satellite bits to the static mask.
+
+	-------
+	Inputs-
+	-------
+		static 		array 	uint8 static mask (bad flat and bad pixel bits)
+		saturation 	array 	boolean saturation mask
+		satellite 	array 	uint8 or boolean satellite mask
+
+	--------
+	Outputs-
+	--------
+		mask 		array 	uint8 bit mask
+	"""
+	mask = np.array(static,dtype=mask_dtype)
+	if saturation is not None:
+		np.bitwise_or(mask,SATURATION,out=mask,where=saturation > 0)
+	if satellite is not None:
+		np.bitwise_or(mask,SATELLITE,out=mask,where=satellite > 0)
+	return mask
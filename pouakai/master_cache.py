@@ -0,0 +1,126 @@
+import os
+import numpy as np
+from collections import OrderedDict
+from astropy.io import fits
+
+
+class master_cache():
+	"""
+	Process wide, size bounded LRU cache for master calibration frames.
+	Entries are keyed on the master filename and its mtime, so a master that is
+	rebuilt on disk is re-read. The cached data and err arrays are read-only.
+	Products derived from a master (e.g. the normalised flat) are cached alongside
+	it under the same (filename, mtime) prefix. The master and its products are
+	used and evicted as one group, so a product never outlives its master or the
+	other way around.
+	"""
+	def __init__(self,max_bytes=1024**3):
+		self.max_bytes = max_bytes
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self._frames = OrderedDict()
+
+	def _key(self,file):
+		file = os.path.abspath(file)
+		return (file, os.path.getmtime(file))
+
+	def _read(self,file):
+		hdu = fits.open(file)
+		data = hdu[0].data
+		err = hdu[1].data
+		hdu.close()
+		data.setflags(write=False)
+		err.setflags(write=False)
+		return data, err
+
+	def get(self,file):
+		"""
+		Return the (data, err) arrays of the master, reading it only on a miss.
+		"""
+		key = self._key(file)
+		if key in self._frames:
+			self.hits += 1
+			self._touch(key)
+			return self._frames[key]
+
+		self.misses += 1
+		frames = self._read(file)
+		self._add(key,frames)
+		return frames
+
+	def derived(self,file,name,func):
+		"""
+		Return func(data, err) of the master, computing it only once per master.
+		"""
+		key = self._key(file) + (name,)
+		if key in self._frames:
+			self.hits += 1
+			self._touch(key)
+			return self._frames[key][0]
+
+		data, err = self.get(file)
+		product = func(data,err)
+		product.setflags(write=False)
+		self._add(key,(product,))
+		return product
+
+	def _add(self,key,frames):
+		size = sum(f.nbytes for f in frames)
+		if size > self.max_bytes:
+			# too large to ever be cached, hand it straight back
+			return
+		# a rebuilt master has a new mtime, drop the stale copy
+		for old in [k for k in self._frames if (k[0] == key[0]) & (k[1] != key[1])]:
+			self._pop(old)
+		self._frames[key] = frames
+		self.nbytes += size
+		self._touch(key)
+		while self.nbytes > self.max_bytes:
+			oldest = next(iter(self._frames))
+			for old in self._group(oldest):
+				self._pop(old)
+
+	def _group(self,key):
+		"""
+		Keys of the master a key belongs to and all of its derived products.
+		"""
+		return [k for k in self._frames if k[:2] == key[:2]]
+
+	def _touch(self,key):
+		for k in self._group(key):
+			self._frames.move_to_end(k)
+
+	def _pop(self,key):
+		frames = self._frames.pop(key)
+		self.nbytes -= sum(f.nbytes for f in frames)
+
+	def clear(self):
+		self._frames.clear()
+		self.nbytes = 0
+
+	def stats(self):
+		"""
+		Summary of the cache usage.
+		"""
+		stats = {'hits':self.hits,'misses':self.misses,'entries':len(self._frames),
+				 'nbytes':self.nbytes,'max_bytes':self.max_bytes}
+		return stats
+
+
+masters = master_cache()
+
+def get_master_frames(file):
+	"""
+	Retrieve the data and err arrays of a master frame from the process cache.
+	"""
+	return masters.get(file)
+
+def _normalise_flat(data,err):
+	return (data / np.nanmedian(data)).astype(np.float32)
+
+def get_normalised_flat(file):
+	"""
+	Retrieve the median normalised master flat (float32) from the process cache.
+	"""
+	return masters.derived(file,'normalised',_normalise_flat)
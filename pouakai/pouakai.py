@@ -2,6 +2,8 @@ from core import pouakai
 from sort_images import sort_cals
 from calibration_masters import make_masters
 from joblib import Parallel, delayed
+from worker_pool import worker_pool
+from diagnostics import render_saved
 import pandas as pd
 import numpy as np
 from glob import glob
@@ -12,7 +14,9 @@ package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
 class consume_moa():
     def __init__(self,files,savepath,time_tolerence=100,dark_tolerence=10,
 				 local_astrom=True,verbose=True,rescale=True,update_cals=True,
-                 cores=10, overwrite=False,compress=True,calibrate=True,plot=True):
+                 cores=10, overwrite=False,compress=True,calibrate=True,plot=True,
+                 surface_method='full',sat_binning=1,fig_format='pdf',fig_mode='defer',
+                 use_pool=False):
         
         self.files = list(files)
         self.savepath = savepath
@@ -23,12 +27,17 @@ class consume_moa():
         self.time_tolerence = time_tolerence
         self.calibrate = calibrate
         self.compress = compress
+        self.surface_method = surface_method
+        self.sat_binning = sat_binning
         self.plot = plot
+        self.fig_format = fig_format
+        self.fig_mode = fig_mode
         
         self.local_astrom = local_astrom
         self.rescale = rescale
         
         self.cores = cores
+        self.use_pool = use_pool
         self._kill_wcs_tmp()
         #running
         if update_cals:
@@ -62,10 +71,7 @@ class consume_moa():
         print('start mem: ', process.memory_info().rss/1024**2)  # in bytes 
         
         try:
-            p = pouakai(file,time_tolerence=self.time_tolerence,
-                            dark_tolerence=self.dark_tolerence, savepath = self.savepath,
-                            local_astrom=self.local_astrom,rescale=self.rescale,verbose=self.verbose,
-                            calibrate=self.calibrate,plot=self.plot)
+            p = pouakai(file,**self._options())
             from ctypes import cdll, CDLL
             cdll.LoadLibrary('libc.so.6')
             libc = CDLL('libc.so.6')
@@ -83,7 +89,7 @@ class consume_moa():
             anum = []
             for file in self.files:
                 anum += [file.split('/')[-1].split('.')[0]]
-            done = glob(self.savepath + 'cal/*.gz')
+            done = glob(self.savepath + 'cal/*_cal.fits*')
             dnum =  []
             for file in done:
                 dnum += [file.split('/')[-1].split('_')[0]]
@@ -127,8 +133,32 @@ class consume_moa():
         self.log.to_csv(package_directory + 'cal_lists/calibrated_image_list.csv',index=False)
         os.system(f'rm -rf {self.savepath}log/*.csv')
 
+    def _options(self):
+        options = {'time_tolerence':self.time_tolerence,'dark_tolerence':self.dark_tolerence,
+                   'savepath':self.savepath,'local_astrom':self.local_astrom,
+                   'rescale':self.rescale,'verbose':self.verbose,'calibrate':self.calibrate,
+                   'plot':self.plot,'compress':self.compress,'surface_method':self.surface_method,
+                   'sat_binning':self.sat_binning,'fig_format':self.fig_format,
+                   'fig_mode':self.fig_mode}
+        return options
+
+    def _render_figures(self):
+        # the reductions only saved the figure products, draw them now
+        done = render_saved(self.savepath + 'fig/',fmt=self.fig_format,cores=self.cores)
+        if self.verbose:
+            print('Rendered {} diagnostic figures'.format(len(done)))
+
+    def _run_pool(self):
+        pool = worker_pool(self.cores,**self._options())
+        try:
+            pool.run(self.files,verbose=self.verbose)
+        finally:
+            pool.close()
+
     def digest(self):
-        if (self.cores > 1) & (len(self.files) > 1):
+        if self.use_pool & (self.cores > 1) & (len(self.files) > 1):
+            self._run_pool()
+        elif (self.cores > 1) & (len(self.files) > 1):
             Parallel(self.cores)(delayed(self._run_func)(file) for file in self.files)
         else:
             for i in range(len(self.files)):
@@ -138,5 +168,8 @@ class consume_moa():
 
         self._update_log()
 
+        if self.plot & (self.fig_mode == 'defer'):
+            self._render_figures()
+
         #if self.compress:
          #   self._compress()
\ No newline at end of file
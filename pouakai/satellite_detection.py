@@ -2,9 +2,38 @@ import numpy as np
 import cv2
 from copy import deepcopy
 from astropy.stats import sigma_clipped_stats
+
+# one record per streak in the mask, endpoints and width in pixels
+streak_dtype = [('angle','f4'),('x1','i4'),('y1','i4'),('x2','i4'),('y2','i4'),('width','i2')]
+
+def block_mean(image,binning):
+    """
+    Mean of binning x binning blocks, trailing rows/columns that don't fill a
+    block are dropped.
+    """
+    ny = (image.shape[0] // binning) * binning
+    nx = (image.shape[1] // binning) * binning
+    blocks = image[:ny,:nx].reshape(ny // binning,binning,nx // binning,binning)
+    return blocks.mean(axis=(1,3))
+
+
 class sat_streaks():
-    def __init__(self,image,thickness=17,sigma=15,angle_tol=5,run=True) -> None:
-        self.image = image - np.nanmedian(image)
+    """
+    Find satellite streaks with a Hough transform of the thresholded image.
+
+    With binning > 1 candidate streaks are found on a block binned copy of the
+    image and their endpoints are then refined at full resolution in a narrow
+    strip around each candidate, so only the strips are searched at full
+    resolution. gray, edges and the Hough lines are then for the binned image,
+    self.lines is always in full resolution pixels.
+    """
+    def __init__(self,image,thickness=17,sigma=15,angle_tol=5,binning=1,run=True) -> None:
+        self.binning = int(binning)
+        if self.binning > 1:
+            self.image = image - np.nanmedian(image[::self.binning,::self.binning])
+            self.binned = block_mean(self.image,self.binning)
+        else:
+            self.image = image - np.nanmedian(image)
         self._set_threshold(sigma)
         self.thickness = thickness
         self.angle_tol = angle_tol
@@ -13,13 +42,22 @@ class sat_streaks():
             self._dilate()
             self._edges()
             self._lines()
+            if self.binning > 1:
+                self._refine_lines()
             self._consolidate_lines()
             self.make_mask()
             self._detected()
 
 
     def _set_threshold(self,sigma):
-        mean, med, std = sigma_clipped_stats(self.image)
+        if self.binning > 1:
+            # detection threshold for the binned image and a full resolution
+            # threshold from a subsample for the refinement
+            mean, med, std = sigma_clipped_stats(self.binned)
+            self.binned_threshold = mean + sigma*std
+            mean, med, std = sigma_clipped_stats(self.image[::self.binning,::self.binning])
+        else:
+            mean, med, std = sigma_clipped_stats(self.image)
         self.threshold = mean + sigma*std
 
     def _detected(self):
@@ -31,11 +69,18 @@ class sat_streaks():
 
     def _dilate(self):
         # set all values below the threshold to zero
-        arr = deepcopy(self.image)
-        arr[arr < self.threshold] = 0
+        if self.binning > 1:
+            arr = deepcopy(self.binned)
+            arr[arr < self.binned_threshold] = 0
+            # keep the kernel about the same size on the sky
+            size = max(3,(9 // self.binning) | 1)
+        else:
+            arr = deepcopy(self.image)
+            arr[arr < self.threshold] = 0
+            size = 9
 
         # create a structuring element for morphological dilation
-        kernel = np.ones((9, 9))
+        kernel = np.ones((size, size))
 
         # dilate the array
         dilated = cv2.dilate(arr, kernel, iterations=1)
@@ -52,15 +97,19 @@ class sat_streaks():
         self.edges = cv2.Canny(self.gray, low_threshold, high_threshold)
 
     def _lines(self):
+        # votes and lengths are in pixels of the (binned) edge image
+        b = self.binning
         lines = cv2.HoughLinesP(
                                 self.edges, # Input edge image
                                 1, # Distance resolution in pixels
                                 np.pi/180, # Angle resolution in radians
-                                threshold=100, # Min number of votes for valid line
-                                minLineLength=200, # Min allowed length of line
-                                maxLineGap=50 # Max allowed gap between line for joining them
+                                threshold=max(100 // b,10), # Min number of votes for valid line
+                                minLineLength=200 // b, # Min allowed length of line
+                                maxLineGap=50 // b # Max allowed gap between line for joining them
                                 )
         if lines is not None:
+            # opencv 4 returns (N,1,4), opencv 5 (N,4)
+            lines = lines.reshape(-1,1,4)
             good = []
             for i in range(len(lines)):
                 line = lines[i]
@@ -75,6 +124,94 @@ class sat_streaks():
         else:
             self.lines = []
 
+    def _refine_lines(self,width=None,margin=None,level=0.25):
+        """
+        Scale the candidate lines from the binned image to full resolution and
+        refine each one in a strip along it. The median across track profile of
+        the strip gives the offset of the streak from the candidate (Hough lines
+        follow the edges of the dilated streak) and candidates without a ridge,
+        e.g. chains of stars, are dropped. The endpoints are where the along
+        track signal on the ridge, smoothed over a binned pixel, drops below the
+        same level.
+
+        -------
+        Inputs-
+        -------
+            width   int     half width of the strip, default 3 binned pixels
+            margin  int     how far past the candidate endpoints to search,
+                            default 2 binned pixels
+            level   float   fraction of the full resolution threshold the ridge
+                            and the along track signal have to reach
+        """
+        b = self.binning
+        if width is None:
+            width = 3 * b
+        if margin is None:
+            margin = 2 * b
+        ny, nx = self.image.shape
+        refined = []
+        for line in self.lines:
+            # centre of the binned pixels in full resolution coordinates
+            x1, y1, x2, y2 = line[0] * b + (b - 1) / 2
+            length = np.hypot(x2 - x1, y2 - y1)
+            if length == 0:
+                continue
+            ux, uy = (x2 - x1) / length, (y2 - y1) / length
+            t = np.arange(-margin, length + margin + 1)
+            o = np.arange(-width, width + 1)
+            xs = np.rint(x1 + t[:,None] * ux - o[None,:] * uy).astype(int)
+            ys = np.rint(y1 + t[:,None] * uy + o[None,:] * ux).astype(int)
+            inside = (xs >= 0) & (xs < nx) & (ys >= 0) & (ys < ny)
+            strip = np.full(xs.shape, np.nan)
+            strip[inside] = self.image[ys[inside], xs[inside]]
+
+            core = (t >= 0) & (t <= length)
+            if not np.isfinite(strip[core]).any():
+                continue
+            profile = np.nanmedian(strip[core], axis=0)
+            centre = np.nanargmax(profile)
+            if profile[centre] < level * self.threshold:
+                continue
+
+            ridge = np.nanmean(strip[:, max(centre - 1,0):centre + 2], axis=1)
+            ridge = np.convolve(np.nan_to_num(ridge), np.ones(b) / b, mode='same')
+            above = np.where(ridge > level * self.threshold)[0]
+            if len(above) == 0:
+                continue
+            ends = t[[above[0], above[-1]]]
+            offset = o[centre]
+            ex = x1 + ends * ux - offset * uy
+            ey = y1 + ends * uy + offset * ux
+            refined = self._merge_line(refined, ex, ey, width)
+        if len(refined) > 0:
+            self.lines = np.rint(np.array(refined)).astype(np.int32)[:,None,:]
+        else:
+            self.lines = []
+
+    def _merge_line(self,lines,ex,ey,width):
+        """
+        Add a refined line to lines, merging it into an existing line when both
+        of its endpoints are within width of it and the angles agree to within
+        angle_tol, as the Hough lines from both edges of a streak refine to the
+        same ridge.
+        """
+        angle = np.arctan2(ey[1] - ey[0], ex[1] - ex[0]) * 180 / np.pi
+        for i, (x1, y1, x2, y2) in enumerate(lines):
+            diff = (angle - np.arctan2(y2 - y1, x2 - x1) * 180 / np.pi + 90) % 180 - 90
+            if abs(diff) >= self.angle_tol:
+                continue
+            length = np.hypot(x2 - x1, y2 - y1)
+            ux, uy = (x2 - x1) / length, (y2 - y1) / length
+            along = (ex - x1) * ux + (ey - y1) * uy
+            across = -(ex - x1) * uy + (ey - y1) * ux
+            if np.max(np.abs(across)) > width:
+                continue
+            start = min(0, np.min(along))
+            end = max(length, np.max(along))
+            lines[i] = [x1 + start * ux, y1 + start * uy, x1 + end * ux, y1 + end * uy]
+            return lines
+        return lines + [[ex[0], ey[0], ex[1], ey[1]]]
+
     def _consolidate_lines(self):
         angle_tolerance = self.angle_tol
         # create an empty list to store the consolidated lines
@@ -102,13 +239,16 @@ class sat_streaks():
     
 
     def make_mask(self,thickness=None):
+        """
+        Draw the consolidated lines into a single uint8 mask (1 on a streak) and
+        keep the fitted streaks as records of (angle, x1, y1, x2, y2, width).
+        """
         if thickness is None:
             thickness = self.thickness
-        # create a black image with the same size as the input image
-        mask = np.zeros_like(self.image)
+        mask = np.zeros(self.image.shape, dtype=np.uint8)
 
         # loop through the consolidated lines
-        sat_mask = []
+        streaks = []
         for consolidated_line in self.consolidated_lines:
             angle = consolidated_line[0]
             points = np.array(consolidated_line[1])
@@ -117,25 +257,13 @@ class sat_streaks():
             coefs = np.polyfit(x, y, 1)
             slope = coefs[0]
             intercept = coefs[1]
-            x1 = np.min(x)
-            xx = np.arange(np.min(x),np.max(x))
+            x1 = int(np.min(x))
             y1 = int(slope * x1 + intercept)
-            x2 = np.max(x)
+            x2 = int(np.max(x))
             y2 = int(slope * x2 + intercept)
-            yy = (slope * xx + intercept).astype(int)
-            # Draw the line on the black image using cv2.line
-            tmp = cv2.line(mask, (x1, y1), (x2, y2), (255, 255, 255), thickness=thickness)
-            tmp[tmp > 0] = 1
-            sat_mask += [tmp]
-
-        # The pixels that are covered by the line will have a value of 8 in the mask
-        # You can use this mask to extract the pixels that belong to the lines
-        sat_mask = np.array(sat_mask).astype(int)
-        if len(sat_mask) == 0:
-            sat_mask = mask
-        
-        self.mask = sat_mask
+            # Draw the line on the mask using cv2.line
+            cv2.line(mask, (x1, y1), (x2, y2), 1, thickness=thickness)
+            streaks += [(angle, x1, y1, x2, y2, thickness)]
 
-        tmp = np.nansum(self.mask,axis=0)
-        tmp[tmp > 0] = 1
-        self.total_mask = tmp.astype(int)
\ No newline at end of file
+        self.streaks = np.array(streaks, dtype=streak_dtype)
+        self.total_mask = mask
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+from calibrimbore import sauron
+
+package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+
+class sauron_registry():
+	"""
+	Process wide store of the calibrimbore sauron models in cal_files/. There is
+	one model per band, survey and spectral model, so each is only built once.
+	Calling preload before forking workers lets them share the loaded models.
+	"""
+	def __init__(self,cal_dir=package_directory + 'cal_files/'):
+		self.cal_dir = cal_dir
+		self._models = {}
+		self.loads = 0
+
+	def fname(self,band,system,model):
+		return self.cal_dir + 'MOA-{filt}_{sys}_{model}.npy'.format(filt=band,sys=system,model=model)
+
+	def get(self,band,system,model):
+		"""
+		Return the sauron model for the band, survey (ps1 or skymapper) and model.
+		"""
+		key = (band,system,model.lower())
+		if key not in self._models:
+			self._models[key] = sauron(load_state = self.fname(*key))
+			self.loads += 1
+		return self._models[key]
+
+	def preload(self,bands=['R','V'],systems=['ps1','skymapper'],models=['ckmodel','calspec']):
+		"""
+		Load every available model combination.
+		"""
+		for band in bands:
+			for system in systems:
+				for model in models:
+					if os.path.isfile(self.fname(band,system,model)):
+						self.get(band,system,model)
+		return len(self._models)
+
+	def estimate_mags(self,band,system,model,ras,decs,close=True):
+		"""
+		Predict magnitudes for the sources of many images in a single model call.
+
+		-------
+		Inputs-
+		-------
+			ras 	list 	arrays of source ra, one per image
+			decs 	list 	arrays of source dec, one per image
+
+		--------
+		Outputs-
+		--------
+			mags 		list 	predicted magnitudes, one array per image
+			cat_mags 	list 	catalogue magnitudes used for each image
+		"""
+		model = self.get(band,system,model)
+		lengths = [len(r) for r in ras]
+		edges = np.cumsum([0] + lengths)
+		mags = model.estimate_mag(ra=np.concatenate(ras),dec=np.concatenate(decs),close=close)
+		mags = [mags[edges[i]:edges[i+1]] for i in range(len(lengths))]
+
+		cat = getattr(model,'cat_mags',None)
+		if cat is None:
+			cat_mags = [None] * len(lengths)
+		else:
+			cat_mags = [cat.iloc[edges[i]:edges[i+1]].reset_index(drop=True) for i in range(len(lengths))]
+		return mags, cat_mags
+
+
+models = sauron_registry()
@@ -9,6 +9,10 @@ import astropy.units as u
 from astropy.time import Time
 
 import os 
+import time
+from archive_index import archive_index, read_header, read_header_sample, report_rate
+from cal_writer import cal_list_writer
+from cal_store import read_list, write_list, FLAG_OK, FLAG_BAD_HEADER, INT_SENTINEL
 package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
 
 
@@ -24,7 +28,7 @@ def _update_paths(files,csv,cal_type):
 		if csv.iloc[ind]['filename'].values != file:
 			print('!!!! Changing path ' + name)
 			csv.iloc[ind]['filename'] = file
-	csv.to_csv(package_directory + 'cal_lists/{}_list.csv'.format(cal_type),index=False)
+	write_list(csv,'{}_list'.format(cal_type),package_directory + 'cal_lists/')
 	return csv
 def _kill_old_paths(csv,cal_type):
 	ind = []
@@ -35,14 +39,15 @@ def _kill_old_paths(csv,cal_type):
 		except:
 			print('bad path')
 	csv_new = csv.iloc[ind]
-	csv_new.to_csv(package_directory + 'cal_lists/{}_list.csv'.format(cal_type),index=False)
+	write_list(csv_new,'{}_list'.format(cal_type),package_directory + 'cal_lists/')
 	return csv_new
 
 def sort_darks(verbose=False,num_core=25):
-	f = np.append(glob(moa_darks_dir + '*/*.gz'),glob(moa_darks_dir + '*.gz')) # first for year sudbdir, second for file
-
-	dark_files = set(f) 
-	dark_list = pd.read_csv(package_directory + 'cal_lists/dark_list.csv')
+	index = archive_index(moa_darks_dir,'dark_archive')
+	dark_files, _ = index.scan(verbose)
+	dark_files = set(dark_files)
+	writer = cal_list_writer('dark_list',key='filename',cal_dir=package_directory + 'cal_lists/')
+	dark_list = read_list('dark_list',columns=['filename'],cal_dir=package_directory + 'cal_lists/')
 	#dark_list = _kill_old_paths(dark_list,'dark')
 	old = set(dark_list['filename'])
 	new = dark_files - old
@@ -50,10 +55,14 @@ def sort_darks(verbose=False,num_core=25):
 		print('Number of new darks: ',len(new))
 	files = list(new)
 	if len(files) > 0:
-		entries = Parallel(num_core)(delayed(dark_info_grab)(file,verbose) for file in files)
+		start = time.time()
+		entries = Parallel(num_core,return_as='generator_unordered')(delayed(dark_info_grab)(file,verbose) for file in files)
 		for entry in entries:
-			dark_list = dark_list.append(entry, ignore_index=True)
-		dark_list.to_csv(package_directory + 'cal_lists/dark_list.csv',index=False)
+			writer.add(entry)
+		writer.commit()
+		if verbose:
+			report_rate('darks',len(files),start)
+	index.save()
 	if verbose:
 		print('Updated darks')
 
@@ -63,18 +72,20 @@ def dark_info_grab(file,verbose = True):
 	name = file.split('/')[-1].split('.')[0]
 	entry['name'] = name
 	try:
-		header = fits.open(file)[0].header
+		header = read_header(file)
 
 		entry['chip'] = header['CHIP']
 		entry['exptime'] = header['EXPTIME']
 		entry['jd'] = header['JDSTART']
 		entry['date'] = header['DATE-OBS'].strip()
+		entry['flag'] = FLAG_OK
 	except:
 		print('!!! bad ',file)
-		entry['chip'] = 'bad'
-		entry['exptime'] = 'bad'
-		entry['jd'] = 'bad'
-		entry['date'] = 'bad'
+		entry['chip'] = INT_SENTINEL
+		entry['exptime'] = np.nan
+		entry['jd'] = np.nan
+		entry['date'] = ''
+		entry['flag'] = FLAG_BAD_HEADER
 	
 	entry['filename'] = file
 	if verbose:
@@ -87,10 +98,12 @@ def dark_info_grab(file,verbose = True):
 
 def sort_flats(verbose = False, num_core = 25):
 
-	f = np.append(glob(moa_flats_dir + '*/*.gz'),glob(moa_flats_dir + '*.gz')) # first for year sudbdir, second for file
-	flat_files = set(f)
+	index = archive_index(moa_flats_dir,'flat_archive')
+	flat_files, _ = index.scan(verbose)
+	flat_files = set(flat_files)
 
-	flat_list = pd.read_csv(package_directory + 'cal_lists/flat_list.csv')	
+	writer = cal_list_writer('flat_list',key='filename',cal_dir=package_directory + 'cal_lists/')
+	flat_list = read_list('flat_list',columns=['filename'],cal_dir=package_directory + 'cal_lists/')	
 	#flat_list = _kill_old_paths(flat_list,'flat')
 	old = set(flat_list['filename'])
 	new = flat_files - old
@@ -99,10 +112,14 @@ def sort_flats(verbose = False, num_core = 25):
 		print('Number of new flats: ',len(new))
 	files = list(new)
 	if len(files) > 0:
-		entries = Parallel(num_core)(delayed(flat_info_grab)(file,verbose) for file in files)
+		start = time.time()
+		entries = Parallel(num_core,return_as='generator_unordered')(delayed(flat_info_grab)(file,verbose) for file in files)
 		for entry in entries:
-			flat_list = flat_list.append(entry, ignore_index=True)
-		flat_list.to_csv(package_directory + 'cal_lists/flat_list.csv',index=False)
+			writer.add(entry)
+		writer.commit()
+		if verbose:
+			report_rate('flats',len(files),start)
+	index.save()
 	if verbose:
 		print('Updated flats')
 
@@ -110,25 +127,36 @@ def sort_flats(verbose = False, num_core = 25):
 def flat_info_grab(file,verbose=False):
 
 	name = file.split('/')[-1].split('.')[0]
-	hdu = fits.open(file)[0]
-	header = hdu.header
-	data = hdu.data
-	average = np.nanmedian(data)
-	if average < 18000:
-		note = 'lower'
-	elif average > 45000:
-		note = 'over'
-	else:
-		note = 'good'
-
 	entry = {}
 	entry['name'] = name
-	entry['band'] = header['COLOUR'].strip()
-	entry['chip'] = header['CHIP']
-	entry['exptime'] = header['EXPTIME']
-	entry['jd'] = header['JDSTART']
-	entry['date'] = header['DATE-OBS'].strip()
-	entry['field'] = header['FIELD'].strip()
+	try:
+		# the flat level only needs a subsample of the pixels
+		header, sample = read_header_sample(file)
+		average = np.nanmedian(sample)
+		if average < 18000:
+			note = 'lower'
+		elif average > 45000:
+			note = 'over'
+		else:
+			note = 'good'
+
+		entry['band'] = header['COLOUR'].strip()
+		entry['chip'] = header['CHIP']
+		entry['exptime'] = header['EXPTIME']
+		entry['jd'] = header['JDSTART']
+		entry['date'] = header['DATE-OBS'].strip()
+		entry['field'] = header['FIELD'].strip()
+		entry['flag'] = FLAG_OK
+	except:
+		print('!!! bad ',file)
+		note = 'bad'
+		entry['band'] = ''
+		entry['chip'] = INT_SENTINEL
+		entry['exptime'] = np.nan
+		entry['jd'] = np.nan
+		entry['date'] = ''
+		entry['field'] = ''
+		entry['flag'] = FLAG_BAD_HEADER
 	entry['filename'] = file
 	entry['note'] = note
 	if verbose:
@@ -137,21 +165,27 @@ def flat_info_grab(file,verbose=False):
 	return df
 
 def sort_obs(verbose=False,num_core = 25):
-	f = np.append(glob(moa_obs_dir + '*/*.gz'),glob(moa_obs_dir + '*.gz')) # first for year sudbdir, second for file
-	obs_files = set(f)
+	index = archive_index(moa_obs_dir,'obs_archive')
+	obs_files, _ = index.scan(verbose)
+	obs_files = set(obs_files)
 	#try:
-	obs_list = pd.read_csv(package_directory + 'cal_lists/obs_list.csv')
+	writer = cal_list_writer('obs_list',key='filename',cal_dir=package_directory + 'cal_lists/')
+	obs_list = read_list('obs_list',columns=['filename'],cal_dir=package_directory + 'cal_lists/')
 	old = set(obs_list['filename'].values)
 	new = obs_files - old
 	if verbose: 
 		print('Number of new obs: ',len(new))
 	files = list(new)
 	if len(files) > 0:
-		entries = Parallel(num_core)(delayed(dark_info_grab)(file,verbose) for file in files)
+		start = time.time()
+		entries = Parallel(num_core,return_as='generator_unordered')(delayed(obs_grab_info)(file,verbose) for file in files)
 		for entry in entries:
-			if len(entry) > 0:
-				obs_list = obs_list.append(entry, ignore_index=True)
-		obs_list.to_csv(package_directory + 'cal_lists/obs_list.csv',index=False)
+			if entry is not None:
+				writer.add(entry)
+		writer.commit()
+		if verbose:
+			report_rate('obs',len(files),start)
+	index.save()
 	if verbose:
 		print('Updated obs')
 
@@ -163,40 +197,41 @@ def obs_grab_info(file,verbose=False):
 	if type(file) == str:
 		name = file.split('/')[-1].split('.')[0]
 		entry['name'] = name.strip()
-		#try:
-		header = fits.open(file)[0].header
-		print(header['FIELD'])
-		entry['field'] = header['FIELD'].strip()
-		entry['chip'] = header['CHIP']
-		entry['band'] = header['COLOUR']
-		entry['exptime'] = header['EXPTIME']
-		entry['jd'] = header['JDSTART']
-		entry['date'] = header['DATE-OBS'].strip()
-		
-		ra = header['RA'].strip()
-		dec = header['DEC'].strip()
-		c = SkyCoord(ra,dec,unit=(u.hourangle,u.deg))
-		t = Time(header['JDSTART'],format='jd')
-		moon = get_moon(t)
-		sep = moon.separation(c)
-		entry['ra'] = ra
-		entry['dec'] = dec
-		entry['moon_sep'] = sep.deg
-		entry['sky'] = np.nanmedian(fits.open(file)[0].data)
+		try:
+			header, sample = read_header_sample(file)
+			entry['field'] = header['FIELD'].strip()
+			entry['chip'] = header['CHIP']
+			entry['band'] = header['COLOUR']
+			entry['exptime'] = header['EXPTIME']
+			entry['jd'] = header['JDSTART']
+			entry['date'] = header['DATE-OBS'].strip()
+			
+			ra = header['RA'].strip()
+			dec = header['DEC'].strip()
+			c = SkyCoord(ra,dec,unit=(u.hourangle,u.deg))
+			t = Time(header['JDSTART'],format='jd')
+			moon = get_moon(t)
+			sep = moon.separation(c)
+			entry['ra'] = ra
+			entry['dec'] = dec
+			entry['moon_sep'] = sep.deg
+			entry['sky'] = np.nanmedian(sample)
+			entry['flag'] = FLAG_OK
+		except:
+			print('!!! bad ',file)
+			entry['field'] = ''
+			entry['chip'] = INT_SENTINEL
+			entry['band'] = ''
+			entry['exptime'] = np.nan
+			entry['jd'] = np.nan
+			entry['date'] = ''
+			entry['ra'] = ''
+			entry['dec'] = ''
+			entry['moon_sep'] = np.nan
+			entry['sky'] = np.nan
+			entry['flag'] = FLAG_BAD_HEADER
 
 		entry['filename'] = file
-		'''except:
-			entry['field'] = 'bad'
-			entry['chip'] = 'bad'
-			entry['exptime'] = 'bad'
-			entry['jd'] = 'bad'
-			entry['date'] = 'bad'
-			entry['ra'] = 'bad'
-			entry['dec'] = 'bad'
-			entry['moon_sep'] = 'bad'
-			entry['sky'] = 'bad'
-
-			entry['filename'] = file'''
 		
 		if verbose:
 			print('Done ', name)
@@ -0,0 +1,60 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.ndimage import binary_dilation
+
+
+class mask_index():
+	"""
+	KD-tree over the masked pixels of an image, so the distance from sources to the
+	nearest masked pixel (or the number of masked pixels around them) is found in
+	O(N log M) instead of through an (N sources x M pixels) distance matrix.
+	Pixel positions are (x, y) = (column, row).
+	"""
+	def __init__(self,mask,buffer=0):
+		mask = np.asarray(mask) > 0
+		if buffer > 1:
+			mask = binary_dilation(mask,structure=np.ones((buffer,buffer),dtype=bool))
+		rows, cols = np.nonzero(mask)
+		self.npix = len(rows)
+		if self.npix > 0:
+			self.tree = cKDTree(np.array([cols,rows]).T)
+		else:
+			self.tree = None
+
+	def nearest(self,x,y):
+		"""
+		Distance from each position to the nearest masked pixel (inf if none).
+		"""
+		x = np.asarray(x,dtype=float)
+		if self.tree is None:
+			return np.full(len(x),np.inf)
+		d, _ = self.tree.query(np.array([x,np.asarray(y,dtype=float)]).T)
+		return d
+
+	def count_within(self,x,y,r):
+		"""
+		Number of masked pixels within r of each position. Non-finite radii give 0.
+		"""
+		x = np.asarray(x,dtype=float)
+		r = np.broadcast_to(np.asarray(r,dtype=float),x.shape)
+		good = np.isfinite(r) & (r >= 0)
+		counts = np.zeros(len(x),dtype=int)
+		if (self.tree is None) | (~good.any()):
+			return counts
+		pos = np.array([x,np.asarray(y,dtype=float)]).T[good]
+		counts[good] = self.tree.query_ball_point(pos,r[good],return_length=True)
+		return counts
+
+
+def close_neighbours(x,y,limit):
+	"""
+	Flag positions that have another (non coincident) position closer than limit.
+	"""
+	pos = np.array([x,y],dtype=float).T
+	if len(pos) == 0:
+		return np.zeros(0,dtype=bool)
+	tree = cKDTree(pos)
+	# coincident positions (including each point itself) are not neighbours
+	within = tree.query_ball_point(pos,np.nextafter(limit,0),return_length=True)
+	same = tree.query_ball_point(pos,0,return_length=True)
+	return (within - same) > 0
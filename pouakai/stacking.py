@@ -0,0 +1,96 @@
+import os
+import tempfile
+import numpy as np
+
+
+reducers = {'median':np.nanmedian,
+			'mean':np.nanmean,
+			'std':np.nanstd}
+
+def _allocate(shape,dtype,memory_budget,tmp_dir=None):
+	"""
+	Empty stack, in memory if it fits the budget, otherwise disk backed. Returns
+	the stack and the temporary file behind it (None in memory).
+	"""
+	# reductions copy the tile, so the stack needs room for itself twice
+	if 2 * np.prod(shape) * dtype.itemsize <= memory_budget:
+		return np.empty(shape,dtype=dtype), None
+	tmp = tempfile.NamedTemporaryFile(dir=tmp_dir,suffix='_stack.dat',delete=False)
+	return np.memmap(tmp,dtype=dtype,mode='w+',shape=shape), tmp
+
+def _release(tmp):
+	if tmp is not None:
+		tmp.close()
+		os.remove(tmp.name)
+
+def stack_frames(items,loader,combine=('median','std'),memory_budget=1024**3,dtype=None,tmp_dir=None):
+	"""
+	Combine a set of frames pixel by pixel without holding every frame in memory.
+
+	Each frame is read with loader(item) and spilled into a disk backed stack when
+	the stack does not fit within memory_budget (bytes). The combinations are then
+	evaluated in row tiles sized to the budget. The per pixel reductions are the same
+	as on the full (N, ny, nx) array, so the output matches the in memory result.
+
+	-------
+	Inputs-
+	-------
+		items 			list 	items passed to loader, one per frame
+		loader 			func 	returns the 2d frame for an item
+		combine 		list 	any of 'median', 'mean', 'std'
+		memory_budget 	int 	bytes available to the stack and tile temporaries
+		dtype 			str 	stack dtype, defaults to np.result_type of all the frames
+		tmp_dir 		str 	location for the disk backed stack
+
+	--------
+	Outputs-
+	--------
+		combined 	list 	2d arrays in the order given by combine
+	"""
+	items = list(items)
+	if len(items) == 0:
+		raise ValueError('No frames to stack')
+	for c in combine:
+		if c not in reducers:
+			raise ValueError('Unknown combination {}, options are {}'.format(c,list(reducers)))
+
+	first = np.asarray(loader(items[0]))
+	fixed = dtype is not None
+	dtype = np.dtype(dtype) if fixed else first.dtype
+	n = len(items)
+	ny, nx = first.shape
+
+	stack, tmp = _allocate((n,ny,nx),dtype,memory_budget,tmp_dir)
+	try:
+		stack[0] = first
+		del first
+		for i in range(1,n):
+			frame = np.asarray(loader(items[i]))
+			if (not fixed) and (not np.can_cast(frame.dtype,dtype,'safe')):
+				# a later frame needs a wider dtype, e.g. a float frame after int16
+				# ones, move the frames read so far to a wider stack
+				dtype = np.result_type(dtype,frame.dtype)
+				wider, wider_tmp = _allocate((n,ny,nx),dtype,memory_budget,tmp_dir)
+				wider[:i] = stack[:i]
+				del stack
+				_release(tmp)
+				stack, tmp = wider, wider_tmp
+			stack[i] = frame
+			del frame
+
+		combined = [None] * len(combine)
+		rows = int(memory_budget // (2 * n * nx * dtype.itemsize))
+		rows = min(max(rows,1),ny)
+		for y0 in range(0,ny,rows):
+			tile = np.asarray(stack[:,y0:y0+rows])
+			for i, c in enumerate(combine):
+				result = reducers[c](tile,axis=0)
+				if combined[i] is None:
+					combined[i] = np.empty((ny,nx),dtype=result.dtype)
+				combined[i][y0:y0+rows] = result
+			del tile
+	finally:
+		del stack
+		_release(tmp)
+
+	return combined
@@ -0,0 +1,185 @@
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+from gaia_query import get_gaia_region
+
+
+class wcs_cache():
+	"""
+	Keep the last blind solved WCS for each (field, chip) so new frames of the
+	same pointing can be verified and refined against it instead of blind solved.
+	Alongside each solution the Gaia stars in its footprint, fainter than
+	bright_limit so they aren't saturated, are kept as the reference catalogue for
+	the cross match. Refined solutions are never stored,
+	every refine starts from the blind solution and the catalogue positions, so
+	errors can't build up from frame to frame.
+	"""
+	def __init__(self,nref=60,min_matches=15,match_radius=3,max_shift=300,max_rms=1,
+				 catalogue=None,size=0.4*60**2,bright_limit=12):
+		self.nref = nref
+		self.size = size
+		self.bright_limit = bright_limit
+		self.min_matches = min_matches
+		self.match_radius = match_radius
+		self.max_shift = max_shift
+		self.max_rms = max_rms
+		self.catalogue = catalogue
+		self.solutions = {}
+		self.hits = 0
+		self.misses = 0
+
+	def _reference(self,wcs,shape,jd=None):
+		"""
+		Sky positions of the brightest unsaturated catalogue stars inside the frame,
+		moved to the epoch of the frame, or None if the catalogue can't be reached.
+		The cone is the one the photometry asks for, so with the Gaia tile cache it
+		is read from disk and only goes to Vizier the first time a field is seen.
+		"""
+		if self.catalogue is None:
+			return None
+		ny, nx = shape
+		ra, dec = wcs.all_pix2world(nx / 2,ny / 2,0)
+		try:
+			cat = self.catalogue([ra],[dec],size=self.size)
+		except Exception:
+			return None
+		cat = cat.iloc[cat['Gmag'].values > self.bright_limit].sort_values('Gmag')
+		px, py = wcs.all_world2pix(cat['RA_ICRS'].values,cat['DE_ICRS'].values,0)
+		inside = (px >= 0) & (px < nx) & (py >= 0) & (py < ny)
+		if inside.sum() < self.min_matches:
+			return None
+		cat = cat.iloc[inside][:self.nref]
+		ra = cat['RA_ICRS'].values
+		dec = cat['DE_ICRS'].values
+		if (jd is not None) & ('pmRA' in cat.columns):
+			# stars without a proper motion are left where they are
+			pmra = np.nan_to_num(cat['pmRA'].values.astype(float))
+			pmde = np.nan_to_num(cat['pmDE'].values.astype(float))
+			c = SkyCoord(ra=ra*u.deg,dec=dec*u.deg,pm_ra_cosdec=pmra*u.mas/u.yr,pm_dec=pmde*u.mas/u.yr,
+						 obstime=Time(2016,format='jyear'))
+			c = c.apply_space_motion(new_obstime=Time(jd,format='jd'))
+			ra, dec = c.ra.deg, c.dec.deg
+		return ra, dec
+
+	def store(self,key,wcs_header,shape,x,y,jd=None):
+		"""
+		Save a blind solved solution with its reference stars: the Gaia stars in the
+		frame at the epoch jd, or if the catalogue is unavailable the sky positions
+		of the brightest sources (x, y are 0-indexed pixel positions sorted
+		brightest first) from this solution.
+		"""
+		wcs = WCS(wcs_header)
+		reference = self._reference(wcs,shape,jd)
+		if reference is None:
+			x = np.asarray(x)[:self.nref]
+			y = np.asarray(y)[:self.nref]
+			reference = wcs.all_pix2world(x,y,0)
+		ra, dec = reference
+		self.solutions[key] = {'header':wcs_header.copy(),'ra':ra,'dec':dec}
+
+	def refine(self,key,x,y):
+		"""
+		Cross match the reference stars of the cached solution to the sources of a
+		new frame and fit a shift and rotation. Returns the updated WCS header, or
+		None if there is no cached solution or the match is not good enough.
+		"""
+		if key not in self.solutions:
+			self.misses += 1
+			return None
+		solution = self.solutions[key]
+		header = solution['header']
+		px, py = WCS(header).all_world2pix(solution['ra'],solution['dec'],0)
+		ref = np.array([px,py]).T
+		new = np.array([np.asarray(x)[:3*self.nref],np.asarray(y)[:3*self.nref]]).T
+
+		fit = self._match(ref,new)
+		if fit is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		rot, shift = fit
+		return _transform_header(header,rot,shift)
+
+	def _coarse_shift(self,ref,new):
+		"""
+		Most common offset between the bright reference and new sources.
+		"""
+		d = (new[np.newaxis,:30] - ref[:30,np.newaxis]).reshape(-1,2)
+		d = d[(abs(d) < self.max_shift).all(axis=1)]
+		if len(d) == 0:
+			return None
+		bins = np.arange(-self.max_shift,self.max_shift + self.match_radius,self.match_radius)
+		hist, xe, ye = np.histogram2d(d[:,0],d[:,1],bins=[bins,bins])
+		i, j = np.unravel_index(np.argmax(hist),hist.shape)
+		near = (abs(d[:,0] - (xe[i] + xe[i+1])/2) < self.match_radius) & (abs(d[:,1] - (ye[j] + ye[j+1])/2) < self.match_radius)
+		return np.median(d[near],axis=0)
+
+	def _match(self,ref,new):
+		shift = self._coarse_shift(ref,new)
+		if shift is None:
+			return None
+		tree = cKDTree(new)
+		rot = np.eye(2)
+		for i in range(3):
+			pred = ref @ rot.T + shift
+			dist, ind = tree.query(pred,distance_upper_bound=self.match_radius)
+			good = np.isfinite(dist)
+			# too few of the reference stars found, e.g. a bad frame or the wrong field
+			if (good.sum() < self.min_matches) | (good.sum() < len(ref) / 4):
+				return None
+			rot, shift = _fit_rotation(ref[good],new[ind[good]])
+		resid = new[ind[good]] - (ref[good] @ rot.T + shift)
+		rms = np.sqrt(np.mean(np.sum(resid**2,axis=1)))
+		if rms > self.max_rms:
+			return None
+		return rot, shift
+
+	def stats(self):
+		return {'hits':self.hits,'misses':self.misses,'solutions':len(self.solutions)}
+
+
+def _fit_rotation(a,b):
+	"""
+	Least squares rotation and shift so that b = a @ rot.T + shift.
+	"""
+	ac = a - a.mean(axis=0)
+	bc = b - b.mean(axis=0)
+	theta = np.arctan2(np.sum(ac[:,0]*bc[:,1] - ac[:,1]*bc[:,0]),
+					   np.sum(ac[:,0]*bc[:,0] + ac[:,1]*bc[:,1]))
+	rot = np.array([[np.cos(theta),-np.sin(theta)],
+					[np.sin(theta),np.cos(theta)]])
+	shift = b.mean(axis=0) - a.mean(axis=0) @ rot.T
+	return rot, shift
+
+def _transform_header(header,rot,shift):
+	"""
+	Move a WCS header to a frame where pixel p_new = rot @ p_old + shift. The linear
+	terms are updated exactly, SIP terms are kept as they are.
+	"""
+	new = header.copy()
+	crpix = np.array([header['CRPIX1'],header['CRPIX2']]) - 1
+	crpix = rot @ crpix + shift + 1
+	new['CRPIX1'] = crpix[0]
+	new['CRPIX2'] = crpix[1]
+	if 'CD1_1' in header:
+		pre = 'CD'
+		m = np.zeros((2,2))
+	else:
+		pre = 'PC'
+		m = np.eye(2)
+	for i in range(2):
+		for j in range(2):
+			key = '{}{}_{}'.format(pre,i+1,j+1)
+			if key in header:
+				m[i,j] = header[key]
+	m = m @ rot.T
+	for i in range(2):
+		for j in range(2):
+			new['{}{}_{}'.format(pre,i+1,j+1)] = m[i,j]
+	return new
+
+
+wcs_solutions = wcs_cache(catalogue=get_gaia_region)
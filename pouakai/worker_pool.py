@@ -0,0 +1,203 @@
+import os
+import gc
+import numpy as np
+from multiprocessing import get_context
+from ctypes import CDLL
+
+from core import pouakai, find_master
+from cal_index import get_index
+from cal_store import read_list, INT_SENTINEL
+from archive_index import read_header
+from master_cache import masters, get_master_frames, get_normalised_flat
+from sauron_registry import models
+import diagnostics
+
+package_directory = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+
+def frame_info(files,cal_dir=package_directory + 'cal_lists/'):
+	"""
+	(chip, band, exptime, jd) of each raw frame, taken from the observation list
+	so no frames need to be opened. Only frames missing from the list (or with a
+	bad entry) have their header read, and unreadable frames are left out.
+	"""
+	obs = read_list('obs_list',columns=['filename','chip','band','exptime','jd'],cal_dir=cal_dir)
+	good = (obs['chip'].values != INT_SENTINEL) & np.isfinite(obs['jd'].values) & np.isfinite(obs['exptime'].values)
+	obs = obs.iloc[good]
+	listed = dict(zip(obs['filename'].values,zip(obs['chip'].values,obs['band'].values,
+											  obs['exptime'].values,obs['jd'].values)))
+	info = {}
+	for file in files:
+		if file in listed:
+			info[file] = listed[file]
+			continue
+		try:
+			header = read_header(file)
+			band = header['COLOUR'] if 'COLOUR' in header else header['FILTER']
+			info[file] = (header['CHIP'],band.strip(),header['EXPTIME'],header['JDSTART'])
+		except Exception:
+			# unreadable frames are left to fail (and be reported) in the reduction
+			pass
+	return info
+
+def frame_group(info):
+	"""
+	(chip, night) of a raw frame from its frame_info. Nights are split at local
+	noon in NZ (0h UT), so all frames of a night share the same masters.
+	"""
+	chip, band, exptime, jd = info
+	return (chip, int(np.floor(jd + 0.5)))
+
+def group_frames(files,group_size=20,info=None):
+	"""
+	Split the files into (chip, night) groups, ordered by chip then night. Groups
+	larger than group_size are cut into consecutive chunks so a single night still
+	spreads over the workers.
+	"""
+	if info is None:
+		info = frame_info(files)
+	groups = {}
+	for file in files:
+		key = frame_group(info[file]) if file in info else (None, None)
+		groups.setdefault(key,[]).append(file)
+	keys = sorted(groups,key=lambda k: (str(k[0]),str(k[1])))
+	chunks = []
+	for k in keys:
+		group = groups[k]
+		chunks += [group[i:i + group_size] for i in range(0,len(group),group_size)]
+	return chunks
+
+
+_worker = {}
+
+def _preload(verbose=True):
+	"""
+	Warm the process wide caches (calibration indexes and sauron models). Run in
+	the parent before the workers are forked, so they share the loaded copies.
+	A failure is reported and left for the caches to load lazily in the workers.
+	"""
+	try:
+		get_index('dark')
+		get_index('flat')
+		models.preload()
+	except Exception as e:
+		if verbose:
+			print('Preloading the caches failed, loading them in the workers instead: {}: {}'.format(
+				  type(e).__name__,e))
+
+def _preload_masters(groups,info,time_tolerence=100,dark_tolerence=10,verbose=True):
+	"""
+	Read the master dark and flat (and the normalised flat) of each group into the
+	master cache of the parent, in group order and for as many groups as the cache
+	holds, so the forked workers share the pages instead of reading them again.
+	Groups whose masters can't be found are left to fail in the reduction.
+	"""
+	loaded = 0
+	size = 0
+	for group in groups:
+		if group[0] not in info:
+			continue
+		if masters.nbytes + size > masters.max_bytes:
+			break
+		chip, band, exptime, jd = info[group[0]]
+		before = masters.nbytes
+		try:
+			dark, _ = find_master('dark',chip,band,exptime,jd,time_tolerence,dark_tolerence)
+			flat, _ = find_master('flat',chip,band,exptime,jd,time_tolerence,dark_tolerence)
+			get_master_frames(dark)
+			get_master_frames(flat)
+			get_normalised_flat(flat)
+		except Exception:
+			continue
+		size = max(size,masters.nbytes - before)
+		loaded += 1
+	if verbose:
+		print('Preloaded the masters of {} of {} batches'.format(loaded,len(groups)))
+	return loaded
+
+def _init_worker(options):
+	"""
+	Run once in each worker: keep the reduction options. It must not raise, the
+	pool would keep replacing the worker.
+	"""
+	_worker['options'] = options
+	try:
+		_worker['libc'] = CDLL('libc.so.6')
+	except OSError:
+		_worker['libc'] = None
+
+def _reduce_group(files):
+	"""
+	Reduce a (chip, night) group of frames in the worker.
+	"""
+	results = []
+	for file in files:
+		try:
+			pouakai(file,**_worker['options'])
+			results += [(file,None)]
+		except Exception as e:
+			results += [(file,str(e))]
+	# figures drawn in the background of this worker
+	for file, error in diagnostics.wait().items():
+		print('Failed to draw the figure for {}: {}'.format(file,error))
+	gc.collect()
+	if _worker['libc'] is not None:
+		_worker['libc'].malloc_trim(0)
+	return results
+
+
+class worker_pool():
+	"""
+	Long lived pool of reduction workers. The calibration indexes, sauron models
+	and the masters of the first run's (chip, night) groups are loaded once and
+	the workers are forked at the start of that run, so they share the loaded
+	copies. Each worker then pulls groups of frames off the pool queue, so its
+	master and WCS caches stay hot between frames.
+
+	-------
+	Inputs-
+	-------
+		cores 		int 	number of worker processes
+		preload 	bool 	warm the caches before starting the workers
+		group_size 	int 	most frames handed to a worker at once
+		options 	kwargs 	passed to pouakai for every frame
+	"""
+	def __init__(self,cores=10,preload=True,group_size=20,**options):
+		self.cores = cores
+		self.preload = preload
+		self.group_size = group_size
+		self.options = options
+		self.pool = None
+
+	def _start(self,groups,info):
+		verbose = self.options.get('verbose',True)
+		if self.preload:
+			_preload(verbose)
+			_preload_masters(groups,info,self.options.get('time_tolerence',100),
+							 self.options.get('dark_tolerence',10),verbose)
+		ctx = get_context('fork')
+		self.pool = ctx.Pool(self.cores,initializer=_init_worker,initargs=(self.options,))
+
+	def run(self,files,verbose=True):
+		"""
+		Reduce the files, returning a list of (file, error) with error None on success.
+		"""
+		info = frame_info(files)
+		groups = group_frames(files,self.group_size,info)
+		if verbose:
+			print('Reducing {} files in {} (chip, night) batches'.format(len(files),len(groups)))
+		if self.pool is None:
+			self._start(groups,info)
+		results = []
+		for group in self.pool.imap_unordered(_reduce_group,groups):
+			for file, error in group:
+				if (error is not None) & verbose:
+					print('Failed: ' + file)
+					print(error)
+			results += group
+		return results
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
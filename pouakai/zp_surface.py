@@ -0,0 +1,160 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from scipy.interpolate import griddata
+from astropy.stats import sigma_clip
+
+
+def fit_surface(x,y,z,shape,smoother=100,method='full',bin_size=16):
+	"""
+	Interpolate zeropoints measured at source positions onto the image grid and
+	smooth them into a zeropoint surface.
+
+	-------
+	Inputs-
+	-------
+		x, y 		array 	integer pixel positions of the zeropoints
+		z 			array 	zeropoints
+		shape 		tuple 	image shape
+		smoother 	float 	gaussian smoothing scale in pixels
+		method 		str 	'full' interpolates and smooths at full resolution,
+							'coarse' does both on a grid binned by bin_size and
+							upsamples the result bilinearly
+		bin_size 	int 	pixels per coarse grid cell
+
+	--------
+	Outputs-
+	--------
+		estimate 	array 	zeropoint surface with the image shape
+		bitmask 	array 	128 | 4 where the linear interpolation was extrapolated
+	"""
+	if method == 'full':
+		return _fit_full(x,y,z,shape,smoother)
+	elif method == 'coarse':
+		return _fit_coarse(x,y,z,shape,smoother,bin_size)
+	else:
+		raise ValueError("method must be 'full' or 'coarse'")
+
+def _unique_points(x,y,z,shape):
+	"""
+	One zeropoint per pixel, the last one given wins, and zero is treated as missing.
+	"""
+	zpimage = np.zeros(shape)
+	zpimage[y,x] = z
+	zpimage[zpimage==0] = np.nan
+	return zpimage
+
+def _fit_full(x,y,z,shape,smoother):
+	zpimage = _unique_points(x,y,z,shape)
+
+	xx = np.arange(0, zpimage.shape[1])
+	yy = np.arange(0, zpimage.shape[0])
+	arr = np.ma.masked_invalid(zpimage)
+	xx, yy = np.meshgrid(xx, yy)
+	#get only the valid values
+	x1 = xx[~arr.mask]
+	y1 = yy[~arr.mask]
+	newarr = arr[~arr.mask]
+
+	estimate = griddata((x1, y1), newarr.ravel(),
+								(xx, yy),method='linear')
+	bitmask = np.zeros_like(zpimage,dtype=int)
+	bitmask[np.isnan(estimate)] = 128 | 4
+	nearest = griddata((x1, y1), newarr.ravel(),
+								(xx, yy),method='nearest')
+
+	estimate[np.isnan(estimate)] = nearest[np.isnan(estimate)]
+
+	estimate = gaussian_filter(estimate,smoother)
+
+	return estimate, bitmask
+
+def _fit_coarse(x,y,z,shape,smoother,bin_size):
+	# use the same one point per pixel selection as the full resolution fit
+	flat = np.ravel_multi_index((y,x),shape)
+	_, last = np.unique(flat[::-1],return_index=True)
+	keep = len(flat) - 1 - last
+	x, y, z = x[keep], y[keep], z[keep]
+	good = np.isfinite(z) & (z != 0)
+	x, y, z = x[good], y[good], z[good]
+
+	ny, nx = shape
+	cy = int(np.ceil(ny / bin_size))
+	cx = int(np.ceil(nx / bin_size))
+	# pixel coordinates of the coarse cell centres
+	gx = (np.arange(cx) + 0.5) * bin_size - 0.5
+	gy = (np.arange(cy) + 0.5) * bin_size - 0.5
+	gx, gy = np.meshgrid(gx, gy)
+
+	coarse = griddata((x, y), z, (gx, gy), method='linear')
+	outside = np.isnan(coarse)
+	nearest = griddata((x, y), z, (gx, gy), method='nearest')
+	coarse[outside] = nearest[outside]
+	coarse = gaussian_filter(coarse,smoother / bin_size)
+
+	estimate = upsample_bilinear(coarse,shape,bin_size)
+	bitmask = np.zeros(shape,dtype=int)
+	rows = np.minimum(np.arange(ny) // bin_size,cy - 1)
+	cols = np.minimum(np.arange(nx) // bin_size,cx - 1)
+	bitmask[outside[rows][:,cols]] = 128 | 4
+	return estimate, bitmask
+
+def upsample_bilinear(coarse,shape,bin_size):
+	"""
+	Bilinearly interpolate a grid of bin_size cells back to the full image shape.
+	"""
+	if min(coarse.shape) < 2:
+		coarse = np.pad(coarse,((0,max(2 - coarse.shape[0],0)),(0,max(2 - coarse.shape[1],0))),mode='edge')
+	cy, cx = coarse.shape
+	ny, nx = shape
+	u = np.clip((np.arange(nx) + 0.5) / bin_size - 0.5,0,cx - 1)
+	v = np.clip((np.arange(ny) + 0.5) / bin_size - 0.5,0,cy - 1)
+	x0 = np.minimum(u.astype(int),cx - 2)
+	y0 = np.minimum(v.astype(int),cy - 2)
+	fx = u - x0
+	fy = (v - y0)[:,np.newaxis]
+	rows = coarse[:,x0] * (1 - fx) + coarse[:,x0+1] * fx
+	return rows[y0] * (1 - fy) + rows[y0+1] * fy
+
+def zp_correction_surface(x,y,zps,shape,sigma=2,method='full',bin_size=16):
+	"""
+	Two pass zeropoint surface: a heavily smoothed fit is used to sigma clip the
+	outlying zeropoints, which are then left out of the final fit.
+	"""
+	ind = np.isfinite(zps)
+	tmp,_ = fit_surface(x[ind],y[ind],zps[ind],shape,smoother=200,method=method,bin_size=bin_size)
+	diff = (zps - tmp[y,x])
+	cut = ~sigma_clip(diff,sigma=sigma).mask
+	ind = ind & cut
+	estimate,bitmask = fit_surface(x[ind],y[ind],zps[ind],shape,smoother=30,method=method,bin_size=bin_size)
+	return estimate, bitmask, cut
+
+def compare_surfaces(reference,surface):
+	"""
+	Summary of the difference between two zeropoint surfaces (in mag).
+	"""
+	diff = surface - reference
+	stats = {'max_abs':np.nanmax(abs(diff)),
+			 'rms':np.sqrt(np.nanmean(diff**2)),
+			 'p99_abs':np.nanpercentile(abs(diff),99)}
+	return stats
+
+def save_surface(savepath,base_name,surface,x=None,y=None,zps=None):
+	"""
+	Save a zeropoint surface and, if given, the points (x, y, zeropoint) it was
+	fit to.
+	"""
+	np.save(f'{savepath}/zp_surface/{base_name}_zp_surface',surface)
+	if zps is not None:
+		np.savetxt(f'{savepath}/zp_surface/{base_name}_zp_points.txt',np.array([x,y,zps]))
+
+def check_saved_surface(savepath,base_name,method='coarse',bin_size=16):
+	"""
+	Refit the zeropoint surface of a reduced image from its saved zeropoints and
+	compare it to the surface saved by save_surface.
+	"""
+	reference = np.load(f'{savepath}/zp_surface/{base_name}_zp_surface.npy')
+	x, y, zps = np.loadtxt(f'{savepath}/zp_surface/{base_name}_zp_points.txt')
+	x = x.astype(int)
+	y = y.astype(int)
+	surface,_,_ = zp_correction_surface(x,y,zps,reference.shape,method=method,bin_size=bin_size)
+	return compare_surfaces(reference,surface)
@@ -0,0 +1,67 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'pouakai'))
+
+
+def _frames(n=3,shape=(256,128),seed=0):
+	rng = np.random.default_rng(seed)
+	raw = [rng.normal(3000,300,shape).astype(np.float64) for i in range(n)]
+	for frame in raw:
+		frame[rng.integers(0,shape[0],20),rng.integers(0,shape[1],20)] = 4e4
+		frame[5,5] = np.nan
+	dark = rng.normal(400,5,shape)
+	flat = rng.normal(20000,500,shape)
+	return raw, dark, flat, flat / np.nanmedian(flat)
+
+def test_calibrate_stack_matches_reduce_image():
+	try:
+		from batch import calibrate_stack
+		from core import pouakai
+	except ImportError as e:
+		pytest.skip('reduction dependencies not available: {}'.format(e))
+	raw, dark, flat, norm_flat = _frames()
+	stack, saturation, bkg = calibrate_stack(raw,dark,norm_flat,offset=500)
+	for i in range(len(raw)):
+		p = pouakai.__new__(pouakai)
+		p.raw_image = raw[i]
+		p.dark = dark
+		p.flat = flat
+		p.norm_flat = norm_flat
+		p.offset = 500
+		p.plotting = False
+		p.reduce_image()
+		assert np.array_equal(stack[i],p.image,equal_nan=True)
+		assert np.array_equal(saturation[i],p._saturaton_mask())
+
+def test_reduce_group_thumbnails_match_reduce_image(monkeypatch):
+	try:
+		import batch
+		from core import pouakai
+		import diagnostics
+	except ImportError as e:
+		pytest.skip('reduction dependencies not available: {}'.format(e))
+	raw, dark, flat, norm_flat = _frames()
+	monkeypatch.setattr(pouakai,'finish_reduction',lambda self: None)
+	group, single = [], []
+	for i in range(len(raw)):
+		for frames in [group,single]:
+			p = pouakai.__new__(pouakai)
+			p.file = str(i)
+			p.verbose = False
+			p.raw_image = raw[i]
+			p.dark = dark
+			p.flat = flat
+			p.norm_flat = norm_flat
+			p.offset = 500
+			p.plotting = True
+			p.diag = diagnostics.diagnostic_products()
+			frames += [p]
+	diag = [p.diag for p in group]
+	batch._reduce_group(group)
+	for i, p in enumerate(single):
+		p.reduce_image()
+		for name in ['raw','flat','reduced']:
+			assert np.array_equal(diag[i].products[name],p.diag.products[name],equal_nan=True)
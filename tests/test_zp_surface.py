@@ -0,0 +1,86 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'pouakai'))
+from zp_surface import zp_correction_surface, save_surface, check_saved_surface
+
+
+def _points(n=600,shape=(1024,512),seed=0):
+	rng = np.random.default_rng(seed)
+	x = rng.integers(0,shape[1],n)
+	y = rng.integers(0,shape[0],n)
+	zps = 25 + 0.1 * x / shape[1] + rng.normal(0,0.01,n)
+	return x, y, zps
+
+def test_saved_surface_round_trip(tmp_path):
+	os.makedirs(tmp_path / 'zp_surface')
+	x, y, zps = _points()
+	surface,_,_ = zp_correction_surface(x,y,zps,(1024,512),method='full')
+	save_surface(str(tmp_path),'frame',surface,x,y,zps)
+	stats = check_saved_surface(str(tmp_path),'frame',method='full')
+	assert stats['max_abs'] < 1e-8
+
+def _synthetic_frame(ny=1024,nx=512,nstar=800,seed=0):
+	from astropy.io import fits
+	from astropy.wcs import WCS
+	rng = np.random.default_rng(seed)
+	h = fits.Header()
+	h['CTYPE1'] = 'RA---TAN'; h['CTYPE2'] = 'DEC--TAN'
+	h['CRVAL1'] = 270.; h['CRVAL2'] = -29.
+	h['CRPIX1'] = nx / 2; h['CRPIX2'] = ny / 2
+	h['CD1_1'] = -0.58 / 3600; h['CD1_2'] = 0.; h['CD2_1'] = 0.; h['CD2_2'] = 0.58 / 3600
+	h['FILTER'] = 'R'; h['JDSTART'] = 2459765.0
+	wcs = WCS(h)
+	x = rng.uniform(20,nx-20,nstar)
+	y = rng.uniform(20,ny-20,nstar)
+	ra, dec = wcs.all_pix2world(x,y,0)
+	mag = rng.uniform(13,19,nstar)
+	image = rng.normal(0,10,(ny,nx))
+	yy, xx = np.mgrid[:ny,:nx]
+	flux = 10**(-0.4 * (mag - 25))
+	for i in range(nstar):
+		y0, x0 = int(y[i]), int(x[i])
+		sl = (slice(max(y0-12,0),y0+13),slice(max(x0-12,0),x0+13))
+		image[sl] += flux[i] / (2 * np.pi * 2.2**2) * np.exp(-((xx[sl] - x[i])**2 + (yy[sl] - y[i])**2) / (2 * 2.2**2))
+	# a zeropoint gradient across the frame for the surface to fit
+	image = image * (1 + 0.2 * xx / nx) + 500
+	cat = pd.DataFrame({'RA_ICRS':ra,'DE_ICRS':dec,'pmRA':np.zeros(nstar),'pmDE':np.zeros(nstar),
+						'Source':np.arange(nstar),'Gmag':mag})
+	return image.astype(np.float32), wcs, h, cat, mag
+
+def test_rescaled_photometry_saves_surface_points(tmp_path,monkeypatch):
+	try:
+		import aperture_photom
+		import sauron_registry
+	except ImportError as e:
+		pytest.skip('photometry dependencies not available: {}'.format(e))
+	from astropy.coordinates import SkyCoord
+	import astropy.units as u
+
+	image, wcs, header, cat, mag = _synthetic_frame()
+
+	class catalogue_model():
+		def __init__(self,load_state=None,**kwargs):
+			pass
+		def estimate_mag(self,ra=None,dec=None,close=True):
+			c = SkyCoord(ra * u.deg,dec * u.deg)
+			i,_,_ = c.match_to_catalog_sky(SkyCoord(cat.RA_ICRS.values * u.deg,cat.DE_ICRS.values * u.deg))
+			return mag[i]
+
+	monkeypatch.setattr(aperture_photom,'get_gaia_region',lambda *a,**k: cat.copy())
+	monkeypatch.setattr(sauron_registry,'sauron',catalogue_model)
+	sauron_registry.models._models.clear()
+
+	cal = aperture_photom.ap_photom(data=image,wcs=wcs,header=header,plot=False,
+									rescale=True,surface_method='full')
+	sauron_registry.models._models.clear()
+	# the rescaled pass flattens the zeropoints, the surface was fit to the first pass
+	assert np.nanstd(cal.surface_zps) > 2 * np.nanstd(cal.zps)
+
+	os.makedirs(tmp_path / 'zp_surface')
+	save_surface(str(tmp_path),'frame',cal.zp_surface,cal.surface_x,cal.surface_y,cal.surface_zps)
+	stats = check_saved_surface(str(tmp_path),'frame',method='full')
+	assert stats['max_abs'] < 1e-8